@@ -0,0 +1,121 @@
+# async_server.py
+
+import asyncio
+import contextvars
+import functools
+
+from common.config import env_int, env_str
+
+# "threads" serves on grpc.server with a fixed thread pool, "asyncio" on grpc.aio
+SERVER_MODE = env_str("VIE_SERVER_MODE", "threads")
+
+# Bound on in-flight RPCs in asyncio mode; the thread pool bounds it in threads mode
+MAX_CONCURRENT_RPCS = env_int("VIE_MAX_CONCURRENT_RPCS", 1000)
+
+# Threads running the blocking and CPU-bound parts of RPCs in asyncio mode
+ASYNC_EXECUTOR_WORKERS = env_int("VIE_ASYNC_EXECUTOR_WORKERS", 10)
+
+
+def use_asyncio() -> bool:
+    """
+    @brief Returns whether the services are configured to serve with grpc.aio.
+
+    @exception ValueError If VIE_SERVER_MODE is neither "threads" nor "asyncio".
+    """
+    mode = SERVER_MODE.strip().lower()
+    if mode not in ("threads", "asyncio"):
+        raise ValueError(f"Unknown server mode {SERVER_MODE!r}")
+    return mode == "asyncio"
+
+
+async def offload(executor, function, *args):
+    """
+    @brief Runs a blocking function on an executor without blocking the event loop.
+
+    The function runs in a copy of the caller's contextvars context, as it would if it
+    were called directly, so it sees e.g. the caller's trace span.
+
+    @param executor The concurrent.futures executor to run the function on.
+    @param function The function to run.
+    @param args The arguments to call it with.
+    @return The function's result.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, function, *args)
+    )
+
+
+def offloaded(method):
+    """
+    @brief Turns a synchronous unary servicer method into a coroutine that runs it on
+    the servicer's executor attribute.
+
+    @param method The synchronous method, taking the request and the gRPC context.
+    @return The asynchronous method.
+    """
+
+    @functools.wraps(method)
+    async def run(self, request, context):
+        return await offload(self.executor, method, self, request, context)
+
+    return run
+
+
+def offloaded_stream(method):
+    """
+    @brief Turns a synchronous server-streaming servicer method into an asynchronous
+    generator that advances it on the servicer's executor attribute.
+
+    @param method The synchronous generator method, taking the request and the gRPC
+           context.
+    @return The asynchronous generator method.
+    """
+
+    @functools.wraps(method)
+    async def run(self, request, context):
+        iterator = method(self, request, context)
+        done = object()
+        # Every step runs in the same context, so context variables the generator sets
+        # persist from one step to the next
+        step_context = contextvars.copy_context()
+        while True:
+            item = await offload(self.executor, step_context.run, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    return run
+
+
+def offloaded_client_stream(method):
+    """
+    @brief Turns a synchronous client-streaming servicer method into a coroutine that
+    runs it on the servicer's executor attribute.
+
+    The method iterates the requests as usual; each step waits on the event loop for
+    the next request of the asynchronous request iterator.
+
+    @param method The synchronous method, taking the request iterator and the gRPC
+           context.
+    @return The asynchronous method.
+    """
+
+    @functools.wraps(method)
+    async def run(self, request_iterator, context):
+        loop = asyncio.get_running_loop()
+        iterator = request_iterator.__aiter__()
+
+        def requests():
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(
+                        iterator.__anext__(), loop
+                    ).result()
+                except StopAsyncIteration:
+                    return
+
+        return await offload(self.executor, method, self, requests(), context)
+
+    return run
@@ -0,0 +1,204 @@
+# benchmarking.py
+
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+# Relative change for the worse past which a gated metric fails the run
+DEFAULT_THRESHOLD = 0.25
+
+
+class Metric(NamedTuple):
+    """
+    @brief One measured value of a benchmark run.
+    """
+
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = False
+
+
+def best_time(function: Callable[[], object], repeats: int, number: int = 1) -> float:
+    """
+    @brief Returns the fastest wall time of calling a function, in seconds per call.
+
+    As with timeit, the minimum of several samples is reported: slower samples measure
+    interference from the rest of the machine rather than the code.
+
+    @param function The function to time; its result is discarded.
+    @param repeats The number of samples.
+    @param number The number of calls per sample, so that fast functions take long
+           enough to time.
+    @return The duration of one call in the fastest sample.
+    """
+    return min(timeit.repeat(function, repeat=repeats, number=number)) / number
+
+
+def load_baseline(path: Path) -> dict:
+    """
+    @brief Reads a baseline file, or returns an empty baseline if there is none.
+
+    @param path The JSON baseline file.
+    @return A dict with a "metrics" dict of name to {"value", "unit",
+            "higher_is_better", "gate"} and an optional default "threshold".
+    """
+    if not path.exists():
+        return {"metrics": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(path: Path, metrics: Iterable[Metric], previous: dict) -> None:
+    """
+    @brief Writes measured metrics as the new baseline.
+
+    The gate flags and thresholds of metrics already in the previous baseline are kept,
+    so choosing which metrics gate a run survives re-baselining; new metrics are gated.
+
+    @param path The JSON baseline file.
+    @param metrics The measured metrics.
+    @param previous The baseline being replaced, from load_baseline.
+    """
+    entries = {}
+    for metric in metrics:
+        old = previous["metrics"].get(metric.name, {})
+        entry = {
+            "value": metric.value,
+            "unit": metric.unit,
+            "higher_is_better": metric.higher_is_better,
+            "gate": old.get("gate", True),
+        }
+        if "threshold" in old:
+            entry["threshold"] = old["threshold"]
+        entries[metric.name] = entry
+    baseline = {
+        "threshold": previous.get("threshold", DEFAULT_THRESHOLD),
+        "metrics": entries,
+    }
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2)
+        file.write("\n")
+
+
+def find_regressions(
+    metrics: Iterable[Metric], baseline: dict, threshold: Optional[float] = None
+) -> List[str]:
+    """
+    @brief Compares metrics with a baseline.
+
+    A gated metric regresses when it is worse than its baseline value by more than its
+    threshold, relative to the baseline value. Metrics missing from the baseline and
+    metrics whose baseline entry has "gate": false are not checked.
+
+    @param metrics The measured metrics.
+    @param baseline The baseline, from load_baseline.
+    @param threshold The threshold of metrics without one of their own, or None for
+           the baseline's default.
+    @return One message per regressed metric, empty if none regressed.
+    """
+    if threshold is None:
+        threshold = baseline.get("threshold", DEFAULT_THRESHOLD)
+    regressions = []
+    for metric in metrics:
+        entry = baseline["metrics"].get(metric.name)
+        if entry is None or not entry.get("gate", True) or entry["value"] <= 0:
+            continue
+        change = (metric.value - entry["value"]) / entry["value"]
+        if metric.higher_is_better:
+            change = -change
+        allowed = entry.get("threshold", threshold)
+        if change > allowed:
+            regressions.append(
+                f"{metric.name}: {metric.value:.6g} {metric.unit} is {change:.0%} worse "
+                f"than the baseline {entry['value']:.6g} {metric.unit} "
+                f"(threshold {allowed:.0%})"
+            )
+    return regressions
+
+
+def run_suite(
+    description: str,
+    benchmarks: Dict[str, Callable[[], Iterable[Metric]]],
+    baseline_path: Path,
+    argv: Optional[List[str]] = None,
+) -> int:
+    """
+    @brief Runs benchmarks from the command line and gates them against a baseline.
+
+    Each benchmark returns the metrics it measured. The metrics are printed next to
+    their baseline values; with --update-baseline they are written as the new baseline
+    instead of being checked.
+
+    @param description The description shown by --help.
+    @param benchmarks The benchmark functions, by name.
+    @param baseline_path The JSON baseline file.
+    @param argv The command line arguments, or None for sys.argv.
+    @return The exit status: 0, or 1 if a gated metric regressed.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="write the results as the new baseline instead of checking them",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="relative regression allowed for metrics without a threshold of their own",
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=sorted(benchmarks),
+        help="run only this benchmark; may be repeated",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="also write the results to this JSON file"
+    )
+    arguments = parser.parse_args(argv)
+
+    baseline = load_baseline(baseline_path)
+    metrics = []
+    print(f"{'metric':<44} {'value':>21} {'baseline':>14} {'change':>8}")
+    for name in arguments.only or benchmarks:
+        for metric in benchmarks[name]():
+            metrics.append(metric)
+            entry = baseline["metrics"].get(metric.name)
+            if entry is None:
+                reference, change = "-", ""
+            else:
+                reference = f"{entry['value']:.6g}"
+                change = (
+                    f"{(metric.value - entry['value']) / entry['value']:+.0%}"
+                    if entry["value"]
+                    else ""
+                )
+            print(
+                f"{metric.name:<44} {metric.value:>12.6g} {metric.unit:<8} "
+                f"{reference:>14} {change:>8}"
+            )
+
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump({metric.name: metric._asdict() for metric in metrics}, file)
+    if arguments.update_baseline:
+        if arguments.only:
+            # Keep the metrics of the benchmarks that were not run
+            kept = {metric.name for metric in metrics}
+            metrics += [
+                Metric(name, entry["value"], entry["unit"], entry["higher_is_better"])
+                for name, entry in baseline["metrics"].items()
+                if name not in kept
+            ]
+        save_baseline(baseline_path, metrics, baseline)
+        print(f"Baseline written to {baseline_path}")
+        return 0
+
+    regressions = find_regressions(metrics, baseline, arguments.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
@@ -0,0 +1,215 @@
+# channel_pool.py
+
+import asyncio
+import threading
+from typing import Optional
+
+import grpc
+
+from common.config import env_int, env_str
+
+# Interval between keepalive pings on a pooled connection, and how long to wait for
+# the acknowledgement before the connection is considered dead
+KEEPALIVE_TIME_MS = env_int("VIE_GRPC_KEEPALIVE_TIME_MS", 30_000)
+KEEPALIVE_TIMEOUT_MS = env_int("VIE_GRPC_KEEPALIVE_TIMEOUT_MS", 10_000)
+
+# Largest message sent or received; gRPC's default receive limit is 4 MiB
+MAX_MESSAGE_BYTES = env_int("VIE_GRPC_MAX_MESSAGE_BYTES", 64 * 1024 * 1024)
+
+# Compression of large request payloads: "gzip", "deflate" or "none"
+COMPRESSION = env_str("VIE_GRPC_COMPRESSION", "gzip")
+
+# Payloads of at least this many bytes are compressed
+COMPRESSION_MIN_BYTES = env_int("VIE_GRPC_COMPRESSION_MIN_BYTES", 64 * 1024)
+
+_COMPRESSIONS = {
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+    "none": grpc.Compression.NoCompression,
+}
+
+
+def channel_options(authority: Optional[str] = None) -> list:
+    """
+    @brief Returns the options of pooled client channels.
+
+    @param authority The host name to verify the server certificate against and send
+           as the authority, or None for the target's host.
+    @return A list of (name, value) channel arguments.
+    """
+    options = [
+        ("grpc.keepalive_time_ms", KEEPALIVE_TIME_MS),
+        ("grpc.keepalive_timeout_ms", KEEPALIVE_TIMEOUT_MS),
+        # Keep idle pooled connections alive too, so the next call needs no handshake
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+        ("grpc.max_send_message_length", MAX_MESSAGE_BYTES),
+        ("grpc.max_receive_message_length", MAX_MESSAGE_BYTES),
+    ]
+    if authority is not None:
+        options += [
+            ("grpc.ssl_target_name_override", authority),
+            ("grpc.default_authority", authority),
+        ]
+    return options
+
+
+def server_options() -> list:
+    """
+    @brief Returns the options of servers accepting pooled channels.
+
+    Servers by default answer pings more frequent than every five minutes with a
+    GOAWAY, which would drop pooled connections; these options accept the pooled
+    channels' keepalive pings and raise the message size limits to match theirs.
+
+    @return A list of (name, value) server arguments.
+    """
+    return [
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_ping_interval_without_data_ms", KEEPALIVE_TIME_MS // 2),
+        ("grpc.max_send_message_length", MAX_MESSAGE_BYTES),
+        ("grpc.max_receive_message_length", MAX_MESSAGE_BYTES),
+    ]
+
+
+def call_compression(payload_bytes: int) -> grpc.Compression:
+    """
+    @brief Chooses the compression of a call by the size of its payload.
+
+    Small payloads are sent as they are, as compressing them costs more time than the
+    bytes saved; the server decompresses whichever algorithm a call was sent with.
+
+    @param payload_bytes The approximate size of the request payload in bytes.
+    @return The grpc.Compression to pass to the call.
+
+    @exception ValueError If VIE_GRPC_COMPRESSION names no known algorithm.
+    """
+    compression = _COMPRESSIONS.get(COMPRESSION.strip().lower())
+    if compression is None:
+        raise ValueError(f"Unknown gRPC compression {COMPRESSION!r}")
+    if payload_bytes < COMPRESSION_MIN_BYTES:
+        return grpc.Compression.NoCompression
+    return compression
+
+
+class ChannelPool:
+    """
+    @brief Cache of gRPC client channels shared by every client in the process.
+
+    Clients of the same target with the same credentials share one channel, so a
+    target costs one connection and one TLS handshake however many service instances
+    talk to it. grpc.aio channels belong to the event loop they were opened on and are
+    shared per loop.
+    """
+
+    def __init__(self):
+        """
+        @brief Creates an empty pool.
+        """
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def channel(
+        self,
+        target: str,
+        root_certificates: Optional[bytes] = None,
+        authority: Optional[str] = None,
+    ) -> grpc.Channel:
+        """
+        @brief Returns the shared channel to a target, opening it on first use.
+
+        @param target The server address, e.g. "localhost:50052".
+        @param root_certificates The PEM certificates to verify the server with, or None
+               for a channel without TLS.
+        @param authority The host name to verify the server certificate against, or
+               None for the target's host.
+        @return The grpc.Channel; callers must not close it.
+        """
+        key = ("sync", target, root_certificates, authority)
+        with self._lock:
+            channel = self._channels.get(key)
+            if channel is None:
+                channel = _open(grpc, target, root_certificates, authority)
+                self._channels[key] = channel
+            return channel
+
+    def aio_channel(
+        self,
+        target: str,
+        root_certificates: Optional[bytes] = None,
+        authority: Optional[str] = None,
+    ) -> grpc.aio.Channel:
+        """
+        @brief Returns the shared grpc.aio channel of the running event loop to a target.
+
+        @param target The server address, e.g. "localhost:50052".
+        @param root_certificates The PEM certificates to verify the server with, or None
+               for a channel without TLS.
+        @param authority The host name to verify the server certificate against, or
+               None for the target's host.
+        @return The grpc.aio.Channel; callers must not close it.
+        """
+        loop = asyncio.get_running_loop()
+        key = ("aio", loop, target, root_certificates, authority)
+        with self._lock:
+            # The channels of closed loops can neither be used nor closed any more
+            for stale in [
+                k for k in self._channels if k[0] == "aio" and k[1].is_closed()
+            ]:
+                del self._channels[stale]
+            channel = self._channels.get(key)
+            if channel is None:
+                channel = _open(grpc.aio, target, root_certificates, authority)
+                self._channels[key] = channel
+            return channel
+
+    def close(self) -> None:
+        """
+        @brief Closes the pooled channels; grpc.aio channels close with their loops.
+        """
+        with self._lock:
+            channels, self._channels = self._channels, {}
+        for key, channel in channels.items():
+            if key[0] == "sync":
+                channel.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._channels)
+
+
+def _open(module, target, root_certificates, authority):
+    """
+    @brief Opens a channel with the pool's options through grpc or grpc.aio.
+    """
+    options = channel_options(authority)
+    if root_certificates is None:
+        return module.insecure_channel(target, options=options)
+    credentials = grpc.ssl_channel_credentials(root_certificates=root_certificates)
+    return module.secure_channel(target, credentials, options=options)
+
+
+_shared_pool = ChannelPool()
+
+
+def shared_channel(
+    target: str,
+    root_certificates: Optional[bytes] = None,
+    authority: Optional[str] = None,
+) -> grpc.Channel:
+    """
+    @brief Returns the process-wide channel to a target; see ChannelPool.channel.
+    """
+    return _shared_pool.channel(target, root_certificates, authority)
+
+
+def shared_aio_channel(
+    target: str,
+    root_certificates: Optional[bytes] = None,
+    authority: Optional[str] = None,
+) -> grpc.aio.Channel:
+    """
+    @brief Returns the process-wide grpc.aio channel of the running event loop to a
+    target; see ChannelPool.aio_channel.
+    """
+    return _shared_pool.aio_channel(target, root_certificates, authority)
@@ -0,0 +1,54 @@
+# config.py
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    @brief Reads an integer setting from the environment.
+
+    @param name The environment variable holding the setting.
+    @param default The value used when the variable is unset or empty.
+    @return The configured integer.
+    """
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    @brief Reads a floating point setting from the environment.
+
+    @param name The environment variable holding the setting.
+    @param default The value used when the variable is unset or empty.
+    @return The configured number.
+    """
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def env_str(name: str, default: str) -> str:
+    """
+    @brief Reads a string setting from the environment.
+
+    @param name The environment variable holding the setting.
+    @param default The value used when the variable is unset or empty.
+    @return The configured string.
+    """
+    return os.environ.get(name) or default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """
+    @brief Reads a boolean setting from the environment.
+
+    "1", "true", "yes" and "on" (in any case) are true; any other non-empty value is false.
+
+    @param name The environment variable holding the setting.
+    @param default The value used when the variable is unset or empty.
+    @return The configured flag.
+    """
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,157 @@
+# interceptors.py
+
+import asyncio
+import inspect
+import threading
+
+import grpc
+
+
+class HandlerCache:
+    """
+    @brief The wrapped handler of each method, so that an interceptor wraps a method's
+    handler once rather than on every call.
+    """
+
+    def __init__(self, wrap):
+        """
+        @brief Creates an empty cache.
+
+        @param wrap A function taking an RpcMethodHandler and its full method name and
+               returning the handler to serve instead.
+        """
+        self._wrap = wrap
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def get(self, handler, method):
+        """
+        @brief Returns the wrapped handler of a method.
+
+        @param handler The RpcMethodHandler, or None for an unknown method.
+        @param method The full method name, e.g. "/persistence.PersistenceService/StoreTerrain".
+        @return The wrapped handler, or None for an unknown method.
+        """
+        if handler is None:
+            return None
+        cached = self._handlers.get(method)
+        if cached is not None and cached[0] is handler:
+            return cached[1]
+        wrapped = self._wrap(handler, method)
+        with self._lock:
+            self._handlers[method] = (handler, wrapped)
+        return wrapped
+
+
+def split_method(method):
+    """
+    @brief Splits a full method name into its service and method names.
+
+    @param method The full method name, e.g. "/persistence.PersistenceService/StoreTerrain".
+    @return A pair such as ("persistence.PersistenceService", "StoreTerrain").
+    """
+    service, _, name = method.lstrip("/").rpartition("/")
+    return service, name
+
+
+def wrap_handler(
+    handler, start, finish, request_deserializer=None, response_serializer=None
+):
+    """
+    @brief Returns a copy of a handler that calls hooks around each call.
+
+    The behavior keeps its kind, coroutine function, asynchronous generator function,
+    generator or plain function, so the same hooks serve grpc.server and
+    grpc.aio.server. A call ends when its behavior returns, raises or, for response
+    streams, when the stream ends.
+
+    @param handler The RpcMethodHandler.
+    @param start A function called with the servicer context when a call starts,
+           returning a state for finish.
+    @param finish A function called with the state, the servicer context and the
+           exception the behavior raised, or None, when a call ends.
+    @param request_deserializer A replacement request deserializer, or None to keep it.
+    @param response_serializer A replacement response serializer, or None to keep it.
+    @return The new RpcMethodHandler.
+    """
+    if handler.request_streaming and handler.response_streaming:
+        behavior, factory = handler.stream_stream, grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        behavior, factory = handler.stream_unary, grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        behavior, factory = handler.unary_stream, grpc.unary_stream_rpc_method_handler
+    else:
+        behavior, factory = handler.unary_unary, grpc.unary_unary_rpc_method_handler
+
+    if inspect.isasyncgenfunction(behavior):
+
+        async def handle(request, context):
+            state, error = start(context), None
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                finish(state, context, error)
+
+    elif inspect.iscoroutinefunction(behavior):
+
+        async def handle(request, context):
+            state, error = start(context), None
+            try:
+                return await behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                finish(state, context, error)
+
+    elif handler.response_streaming:
+
+        def handle(request, context):
+            state, error = start(context), None
+            try:
+                yield from behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                finish(state, context, error)
+
+    else:
+
+        def handle(request, context):
+            state, error = start(context), None
+            try:
+                return behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                finish(state, context, error)
+
+    return factory(
+        handle,
+        request_deserializer=request_deserializer or handler.request_deserializer,
+        response_serializer=response_serializer or handler.response_serializer,
+    )
+
+
+def status_code(context, error):
+    """
+    @brief Returns the status code an RPC ended with.
+
+    @param context The RPC's servicer context.
+    @param error The exception the handler raised, or None.
+    @return The grpc.StatusCode.
+    """
+    code = context.code()
+    if code is not None:
+        return code
+    if error is None:
+        return grpc.StatusCode.OK
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+        return grpc.StatusCode.CANCELLED
+    return grpc.StatusCode.UNKNOWN
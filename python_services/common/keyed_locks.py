@@ -0,0 +1,75 @@
+# keyed_locks.py
+
+import asyncio
+import contextlib
+import threading
+
+
+class KeyedLocks:
+    """
+    @brief A lock per key, so that work on one key never waits for work on another.
+
+    Locks are created when a key is first held and dropped once nothing holds or waits
+    for them, so the number of locks follows the number of keys in use.
+    """
+
+    lock_type = threading.Lock
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, holders and waiters]
+        self._lock = threading.Lock()
+
+    def _enter(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [self.lock_type(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _exit(self, key):
+        with self._lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        """
+        @brief Holds the lock of a key for the duration of a with block.
+
+        @param key A hashable key.
+        """
+        lock = self._enter(key)
+        try:
+            with lock:
+                yield
+        finally:
+            self._exit(key)
+
+
+class AsyncKeyedLocks(KeyedLocks):
+    """
+    @brief KeyedLocks for coroutines of one event loop, held with async with.
+    """
+
+    lock_type = asyncio.Lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        """
+        @brief Holds the lock of a key for the duration of an async with block.
+
+        @param key A hashable key.
+        """
+        lock = self._enter(key)
+        try:
+            async with lock:
+                yield
+        finally:
+            self._exit(key)
@@ -1,45 +1,225 @@
 # logging_config.py
 
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
+from typing import Callable, Optional
+
+from common.config import env_int, env_str
+from common.metrics import counter
+
+# Default log level of each deployment environment, chosen by VIE_ENV
+ENVIRONMENT_LOG_LEVELS = {
+    'development': 'DEBUG',
+    'test': 'WARNING',
+    'production': 'INFO',
+}
+
+ENVIRONMENT = env_str('VIE_ENV', 'production')
+
+# Log level of every logger, overriding the environment's, and of single loggers, as
+# comma-separated name=LEVEL pairs, e.g. "PersistenceService=DEBUG,Tracing=WARNING"
+LOG_LEVEL = env_str('VIE_LOG_LEVEL', ENVIRONMENT_LOG_LEVELS.get(ENVIRONMENT, 'INFO'))
+LOG_LEVELS = env_str('VIE_LOG_LEVELS', '')
+
+# "text" for the classic one line format, "json" for one JSON object per line
+LOG_FORMAT = env_str('VIE_LOG_FORMAT', 'text')
+
+# Bound on records waiting for the writer thread; records beyond it are dropped rather
+# than blocking the thread that logs them
+LOG_QUEUE_SIZE = env_int('VIE_LOG_QUEUE_SIZE', 10000)
+
+# Most records log_sample writes for one collection of items
+LOG_SAMPLE_LIMIT = env_int('VIE_LOG_SAMPLE_LIMIT', 20)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+RECORDS_DROPPED = counter('vie_log_records_dropped_total',
+                          'Log records dropped because the queue to the writer thread was full.')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    @brief Formats records as single-line JSON objects for log collectors.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """
+    @brief Hands records to the writer thread without formatting or blocking.
+
+    The standard QueueHandler formats each record before queueing it; this one queues
+    the record as it is, so messages are only formatted, from their format string and
+    arguments, on the writer thread. A full queue drops the record and counts it in
+    RECORDS_DROPPED.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            RECORDS_DROPPED.inc()
+
+
+_handler: Optional[QueueingHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_lock = threading.Lock()
+
+
+def create_formatter(log_format: str = None) -> logging.Formatter:
+    """
+    @brief Returns the formatter of a log format.
+
+    @param log_format "text" or "json", or None for LOG_FORMAT.
+    @return The formatter.
+    """
+    log_format = log_format or LOG_FORMAT
+    if log_format == 'json':
+        return JsonFormatter()
+    if log_format == 'text':
+        return logging.Formatter(TEXT_FORMAT)
+    raise ValueError(f"Unknown log format {log_format!r}; expected 'text' or 'json'")
+
+
+def _queue_handler() -> QueueingHandler:
+    """
+    @brief Returns the process's queueing handler, starting its writer thread on first use.
+    """
+    global _handler, _listener
+    with _lock:
+        if _handler is None:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(create_formatter())
+            _handler = QueueingHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+            _listener = logging.handlers.QueueListener(_handler.queue, console_handler)
+            _listener.start()
+            atexit.register(_stop_writer)
+        return _handler
+
+
+def _stop_writer():
+    """
+    @brief Writes every queued record and stops the writer thread.
+
+    Called at exit, so that records logged just before are not lost.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def _parse_level(level: str, setting: str) -> int:
+    """
+    @brief Returns the number of a level name.
+
+    @param level The level name, in any case, e.g. "debug".
+    @param setting The environment variable the name was read from, for the error.
+    @return The level number.
+
+    @exception ValueError If the name is not a standard level.
+    """
+    number = logging.getLevelName(level.strip().upper())
+    if not isinstance(number, int):
+        raise ValueError(f"{setting}: unknown log level {level.strip()!r}; expected one of "
+                         f"DEBUG, INFO, WARNING, ERROR or CRITICAL")
+    return number
+
+
+def log_level(name: str) -> int:
+    """
+    @brief Returns the configured level of a logger.
+
+    @param name The logger name.
+    @return Its level in LOG_LEVELS if it has one there, and LOG_LEVEL otherwise.
+
+    @exception ValueError If the configured level is not a standard level.
+    """
+    for pair in LOG_LEVELS.split(','):
+        logger_name, _, logger_level = pair.partition('=')
+        if logger_name.strip() == name and logger_level.strip():
+            return _parse_level(logger_level, 'VIE_LOG_LEVELS')
+    return _parse_level(LOG_LEVEL, 'VIE_LOG_LEVEL')
+
 
 def configure_logging():
     """
-    Configures the logging system to output to stdout with appropriate formatting.
+    @brief Sends the records of loggers not set up with setup_logger, such as those of
+    gRPC and SQLAlchemy, through the same writer thread at LOG_LEVEL.
+
+    Services call this when they start, rather than on import, so importing a module
+    never reconfigures the root logger.
     """
-    logging.basicConfig(
-        level=logging.INFO,  # Set the minimum logging level
-        format='%(asctime)s - %(levelname)s - %(message)s'  # Define the log format
-    )
+    root = logging.getLogger()
+    root.setLevel(_parse_level(LOG_LEVEL, 'VIE_LOG_LEVEL'))
+    handler = _queue_handler()
+    if handler not in root.handlers:
+        root.addHandler(handler)
+
 
 def setup_logger(service_name: str) -> logging.Logger:
     """
     @brief Sets up and returns a logger for the specified service.
-    
+
+    Records are formatted and written to stdout by a background thread, so logging
+    costs the calling thread a level check and a queue put.
+
     @param service_name The name of the service.
     @return Configured Logger instance.
     """
     logger = logging.getLogger(service_name)
-    logger.setLevel(logging.DEBUG)  # Capture all log levels
+    logger.setLevel(log_level(service_name))
 
     # Prevent adding multiple handlers to the logger
     if not logger.handlers:
-        # Create a StreamHandler to output logs to stdout
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(logging.DEBUG)
-
-        # Define formatter with service name prefix
-        formatter = logging.Formatter(
-            '%(asctime)s - {service} - %(levelname)s - %(message)s'.format(service=service_name)
-        )
-        console_handler.setFormatter(formatter)
-
-        # Add the handler to the logger
-        logger.addHandler(console_handler)
+        logger.addHandler(_queue_handler())
 
         # Prevent log messages from being propagated to the root logger
         logger.propagate = False
 
     return logger
 
-configure_logging()
+
+def log_sample(logger: logging.Logger, level: int, message: str, count: int,
+               arguments: Callable[[int], tuple], limit: int = None):
+    """
+    @brief Logs a message for an evenly spaced sample of a collection's items rather than
+    for each of them.
+
+    @param logger The logger.
+    @param level The level to log at; nothing is computed if it is not enabled.
+    @param message The format string of each item's message.
+    @param count The number of items.
+    @param arguments A function returning the message arguments of the item at an index.
+    @param limit The most items to log, or None for LOG_SAMPLE_LIMIT.
+    """
+    if not count or not logger.isEnabledFor(level):
+        return
+    limit = LOG_SAMPLE_LIMIT if limit is None else limit
+    if limit <= 0:
+        return
+    indexes = range(0, count, -(-count // limit))
+    for index in indexes:
+        logger.log(level, message, *arguments(index))
+    if len(indexes) < count:
+        logger.log(level, 'Logged %d of %d items', len(indexes), count)
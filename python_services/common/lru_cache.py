@@ -0,0 +1,125 @@
+# lru_cache.py
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    @brief Thread-safe least recently used cache bounded by entry count and total bytes.
+
+    Callers supply the size of each value when storing it, so the byte bound applies to
+    whatever representation they cache (typically serialized protobuf payloads).
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        """
+        @brief Initializes an empty cache.
+
+        @param max_entries The maximum number of entries kept; 0 disables the cache.
+        @param max_bytes The maximum total size of the cached values in bytes.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        @brief Returns the value cached for key and marks it most recently used.
+
+        @param key The cache key.
+        @return The cached value, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> bool:
+        """
+        @brief Stores a value, evicting least recently used entries to stay within bounds.
+
+        @param key The cache key.
+        @param value The value to cache.
+        @param size The size of the value in bytes.
+        @return True if the value was cached, False if it is larger than the whole cache.
+        """
+        with self._lock:
+            self._discard(key)
+            if self.max_entries < 1 or size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while (
+                len(self._entries) > self.max_entries
+                or self.current_bytes > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key: Hashable) -> bool:
+        """
+        @brief Removes the entry for key, if any.
+
+        @param key The cache key.
+        @return True if an entry was removed.
+        """
+        with self._lock:
+            return self._discard(key)
+
+    def clear(self) -> None:
+        """
+        @brief Removes every entry without touching the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        @brief The fraction of lookups that were hits, or 0.0 before any lookup.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """
+        @brief Returns a snapshot of the cache counters.
+
+        @return A dictionary with hits, misses, hit_ratio, evictions, entries and bytes.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hit_ratio,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.current_bytes -= entry[1]
+        return True
@@ -0,0 +1,349 @@
+# metrics.py
+
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        """
+        @brief Adds a non-negative amount to the counter.
+        """
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self._lock:
+            self._value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self._value
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        @brief Reports the result of calling a function at each scrape instead.
+        """
+        self._function = function
+
+    def samples(self, name, labels):
+        function = self._function
+        yield name, labels, function() if function is not None else self._value
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # The last one counts +Inf only
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class Metric:
+    """
+    @brief A named metric with a value per combination of label values.
+
+    Metrics without labels are updated directly, e.g. counter.inc(); metrics with
+    labels through the child of their label values, e.g. counter.labels("a").inc().
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        """
+        @brief Creates a metric with no values.
+
+        @param name The metric name.
+        @param documentation The help text.
+        @param label_names The names of the metric's labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        self._unlabeled = None if self.label_names else self.labels()
+
+    def labels(self, *values):
+        """
+        @brief Returns the child holding the value of a combination of label values.
+
+        @param values The label values, in the order of the label names.
+        @return The child, created on first use.
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}")
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _child(self):
+        if self._unlabeled is None:
+            raise ValueError(f"{self.name} has labels; update it through labels()")
+        return self._unlabeled
+
+    def samples(self) -> Iterable[Tuple[str, tuple, float]]:
+        """
+        @brief Returns the current samples as (name, ((label, value), ...), value).
+        """
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            yield from child.samples(self.name, tuple(zip(self.label_names, values)))
+
+
+class Counter(Metric):
+    """
+    @brief A metric that only increases, such as a number of requests.
+    """
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._child().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    @brief A metric that goes up and down, such as a number of open sessions.
+    """
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._child().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._child().dec(amount)
+
+    def set(self, value: float) -> None:
+        self._child().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._child().set_function(function)
+
+
+class Histogram(Metric):
+    """
+    @brief A metric counting observations, such as latencies, in buckets of upper bounds.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        @brief Creates a histogram with no observations.
+
+        @param name The metric name.
+        @param documentation The help text.
+        @param label_names The names of the metric's labels.
+        @param buckets The increasing upper bounds of the buckets, without +Inf.
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._child().observe(value)
+
+
+class Registry:
+    """
+    @brief A set of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        @brief Adds a metric, or returns the registered one of the same name and type.
+
+        Modules define their metrics at import, so registering twice is not an error.
+
+        @param metric The metric.
+        @return The registered metric.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric):
+            raise ValueError(f"Metric {metric.name} is already a {existing.kind}")
+        return existing
+
+    def render(self) -> str:
+        """
+        @brief Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    pairs = ",".join(
+                        f'{label}="{_escape(str(label_value), quote=True)}"'
+                        for label, label_value in labels
+                    )
+                    name = f"{name}{{{pairs}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+    """
+    @brief Returns the counter of a name in the default registry, creating it if new.
+    """
+    return REGISTRY.register(Counter(name, documentation, label_names))
+
+
+def gauge(name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+    """
+    @brief Returns the gauge of a name in the default registry, creating it if new.
+    """
+    return REGISTRY.register(Gauge(name, documentation, label_names))
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    label_names: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> Histogram:
+    """
+    @brief Returns the histogram of a name in the default registry, creating it if new.
+    """
+    return REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+
+def start_metrics_server(
+    port: int, address: str = "127.0.0.1", registry: Registry = REGISTRY
+) -> ThreadingHTTPServer:
+    """
+    @brief Serves a registry's metrics over HTTP at /metrics on a background thread.
+
+    @param port The port to listen on, or 0 for any free port.
+    @param address The address to listen on; the default only accepts local scrapes.
+    @param registry The registry to serve.
+    @return The running server; server_address holds the bound port and shutdown()
+            stops it.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are too frequent to log
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, daemon=True, name="metrics-server"
+    ).start()
+    return server
+
+
+def _escape(text: str, quote: bool = False) -> str:
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quote else text
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
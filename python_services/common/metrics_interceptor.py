@@ -0,0 +1,120 @@
+# metrics_interceptor.py
+
+import time
+
+import grpc
+
+from common.interceptors import HandlerCache, split_method, status_code, wrap_handler
+from common.metrics import counter, gauge, histogram
+
+# Upper bounds of the message size buckets, in bytes: 64 B to 64 MiB by powers of four
+SIZE_BUCKETS = tuple(64 * 4**power for power in range(11))
+
+_METHOD_LABELS = ("grpc_service", "grpc_method")
+
+RPCS_STARTED = counter(
+    "grpc_server_started_total", "RPCs started on the server.", _METHOD_LABELS
+)
+RPCS_HANDLED = counter(
+    "grpc_server_handled_total",
+    "RPCs completed on the server, by status code.",
+    _METHOD_LABELS + ("grpc_code",),
+)
+RPC_LATENCY = histogram(
+    "grpc_server_handling_seconds",
+    "Time from the start of an RPC until its handler returned or its response stream ended.",
+    _METHOD_LABELS,
+)
+RPCS_IN_FLIGHT = gauge(
+    "grpc_server_in_flight_rpcs", "RPCs being handled.", _METHOD_LABELS
+)
+REQUEST_BYTES = histogram(
+    "grpc_server_request_message_bytes",
+    "Serialized size of each request message received.",
+    _METHOD_LABELS,
+    SIZE_BUCKETS,
+)
+RESPONSE_BYTES = histogram(
+    "grpc_server_response_message_bytes",
+    "Serialized size of each response message sent.",
+    _METHOD_LABELS,
+    SIZE_BUCKETS,
+)
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """
+    @brief Records request counts, status codes, latencies, in-flight RPCs and message
+    sizes of every method of a grpc.server.
+    """
+
+    def __init__(self):
+        self._handlers = HandlerCache(_instrument)
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._handlers.get(
+            continuation(handler_call_details), handler_call_details.method
+        )
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """
+    @brief The MetricsInterceptor of a grpc.aio.server.
+    """
+
+    def __init__(self):
+        self._handlers = HandlerCache(_instrument)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._handlers.get(
+            await continuation(handler_call_details), handler_call_details.method
+        )
+
+
+def _instrument(handler, method):
+    """
+    @brief Returns a handler recording the metrics of an RPC method.
+    """
+    labels = split_method(method)
+    started = RPCS_STARTED.labels(*labels)
+    in_flight = RPCS_IN_FLIGHT.labels(*labels)
+    latency = RPC_LATENCY.labels(*labels)
+
+    def start(context):
+        started.inc()
+        in_flight.inc()
+        return time.perf_counter()
+
+    def finish(start_time, context, error):
+        latency.observe(time.perf_counter() - start_time)
+        in_flight.dec()
+        RPCS_HANDLED.labels(*labels, status_code(context, error).name).inc()
+
+    return wrap_handler(
+        handler,
+        start,
+        finish,
+        _measure_deserializer(
+            handler.request_deserializer, REQUEST_BYTES.labels(*labels)
+        ),
+        _measure_serializer(
+            handler.response_serializer, RESPONSE_BYTES.labels(*labels)
+        ),
+    )
+
+
+def _measure_deserializer(deserializer, sizes):
+    def deserialize(data):
+        sizes.observe(len(data))
+        return deserializer(data) if deserializer is not None else data
+
+    return deserialize
+
+
+def _measure_serializer(serializer, sizes):
+    def serialize(message):
+        data = serializer(message) if serializer is not None else message
+        sizes.observe(len(data))
+        return data
+
+    return serialize
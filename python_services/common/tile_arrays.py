@@ -0,0 +1,186 @@
+# tile_arrays.py
+
+from array import array
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+
+class Tile(NamedTuple):
+    """
+    @brief A single terrain tile read out of a TileArrays.
+    """
+
+    x: int
+    y: int
+    terrain_type: str
+    id: int = 0
+
+
+class TileArrays:
+    """
+    @brief Column-oriented storage of terrain tiles.
+
+    Tiles are kept as parallel x, y and terrain-code arrays plus a code to terrain type
+    table, and optionally a column of tile IDs. This is far more compact than one
+    protobuf message per tile and maps directly onto the PackedTiles wire format.
+    """
+
+    def __init__(self, terrain_types: Iterable[str] = (), with_ids: bool = False):
+        """
+        @brief Creates an empty tile store.
+
+        @param terrain_types The initial code to terrain type table.
+        @param with_ids Whether the store keeps a tile ID column.
+        """
+        self.terrain_types: List[str] = list(terrain_types)
+        self._codes_by_type = {
+            name: code for code, name in enumerate(self.terrain_types)
+        }
+        self.xs = array("i")
+        self.ys = array("i")
+        self.codes = bytearray()
+        self.ids: Optional[array] = array("i") if with_ids else None
+
+    @classmethod
+    def from_tiles(cls, tiles, terrain_types: Iterable[str] = (), with_ids=False):
+        """
+        @brief Builds a tile store from tile objects with x, y and terrain_type.
+
+        @param tiles The tiles, e.g. TerrainTile messages.
+        @param terrain_types The initial code table; unknown types are appended to it.
+        @param with_ids Whether to copy each tile's id attribute.
+        @return The populated TileArrays.
+        """
+        store = cls(terrain_types, with_ids=with_ids)
+        for tile in tiles:
+            store.append(
+                tile.x,
+                tile.y,
+                store.code_of(tile.terrain_type),
+                tile.id if with_ids else 0,
+            )
+        return store
+
+    @classmethod
+    def from_packed(cls, packed):
+        """
+        @brief Decodes a PackedTiles message.
+
+        @param packed A PackedTiles message from either service's protos.
+        @return The decoded TileArrays.
+        """
+        store = cls(packed.terrain_types, with_ids=bool(getattr(packed, "ids", ())))
+        store.xs.extend(packed.x)
+        store.ys.extend(packed.y)
+        store.codes.extend(packed.terrain_codes)
+        if store.ids is not None:
+            store.ids.extend(packed.ids)
+        if not len(store.xs) == len(store.ys) == len(store.codes):
+            raise ValueError("Packed tile columns have different lengths")
+        if store.codes and max(store.codes) >= len(store.terrain_types):
+            raise ValueError("Packed tile code has no terrain type")
+        return store
+
+    def code_of(self, terrain_type: str) -> int:
+        """
+        @brief Returns the code for a terrain type, adding it to the table if new.
+
+        @param terrain_type The terrain type name.
+        @return The terrain code.
+        """
+        code = self._codes_by_type.get(terrain_type)
+        if code is None:
+            if len(self.terrain_types) > 255:
+                raise ValueError("Too many terrain types for one-byte codes")
+            code = len(self.terrain_types)
+            self.terrain_types.append(terrain_type)
+            self._codes_by_type[terrain_type] = code
+        return code
+
+    def append(self, x: int, y: int, code: int, tile_id: int = 0) -> None:
+        """
+        @brief Appends a tile.
+
+        @param x The tile's x coordinate.
+        @param y The tile's y coordinate.
+        @param code The tile's terrain code.
+        @param tile_id The tile's ID, if the store keeps IDs.
+        """
+        self.xs.append(x)
+        self.ys.append(y)
+        self.codes.append(code)
+        if self.ids is not None:
+            self.ids.append(tile_id)
+
+    def take(self, positions: Iterable[int]) -> "TileArrays":
+        """
+        @brief Returns the tiles at the given positions, in that order.
+
+        @param positions Indexes of tiles; the same one may appear more than once.
+        @return A new TileArrays sharing this one's code table.
+        """
+        positions = list(positions)
+        store = TileArrays(self.terrain_types, with_ids=self.ids is not None)
+        store.xs = array("i", map(self.xs.__getitem__, positions))
+        store.ys = array("i", map(self.ys.__getitem__, positions))
+        store.codes = bytearray(map(self.codes.__getitem__, positions))
+        if self.ids is not None:
+            store.ids = array("i", map(self.ids.__getitem__, positions))
+        return store
+
+    def fill_packed(self, packed, start: int = 0, stop: Optional[int] = None) -> None:
+        """
+        @brief Writes the tiles, or a range of them, into a PackedTiles message.
+
+        @param packed An empty PackedTiles message.
+        @param start The index of the first tile to write.
+        @param stop The index after the last tile to write, or None for the end.
+        """
+        if start == 0 and stop is None:
+            packed.x.extend(self.xs)
+            packed.y.extend(self.ys)
+            packed.terrain_codes = bytes(self.codes)
+        else:
+            packed.x.extend(self.xs[start:stop])
+            packed.y.extend(self.ys[start:stop])
+            packed.terrain_codes = bytes(self.codes[start:stop])
+        packed.terrain_types.extend(self.terrain_types)
+        if self.ids is not None and hasattr(packed, "ids"):
+            packed.ids.extend(self.ids[start:stop])
+
+    def add_to(self, repeated_tiles) -> None:
+        """
+        @brief Appends the tiles as messages to a repeated TerrainTile field.
+
+        @param repeated_tiles The repeated field, e.g. response.tiles.
+        """
+        terrain_types = self.terrain_types
+        add = repeated_tiles.add
+        if self.ids is None:
+            for x, y, code in zip(self.xs, self.ys, self.codes):
+                add(x=x, y=y, terrain_type=terrain_types[code])
+        else:
+            for x, y, code, tile_id in zip(self.xs, self.ys, self.codes, self.ids):
+                add(id=tile_id, x=x, y=y, terrain_type=terrain_types[code])
+
+    @property
+    def nbytes(self) -> int:
+        """
+        @brief The approximate memory held by the tile columns, in bytes.
+        """
+        size = (
+            self.xs.itemsize * len(self.xs)
+            + self.ys.itemsize * len(self.ys)
+            + len(self.codes)
+        )
+        if self.ids is not None:
+            size += self.ids.itemsize * len(self.ids)
+        return size + sum(len(name) for name in self.terrain_types)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __iter__(self) -> Iterator[Tile]:
+        terrain_types = self.terrain_types
+        ids = self.ids if self.ids is not None else (0 for _ in self.codes)
+        for x, y, code, tile_id in zip(self.xs, self.ys, self.codes, ids):
+            yield Tile(x, y, terrain_types[code], tile_id)
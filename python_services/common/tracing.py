@@ -0,0 +1,437 @@
+# tracing.py
+
+import contextvars
+import json
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from typing import NamedTuple, Optional
+
+from common.config import env_float, env_int, env_str
+from common.logging_config import setup_logger
+
+logger = setup_logger("Tracing")
+
+# Where sampled spans are exported, as OTLP/JSON: a file receiving one
+# ExportTraceServiceRequest per line, and an OTLP/HTTP traces endpoint such as
+# http://localhost:4318/v1/traces. Tracing records nothing unless one is set.
+TRACE_FILE = env_str("VIE_TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT = env_str("VIE_TRACE_OTLP_ENDPOINT", "")
+
+# Fraction of traces started by this process that are recorded; traces continued from
+# a caller follow the caller's decision
+TRACE_SAMPLE_RATIO = env_float("VIE_TRACE_SAMPLE_RATIO", 0.01)
+
+# Bound on spans waiting for export; spans beyond it are dropped, not waited for
+TRACE_QUEUE_SIZE = env_int("VIE_TRACE_QUEUE_SIZE", 4096)
+TRACE_EXPORT_BATCH_SIZE = 512
+TRACE_EXPORT_INTERVAL = 1.0
+
+# gRPC metadata key of the W3C trace context
+TRACEPARENT = "traceparent"
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+# OTLP status code of failed spans
+_STATUS_ERROR = 2
+
+_TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanContext(NamedTuple):
+    """
+    @brief The identity of a span, as propagated between services.
+    """
+
+    trace_id: int
+    span_id: int
+    sampled: bool
+
+    def traceparent(self) -> str:
+        """
+        @brief Returns the W3C traceparent header value of the span.
+        """
+        flags = "01" if self.sampled else "00"
+        return f"00-{self.trace_id:032x}-{self.span_id:016x}-{flags}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """
+    @brief Parses a W3C traceparent header value.
+
+    @param value The header value, or None.
+    @return The SpanContext, or None if the value is missing or invalid.
+    """
+    match = _TRACEPARENT_PATTERN.match(value.strip().lower()) if value else None
+    if match is None:
+        return None
+    trace_id, span_id = int(match.group(1), 16), int(match.group(2), 16)
+    if not trace_id or not span_id:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(match.group(3), 16) & 1))
+
+
+class Span:
+    """
+    @brief A recorded, timed operation of a trace.
+
+    Used as a context manager, the span is the current span inside the with block and
+    ends when the block exits; an exception leaving the block marks it failed.
+    """
+
+    recording = True
+
+    def __init__(self, tracer, name, context, parent_id, kind, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or ())
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def set_error(self, description: str) -> None:
+        """
+        @brief Marks the span failed.
+        """
+        self.error = description
+
+    def end(self) -> None:
+        """
+        @brief Ends the span and hands it to the exporter; later calls do nothing.
+        """
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer.exporter.export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _reset_current_span(self._token)
+        if exc is not None and self.error is None:
+            self.set_error(f"{exc_type.__name__}: {exc}")
+        self.end()
+        return False
+
+
+class NonRecordingSpan:
+    """
+    @brief A span that records nothing: a trace that was not sampled, or no trace.
+
+    A non-recording span with a context is still made current, so calls made inside it
+    propagate the trace and its decision not to sample.
+    """
+
+    recording = False
+
+    def __init__(self, context: Optional[SpanContext] = None):
+        self.context = context
+        self._token = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, description):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        if self.context is not None:
+            self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self._token is not None:
+            _reset_current_span(self._token)
+        return False
+
+
+NOOP_SPAN = NonRecordingSpan()
+
+
+def _reset_current_span(token):
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # A response stream abandoned by its client is closed by the garbage collector,
+        # outside the context its span was entered in, which no longer needs resetting
+        pass
+
+
+def current_span():
+    """
+    @brief Returns the current span, or NOOP_SPAN outside any trace.
+    """
+    return _current_span.get() or NOOP_SPAN
+
+
+def outgoing_metadata() -> tuple:
+    """
+    @brief Returns the gRPC metadata propagating the current trace to a called service.
+
+    @return A tuple of (key, value) pairs, empty outside any trace.
+    """
+    span = _current_span.get()
+    if span is None:
+        return ()
+    return ((TRACEPARENT, span.context.traceparent()),)
+
+
+class Tracer:
+    """
+    @brief Starts the spans of one service.
+    """
+
+    def __init__(self, service_name: str, exporter=None, sample_ratio=None):
+        """
+        @brief Creates a tracer.
+
+        @param service_name The service name the spans are exported under.
+        @param exporter The SpanExporter, or None for the process's, from
+               default_exporter(); without an exporter nothing is recorded.
+        @param sample_ratio The fraction of new traces to record, or None for
+               TRACE_SAMPLE_RATIO.
+        """
+        self.service_name = service_name
+        self.exporter = exporter if exporter is not None else default_exporter()
+        self.sample_ratio = TRACE_SAMPLE_RATIO if sample_ratio is None else sample_ratio
+
+    def server_span(self, name: str, traceparent=None, attributes=None):
+        """
+        @brief Starts the span of a request handled by the service.
+
+        The span continues the caller's trace if the request carried one, following
+        its sampling decision, and otherwise starts a trace sampled at sample_ratio.
+
+        @param name The span name.
+        @param traceparent The traceparent the request carried, or None.
+        @param attributes The initial span attributes.
+        @return A Span, or a NonRecordingSpan if the trace is not recorded.
+        """
+        parent = parse_traceparent(traceparent)
+        if self.exporter is None:
+            return NonRecordingSpan(parent) if parent is not None else NOOP_SPAN
+        if parent is not None:
+            trace_id, sampled = parent.trace_id, parent.sampled
+        else:
+            trace_id = random.getrandbits(128) or 1
+            sampled = random.random() < self.sample_ratio
+        context = SpanContext(trace_id, random.getrandbits(64) or 1, sampled)
+        if not sampled:
+            return NonRecordingSpan(context)
+        parent_id = parent.span_id if parent is not None else 0
+        return Span(self, name, context, parent_id, SERVER, attributes)
+
+    def span(self, name: str, attributes=None, kind: int = INTERNAL):
+        """
+        @brief Starts a child of the current span.
+
+        Outside a recorded trace this returns NOOP_SPAN, so instrumented code costs
+        next to nothing when it is not sampled.
+
+        @param name The span name.
+        @param attributes The initial span attributes.
+        @param kind The span kind, INTERNAL or CLIENT for a call to another service.
+        @return A Span, or NOOP_SPAN.
+        """
+        parent = _current_span.get()
+        if parent is None or not parent.recording:
+            return NOOP_SPAN
+        context = SpanContext(
+            parent.context.trace_id, random.getrandbits(64) or 1, True
+        )
+        return Span(self, name, context, parent.context.span_id, kind, attributes)
+
+
+class SpanExporter:
+    """
+    @brief Exports ended spans as OTLP/JSON from a background thread.
+
+    Spans are queued without blocking and written in batches, to a file with one
+    ExportTraceServiceRequest per line (the OpenTelemetry Collector's otlpjsonfile
+    format) and/or posted to an OTLP/HTTP endpoint. Spans arriving while the queue is
+    full are dropped and counted.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        queue_size: int = TRACE_QUEUE_SIZE,
+        batch_size: int = TRACE_EXPORT_BATCH_SIZE,
+        interval: float = TRACE_EXPORT_INTERVAL,
+    ):
+        """
+        @brief Creates an exporter and starts its thread.
+
+        @param path The JSON lines file to append to, or None.
+        @param endpoint The OTLP/HTTP traces URL to post to, or None.
+        @param queue_size The bound on spans waiting for export.
+        @param batch_size The most spans written at once.
+        @param interval Seconds the thread waits for a batch to fill.
+        """
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="span-exporter"
+        )
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        """
+        @brief Queues an ended span for export.
+        """
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        @brief Waits until the spans queued so far are exported.
+
+        @param timeout The most seconds to wait.
+        @return Whether they were exported in time.
+        """
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch, flushes = [], []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    flushes.append(item)
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logger.error(f"Failed to export {len(batch)} spans: {e}")
+            for done in flushes:
+                done.set()
+
+    def _write(self, spans):
+        payload = json.dumps(to_otlp_json(spans), separators=(",", ":"))
+        if self.path:
+            with self._file_lock, open(self.path, "a") as file:
+                file.write(payload + "\n")
+        if self.endpoint:
+            request = urllib.request.Request(
+                self.endpoint,
+                data=payload.encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+
+
+def to_otlp_json(spans) -> dict:
+    """
+    @brief Encodes spans as an OTLP/JSON ExportTraceServiceRequest.
+
+    @param spans Ended Spans, of any services.
+    @return The request as a JSON-serializable dict.
+    """
+    by_service = {}
+    for span in spans:
+        by_service.setdefault(span.tracer.service_name, []).append(_span_json(span))
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [_attribute_json("service.name", service_name)]
+                },
+                "scopeSpans": [{"scope": {"name": "vie"}, "spans": encoded}],
+            }
+            for service_name, encoded in by_service.items()
+        ]
+    }
+
+
+def _span_json(span):
+    encoded = {
+        "traceId": f"{span.context.trace_id:032x}",
+        "spanId": f"{span.context.span_id:016x}",
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [
+            _attribute_json(key, value) for key, value in span.attributes.items()
+        ],
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = f"{span.parent_id:016x}"
+    if span.error is not None:
+        encoded["status"] = {"code": _STATUS_ERROR, "message": span.error}
+    return encoded
+
+
+def _attribute_json(key, value):
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+_default_exporter = None
+_default_exporter_lock = threading.Lock()
+
+
+def default_exporter() -> Optional[SpanExporter]:
+    """
+    @brief Returns the process's exporter to TRACE_FILE and TRACE_OTLP_ENDPOINT,
+    starting it on first use.
+
+    @return The SpanExporter, or None if neither is set.
+    """
+    global _default_exporter
+    if not TRACE_FILE and not TRACE_OTLP_ENDPOINT:
+        return None
+    with _default_exporter_lock:
+        if _default_exporter is None:
+            _default_exporter = SpanExporter(
+                TRACE_FILE or None, TRACE_OTLP_ENDPOINT or None
+            )
+        return _default_exporter
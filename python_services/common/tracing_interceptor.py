@@ -0,0 +1,78 @@
+# tracing_interceptor.py
+
+import grpc
+
+from common.interceptors import HandlerCache, split_method, status_code, wrap_handler
+from common.tracing import TRACEPARENT
+
+
+class TracingInterceptor(grpc.ServerInterceptor):
+    """
+    @brief Starts a server span around every call of a grpc.server, continuing the
+    trace of the caller's traceparent metadata, and makes it the current span of the
+    handler.
+    """
+
+    def __init__(self, tracer):
+        """
+        @brief Creates the interceptor.
+
+        @param tracer The service's Tracer.
+        """
+        self._handlers = HandlerCache(
+            lambda handler, method: _trace(tracer, handler, method)
+        )
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._handlers.get(
+            continuation(handler_call_details), handler_call_details.method
+        )
+
+
+class AsyncTracingInterceptor(grpc.aio.ServerInterceptor):
+    """
+    @brief The TracingInterceptor of a grpc.aio.server.
+    """
+
+    def __init__(self, tracer):
+        """
+        @brief Creates the interceptor.
+
+        @param tracer The service's Tracer.
+        """
+        self._handlers = HandlerCache(
+            lambda handler, method: _trace(tracer, handler, method)
+        )
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._handlers.get(
+            await continuation(handler_call_details), handler_call_details.method
+        )
+
+
+def _trace(tracer, handler, method):
+    """
+    @brief Returns a handler running each call of an RPC method in a server span.
+    """
+    service, name = split_method(method)
+    span_name = f"{service}/{name}"
+    attributes = {"rpc.system": "grpc", "rpc.service": service, "rpc.method": name}
+
+    def start(context):
+        traceparent = None
+        for key, value in context.invocation_metadata() or ():
+            if key == TRACEPARENT:
+                traceparent = value
+                break
+        span = tracer.server_span(span_name, traceparent, attributes)
+        span.__enter__()
+        return span
+
+    def finish(span, context, error):
+        code = status_code(context, error)
+        span.set_attribute("rpc.grpc.status_code", code.value[0])
+        if code is not grpc.StatusCode.OK:
+            span.set_error(code.name)
+        span.__exit__(None, None, None)
+
+    return wrap_handler(handler, start, finish)
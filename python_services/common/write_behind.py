@@ -0,0 +1,164 @@
+# write_behind.py
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+from common.logging_config import setup_logger
+
+logger = setup_logger("WriteBehindQueue")
+
+PENDING = "pending"
+DURABLE = "durable"
+FAILED = "failed"
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    @brief Bounded queue of writes applied in batches by a background thread.
+
+    Producers submit items under a key and return at once; a writer thread takes up to
+    batch_size queued items at a time and hands them to write_batch, retrying failed
+    batches with exponential backoff. A batch that still fails is retried item by item,
+    so one bad item does not fail the others. When max_pending items are waiting,
+    submit blocks, pushing back on producers instead of growing without bound.
+
+    The status of each key (PENDING, DURABLE or FAILED) is kept for the most recent
+    max_statuses keys.
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[List[Any]], None],
+        max_pending: int,
+        batch_size: int,
+        max_attempts: int,
+        retry_delay: float,
+        max_statuses: int = 10_000,
+    ):
+        """
+        @brief Creates the queue and starts its writer thread.
+
+        @param write_batch Writes a list of items, raising if any of them is not written.
+        @param max_pending The maximum number of items waiting to be written.
+        @param batch_size The maximum number of items per write_batch call.
+        @param max_attempts The number of times a batch is tried before giving up.
+        @param retry_delay The delay before the first retry in seconds, doubled per retry.
+        @param max_statuses The number of keys whose status is remembered.
+        """
+        if batch_size < 1 or max_attempts < 1:
+            raise ValueError("batch_size and max_attempts must be at least 1")
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_statuses = max_statuses
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="write-behind"
+        )
+        self._thread.start()
+
+    def submit(self, key: Hashable, item: Any, timeout: Optional[float] = None) -> None:
+        """
+        @brief Queues an item for writing.
+
+        @param key The key the item's status is reported under.
+        @param item The item, passed to write_batch.
+        @param timeout Seconds to wait for room in the queue, or None to wait forever.
+
+        @exception queue.Full If the queue stays full for timeout seconds.
+        """
+        self._set_status(key, PENDING)
+        try:
+            self._queue.put((key, item), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._statuses.pop(key, None)
+            raise
+
+    def status(self, key: Hashable) -> Optional[Tuple[str, str]]:
+        """
+        @brief Returns the status of a key.
+
+        @param key The key the item was submitted under.
+        @return A (status, error) pair, or None if the key is not known.
+        """
+        with self._lock:
+            return self._statuses.get(key)
+
+    def flush(self) -> None:
+        """
+        @brief Waits until every item submitted so far is written or has failed.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        @brief Writes the queued items, then stops the writer thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put((_STOP, None))
+            self._thread.join()
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def _set_status(self, key, status, error=""):
+        with self._lock:
+            self._statuses[key] = (status, error)
+            self._statuses.move_to_end(key)
+            while len(self._statuses) > self.max_statuses:
+                self._statuses.popitem(last=False)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1][0] is not _STOP:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1][0] is _STOP
+            entries = batch[:-1] if stop else batch
+            try:
+                if entries:
+                    self._write(entries)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, entries):
+        """
+        @brief Writes a batch with retries, falling back to one item at a time.
+        """
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.write_batch([item for _, item in entries])
+            except Exception as e:
+                error = e
+                logger.warning(
+                    f"Write of {len(entries)} items failed (attempt {attempt + 1}): {e}"
+                )
+                continue
+            for key, _ in entries:
+                self._set_status(key, DURABLE)
+            return
+        if len(entries) > 1:
+            for entry in entries:
+                self._write([entry])
+            return
+        key = entries[0][0]
+        logger.error(f"Giving up writing {key}: {error}")
+        self._set_status(key, FAILED, str(error))
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import threading
 import time
@@ -7,14 +8,24 @@ import grpc
 import socket
 import os
 from concurrent import futures
-from sqlalchemy import create_engine, Column, Integer, String, Sequence
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, Session
 import persistence.persistence_pb2 as persistence_pb2
 import persistence.persistence_pb2_grpc as persistence_pb2_grpc
 from grpc_reflection.v1alpha import reflection
-from common.logging_config import setup_logger
+from common.logging_config import configure_logging, setup_logger
+from common.config import env_float, env_int, env_str
+from common.lru_cache import LRUCache
+from common.tile_arrays import TileArrays
+from persistence.schema_migrations import migrate
+from persistence.storage import TerrainExistsError, TileNotFoundError, create_store
+from common.channel_pool import server_options
+from common.metrics import counter, gauge, start_metrics_server
+from common.metrics_interceptor import AsyncMetricsInterceptor, MetricsInterceptor
+from common.tracing import Tracer
+from common.tracing_interceptor import AsyncTracingInterceptor, TracingInterceptor
+from common.async_server import ASYNC_EXECUTOR_WORKERS, MAX_CONCURRENT_RPCS, offloaded, offloaded_client_stream, offloaded_stream, use_asyncio
 import json
-from collections import defaultdict
 import ssl
 from pathlib import Path
 
@@ -22,9 +33,13 @@ from pathlib import Path
 logger = setup_logger("PersistenceService")
 
 # SQLAlchemy setup
-Base = declarative_base()
-engine = create_engine('sqlite:///persistence_service.db')
-DbSession = sessionmaker(bind=engine)
+DATABASE_URL = env_str('VIE_DATABASE_URL', 'sqlite:///persistence_service.db')
+
+# "relational" stores a row per tile, "blob" compressed chunks of packed tiles (see storage.py)
+STORAGE_BACKEND = env_str('VIE_STORAGE_BACKEND', 'relational')
+
+# Tiles per streamed chunk when a RetrieveTerrainStream request does not choose a chunk size
+DEFAULT_RETRIEVE_CHUNK_SIZE = 1000
 
 # Define the path to the certificates
 project_root = Path(__file__).parent.parent.parent  # Navigate up to the project root
@@ -43,130 +58,765 @@ server_credentials = grpc.ssl_server_credentials(
     require_client_auth=False
 )
 
-class TerrainTile(Base):
-    __tablename__ = 'terrain_tiles'
-    id = Column(Integer, Sequence('tile_id_seq'), primary_key=True)
-    x = Column(Integer)
-    y = Column(Integer)
-    terrain_type = Column(String(50))
-    terrain_id = Column(String(50))
+# Bounds of the cache of serialized RetrieveTerrain responses
+RESPONSE_CACHE_MAX_ENTRIES = env_int('VIE_RESPONSE_CACHE_MAX_ENTRIES', 1024)
+RESPONSE_CACHE_MAX_BYTES = env_int('VIE_RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+# Seconds a transaction may go unused before the reaper rolls it back; 0 disables the reaper
+TRANSACTION_IDLE_TIMEOUT = env_float('VIE_TRANSACTION_IDLE_TIMEOUT', 300.0)
+
+# Bound on open transactions; BeginTransaction fails with RESOURCE_EXHAUSTED beyond it
+MAX_OPEN_TRANSACTIONS = env_int('VIE_MAX_OPEN_TRANSACTIONS', 1024)
+
+# Port of the local Prometheus metrics endpoint, 0 to disable it, and its address
+METRICS_PORT = env_int('VIE_PERSISTENCE_METRICS_PORT', 9102)
+METRICS_ADDRESS = env_str('VIE_METRICS_ADDRESS', '127.0.0.1')
+
+TILES_STORED = counter('vie_tiles_stored_total',
+                       'Tiles written, including those of transactions later rolled back.')
+TRANSACTIONS_OPEN = gauge('vie_transaction_sessions_open', 'Transactions begun and not yet committed or rolled back.')
 
-Base.metadata.create_all(engine)
+TRACER = Tracer('persistence')
+
+class _Transaction:
+    """
+    @brief An open transaction: its session, the lock serializing its RPCs, and the
+    terrains it has written.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+        self.terrains = set()
+        self.last_used = time.monotonic()
+        self.closed = False  # Set under the lock once committed or rolled back
+
+def _stored_tile_ids(terrain_id, stored, tiles):
+    """
+    @brief Returns the IDs a stored terrain holds for the tiles of a retried store.
+
+    @param terrain_id The ID of the terrain.
+    @param stored The terrain's tile IDs by coordinate.
+    @param tiles The TileArrays of the retried request; tiles with an ID keep it.
+
+    @return The tile IDs, in the order of the tiles.
+
+    @exception TerrainExistsError If the terrain holds no tile at the coordinate of a new tile.
+    """
+    tile_ids = []
+    for tile in tiles:
+        if tile.id:
+            tile_ids.append(tile.id)
+            continue
+        tile_id = stored.get((tile.x, tile.y))
+        if tile_id is None:
+            raise TerrainExistsError(terrain_id, tile.x, tile.y)
+        tile_ids.append(tile_id)
+    return tile_ids
 
 class PersistenceService(persistence_pb2_grpc.PersistenceServiceServicer):
     """
     @brief Service for persisting data.
     """
 
-    def __init__(self):
+    def __init__(self, database_url=None, cache_max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 cache_max_bytes=RESPONSE_CACHE_MAX_BYTES, storage_backend=None,
+                 transaction_idle_timeout=TRANSACTION_IDLE_TIMEOUT, max_open_transactions=MAX_OPEN_TRANSACTIONS):
         """
-        @brief Initializes the PersistenceService.
+        @brief Initializes the PersistenceService, migrating the database schema.
+
+        @param database_url The SQLAlchemy URL of the database, or None for DATABASE_URL.
+        @param cache_max_entries The maximum number of RetrieveTerrain responses to cache.
+        @param cache_max_bytes The maximum total size of the cached responses in bytes.
+        @param storage_backend The name of the storage backend, or None for STORAGE_BACKEND.
+        @param transaction_idle_timeout Seconds before an unused transaction is rolled back, or 0 for never.
+        @param max_open_transactions The maximum number of transactions open at once.
         """
-        self.engine = create_engine('sqlite:///persistence_service.db')
+        self.store = create_store(storage_backend or STORAGE_BACKEND)
+        self.engine = create_engine(database_url or DATABASE_URL)
+        migrate(self.engine)
         self.DbSession = sessionmaker(bind=self.engine)
         logger.info("PersistenceService initialized.")
-        self.lock = threading.Lock()
-        self.sessions = defaultdict(lambda: self.DbSession())
-        self.transaction_locks = defaultdict(threading.Lock)
+        # Open transactions by ID; entries leave on commit, rollback or reaping
+        self.transactions = {}
+        self.transactions_lock = threading.Lock()
+        self.max_open_transactions = max_open_transactions
+        self.transaction_idle_timeout = transaction_idle_timeout
+        # Serialized RetrieveTerrainResponse payloads keyed by (terrain_id, packed)
+        self.response_cache = LRUCache(cache_max_entries, cache_max_bytes)
+        self.cache_lock = threading.Lock()
+        self.cache_generation = 0  # Incremented on every invalidation
+        self._reaper_stop = threading.Event()
+        if transaction_idle_timeout > 0:
+            threading.Thread(target=self._reap_idle_transactions_periodically, daemon=True,
+                             name='transaction-reaper').start()
 
     def BeginTransaction(self, request, context):
         transaction_id = str(uuid.uuid4())
-        self.sessions[transaction_id]  # Initialize session
+        with self.transactions_lock:
+            if len(self.transactions) >= self.max_open_transactions:
+                context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                context.set_details("Too many open transactions.")
+                return persistence_pb2.BeginTransactionResponse()
+            self.transactions[transaction_id] = _Transaction(self.DbSession())
+        TRANSACTIONS_OPEN.inc()
         logger.info(f"Transaction {transaction_id} started.")
         return persistence_pb2.BeginTransactionResponse(transaction_id=transaction_id)
 
     def CommitTransaction(self, request, context):
         transaction_id = request.transaction_id
-        with self.transaction_locks[transaction_id]:
-            session = self.sessions.pop(transaction_id, None)
-            if session:
-                session.commit()
-                session.close()
-                logger.info(f"Transaction {transaction_id} committed.")
-            else:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details("Transaction not found.")
+        with self.transactions_lock:
+            transaction = self.transactions.pop(transaction_id, None)
+        if transaction is None:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("Transaction not found.")
+            return persistence_pb2.CommitTransactionResponse()
+        TRANSACTIONS_OPEN.dec()
+        with transaction.lock:
+            transaction.closed = True
+            try:
+                with TRACER.span('commit'):
+                    transaction.session.commit()
+            except Exception as e:
+                logger.error(f"Failed to commit transaction {transaction_id}: {e}")
+                transaction.session.rollback()
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details("Failed to commit transaction.")
+                return persistence_pb2.CommitTransactionResponse()
+            finally:
+                transaction.session.close()
+        self._invalidate_terrains(transaction.terrains)
+        logger.info(f"Transaction {transaction_id} committed.")
         return persistence_pb2.CommitTransactionResponse()
 
     def RollbackTransaction(self, request, context):
         transaction_id = request.transaction_id
-        with self.transaction_locks[transaction_id]:
-            session = self.sessions.pop(transaction_id, None)
-            if session:
-                session.rollback()
-                session.close()
-                logger.info(f"Transaction {transaction_id} rolled back.")
-            else:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details("Transaction not found.")
+        with self.transactions_lock:
+            transaction = self.transactions.pop(transaction_id, None)
+        if transaction is None:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("Transaction not found.")
+            return persistence_pb2.RollbackTransactionResponse()
+        TRANSACTIONS_OPEN.dec()
+        # Nothing written in the transaction was visible to other sessions, so no
+        # cached response has to be invalidated
+        self._close_transaction(transaction, transaction_id)
+        logger.info(f"Transaction {transaction_id} rolled back.")
         return persistence_pb2.RollbackTransactionResponse()
 
+    def _close_transaction(self, transaction, transaction_id):
+        """
+        @brief Rolls back and closes a transaction already removed from self.transactions.
+
+        @param transaction The _Transaction.
+        @param transaction_id Its ID, for logging.
+        """
+        with transaction.lock:
+            transaction.closed = True
+            try:
+                transaction.session.rollback()
+            except Exception as e:
+                logger.error(f"Failed to roll back transaction {transaction_id}: {e}")
+            finally:
+                transaction.session.close()
+
+    def reap_idle_transactions(self, now=None):
+        """
+        @brief Rolls back the transactions unused for longer than the idle timeout.
+
+        Transactions with an RPC in progress are never reaped.
+
+        @param now The monotonic time to measure idleness against, or None for the current time.
+
+        @return The number of transactions rolled back.
+        """
+        deadline = (time.monotonic() if now is None else now) - self.transaction_idle_timeout
+        with self.transactions_lock:
+            idle = [(transaction_id, transaction) for transaction_id, transaction in self.transactions.items()
+                    if transaction.last_used < deadline and not transaction.lock.locked()]
+            for transaction_id, _ in idle:
+                del self.transactions[transaction_id]
+        TRANSACTIONS_OPEN.dec(len(idle))
+        for transaction_id, transaction in idle:
+            self._close_transaction(transaction, transaction_id)
+            logger.warning(f"Transaction {transaction_id} rolled back after being idle.")
+        return len(idle)
+
+    def _reap_idle_transactions_periodically(self):
+        while not self._reaper_stop.wait(self.transaction_idle_timeout / 2):
+            try:
+                self.reap_idle_transactions()
+            except Exception as e:
+                logger.error(f"Failed to reap idle transactions: {e}")
+
+    def close(self):
+        """
+        @brief Stops the transaction reaper and rolls back the open transactions.
+        """
+        self._reaper_stop.set()
+        with self.transactions_lock:
+            transactions = list(self.transactions.items())
+            self.transactions.clear()
+        TRANSACTIONS_OPEN.dec(len(transactions))
+        for transaction_id, transaction in transactions:
+            self._close_transaction(transaction, transaction_id)
+
     def StoreTerrain(self, request, context):
         """
         @brief Stores terrain data in the database.
 
+        A request with a transaction ID writes through that transaction's session and is
+        committed by CommitTransaction; any other request is committed on its own.
+
         @param request The request containing terrain tiles to store.
         @param context The gRPC context.
 
         @return A response indicating success or failure.
         """
+        # New tiles stored in a transaction join the terrain with the transaction's ID
+        terrain_id = request.transaction_id or str(uuid.uuid4())
+
+        def write(session):
+            tile_ids, changed_terrains = self.store.store(session, terrain_id, request.tiles)
+            TILES_STORED.inc(len(tile_ids))
+            return persistence_pb2.StoreTerrainResponse(
+                terrain_id=terrain_id, tile_ids=tile_ids, success=True), changed_terrains
+
+        failure_response = persistence_pb2.StoreTerrainResponse(success=False)
+        if request.transaction_id:
+            return self._store_in_transaction(request.transaction_id, write, context, failure_response)
+        return self._store_and_commit(write, context, failure_response)
+
+    def UpdateTiles(self, request, context):
+        """
+        @brief Changes the terrain type of tiles of a terrain, addressed by coordinate.
+
+        Like StoreTerrain, a request with a transaction ID writes through that
+        transaction's session and any other request is committed on its own.
+
+        @param request The UpdateTilesRequest with the terrain ID and the changes.
+        @param context The gRPC context.
+
+        @return An UpdateTilesResponse with the terrain's new version.
+        """
+        def write(session):
+            version = self.store.update_tiles(session, request.terrain_id, request.changes)
+            changed_terrains = {request.terrain_id} if request.changes else set()
+            return persistence_pb2.UpdateTilesResponse(version=version, success=True), changed_terrains
+
+        failure_response = persistence_pb2.UpdateTilesResponse(success=False)
+        if request.transaction_id:
+            return self._store_in_transaction(request.transaction_id, write, context, failure_response)
+        return self._store_and_commit(write, context, failure_response)
+
+    def StoreTerrainAtomic(self, request, context):
+        """
+        @brief Stores a terrain and commits it in one call.
+
+        Equivalent to BeginTransaction, StoreTerrain and CommitTransaction, but in a single
+        round trip and with the tiles in the columnar PackedTiles encoding. New tiles go
+        to the storage backend straight from their columns.
+
+        @param request The StoreTerrainAtomicRequest.
+        @param context The gRPC context.
+
+        @return A StoreTerrainResponse, with tile IDs if the request asked for them.
+        """
+        try:
+            with TRACER.span('decode_tiles'):
+                tiles = TileArrays.from_packed(request.packed_tiles)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return persistence_pb2.StoreTerrainResponse(success=False)
+        return self._store_and_commit(lambda session: self._store_packed(session, request, tiles), context,
+                                      persistence_pb2.StoreTerrainResponse(success=False))
+
+    def StoreTerrainBatch(self, request, context):
+        """
+        @brief Stores several terrains with a single commit.
+
+        Each terrain is stored as by StoreTerrainAtomic, but all in one transaction: if
+        any of them fails, none is stored.
+
+        @param request The StoreTerrainBatchRequest.
+        @param context The gRPC context.
+
+        @return A StoreTerrainBatchResponse with a StoreTerrainResponse per terrain.
+        """
+        try:
+            with TRACER.span('decode_tiles', {'terrains': len(request.terrains)}):
+                terrains = [(terrain, TileArrays.from_packed(terrain.packed_tiles)) for terrain in request.terrains]
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return persistence_pb2.StoreTerrainBatchResponse()
+
+        def write(session):
+            response = persistence_pb2.StoreTerrainBatchResponse()
+            changed_terrains = set()
+            for terrain, tiles in terrains:
+                terrain_response, changed = self._store_packed(session, terrain, tiles)
+                response.terrains.append(terrain_response)
+                changed_terrains.update(changed)
+            return response, changed_terrains
+
+        return self._store_and_commit(write, context, persistence_pb2.StoreTerrainBatchResponse())
+
+    def _store_packed(self, session, request, tiles):
+        """
+        @brief Stores the tiles of a StoreTerrainAtomicRequest without committing.
+
+        @param session The database session.
+        @param request The StoreTerrainAtomicRequest.
+        @param tiles Its decoded packed tiles.
+
+        @return A pair of the StoreTerrainResponse and the set of changed terrain IDs.
+
+        @exception TerrainExistsError If the terrain ID is taken by a terrain without the
+                   request's tiles.
+        """
+        terrain_id = request.terrain_id or str(uuid.uuid4())
+        if request.terrain_id and self.store.exists(session, terrain_id):
+            # Stored by an earlier attempt whose response was lost
+            logger.info(f"Terrain {terrain_id} is already stored.")
+            response = persistence_pb2.StoreTerrainResponse(terrain_id=terrain_id, success=True)
+            if request.return_tile_ids:
+                stored = self._stored_tile_index(session, terrain_id)
+                response.tile_ids.extend(_stored_tile_ids(terrain_id, stored, tiles))
+            return response, set()
+        tile_ids, changed_terrains = self._write_tiles(session, terrain_id, tiles)
+        response = persistence_pb2.StoreTerrainResponse(terrain_id=terrain_id, success=True)
+        if request.return_tile_ids:
+            response.tile_ids.extend(tile_ids)
+        return response, changed_terrains
+
+    def _stored_tile_index(self, session, terrain_id):
+        """
+        @brief Returns the IDs of the tiles of a stored terrain by coordinate.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+
+        @return A dictionary mapping (x, y) to tile ID.
+        """
+        stored = self.store.load(session, terrain_id)
+        return dict(zip(zip(stored.xs, stored.ys), stored.ids))
+
+    def _write_tiles(self, session, terrain_id, tiles):
+        """
+        @brief Writes decoded packed tiles without committing.
+
+        @param session The database session.
+        @param terrain_id The terrain new tiles are added to.
+        @param tiles The TileArrays; with an ID column, tiles with an ID are updates.
+
+        @return A pair of the tile IDs in order and the set of changed terrain IDs.
+        """
+        if tiles.ids is not None:
+            # Some tiles are updates
+            tile_ids, changed_terrains = self.store.store(session, terrain_id, list(tiles))
+        elif len(tiles):
+            tile_ids, changed_terrains = self.store.store_new(session, terrain_id, tiles), {terrain_id}
+        else:
+            return [], set()
+        TILES_STORED.inc(len(tile_ids))
+        return tile_ids, changed_terrains
+
+    def StoreTerrainStream(self, request_iterator, context):
+        """
+        @brief Stores a terrain uploaded as a stream of tile batches.
+
+        Each batch is written into one transaction as it arrives, so neither side holds
+        the whole terrain and no message has to fit it; the transaction is committed
+        once the client closes the stream. The terrain ID and tile IDs are returned at
+        the end, the IDs as runs of consecutive values. A stream without chunks is
+        rejected with INVALID_ARGUMENT. A retried upload of a stored terrain writes
+        nothing and returns the IDs the terrain holds for the uploaded tiles.
+
+        @param request_iterator The StoreTerrainChunk messages.
+        @param context The gRPC context.
+
+        @return A StoreTerrainStreamResponse.
+        """
+        start_time = time.time()
+        response = persistence_pb2.StoreTerrainStreamResponse()
+        ranges = []  # [first_id, count] runs
+        changed_terrains = set()
+        terrain_id = None
+        stored = None  # Tile IDs by coordinate of an already stored terrain
         try:
             with self.DbSession() as session:
-                terrain_id = request.transaction_id or str(uuid.uuid4())
-                tile_ids = []
-                for tile in request.tiles:
-                    if tile.id:  # Check if the tile has an ID, indicating an update
-                        existing_tile = session.query(TerrainTile).filter_by(id=tile.id).first()
-                        if existing_tile:
-                            existing_tile.x = tile.x
-                            existing_tile.y = tile.y
-                            existing_tile.terrain_type = tile.terrain_type
-                            tile_ids.append(existing_tile.id)
-                        else:
-                            context.set_code(grpc.StatusCode.NOT_FOUND)
-                            context.set_details(f"Tile with ID {tile.id} not found for update")
-                            return persistence_pb2.StoreTerrainResponse(success=False)
+                for chunk in request_iterator:
+                    if terrain_id is None:
+                        terrain_id = chunk.terrain_id or str(uuid.uuid4())
+                        if chunk.terrain_id and self.store.exists(session, terrain_id):
+                            # Stored by an earlier attempt whose response was lost
+                            logger.info(f"Terrain {terrain_id} is already stored.")
+                            stored = self._stored_tile_index(session, terrain_id)
+                    with TRACER.span('decode_tiles'):
+                        tiles = TileArrays.from_packed(chunk.packed_tiles)
+                    if stored is not None:
+                        tile_ids = _stored_tile_ids(terrain_id, stored, tiles)
                     else:
-                        new_tile = TerrainTile(
-                            x=tile.x,
-                            y=tile.y,
-                            terrain_type=tile.terrain_type,
-                            terrain_id=terrain_id
-                        )
-                        session.add(new_tile)
-                        session.flush()  # Ensure the ID is generated
-                        tile_ids.append(new_tile.id)
-                session.commit()
-                logger.info("Stored terrain successfully.")
-                return persistence_pb2.StoreTerrainResponse(terrain_id=terrain_id, tile_ids=tile_ids, success=True)
+                        with TRACER.span('write', {'tiles': len(tiles)}):
+                            tile_ids, changed = self._write_tiles(session, terrain_id, tiles)
+                        changed_terrains.update(changed)
+                    response.tile_count += len(tile_ids)
+                    for tile_id in tile_ids:
+                        if ranges and ranges[-1][0] + ranges[-1][1] == tile_id:
+                            ranges[-1][1] += 1
+                        else:
+                            ranges.append([tile_id, 1])
+                if terrain_id is None:
+                    raise ValueError('Empty terrain stream')
+                with TRACER.span('commit'):
+                    session.commit()
+        except TileNotFoundError as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(str(e))
+            return persistence_pb2.StoreTerrainStreamResponse()
+        except TerrainExistsError as e:
+            context.set_code(grpc.StatusCode.ALREADY_EXISTS)
+            context.set_details(str(e))
+            return persistence_pb2.StoreTerrainStreamResponse()
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return persistence_pb2.StoreTerrainStreamResponse()
+        except Exception as e:
+            logger.error(f"Failed to store terrain stream: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Failed to store terrain')
+            return persistence_pb2.StoreTerrainStreamResponse()
+        self._invalidate_terrains(changed_terrains)
+        response.terrain_id = terrain_id
+        for first_id, count in ranges:
+            response.tile_id_ranges.add(first_id=first_id, count=count)
+        response.success = True
+        duration = time.time() - start_time
+        logger.info(f"Stored {response.tile_count} streamed tiles of terrain {response.terrain_id} "
+                     f"in {duration:.2f} seconds")
+        return response
+
+    def _store_and_commit(self, write, context, failure_response):
+        """
+        @brief Runs a write in a session of its own and commits it.
+
+        @param write A function taking the session and returning the response and the set
+               of changed terrain IDs.
+        @param context The gRPC context.
+        @param failure_response The response to return if the write fails.
+
+        @return The response.
+        """
+        try:
+            with self.DbSession() as session:
+                with TRACER.span('write'):
+                    response, changed_terrains = write(session)
+                with TRACER.span('commit'):
+                    session.commit()
+            self._invalidate_terrains(changed_terrains)
+            logger.info("Stored terrain successfully.")
+            return response
+        except TileNotFoundError as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(str(e))
+            return failure_response
+        except TerrainExistsError as e:
+            context.set_code(grpc.StatusCode.ALREADY_EXISTS)
+            context.set_details(str(e))
+            return failure_response
         except Exception as e:
             logger.error(f"Failed to store terrain: {e}")
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Failed to store terrain')
-            return persistence_pb2.StoreTerrainResponse(success=False)
+            return failure_response
+
+    def _store_in_transaction(self, transaction_id, write, context, failure_response):
+        """
+        @brief Runs a write through the session of a transaction.
+
+        The write is not committed. An update of a missing tile writes nothing and leaves
+        the transaction open; any other failure rolls the transaction back.
+
+        @param transaction_id The ID of the transaction.
+        @param write A function taking the session and returning the response and the set
+               of changed terrain IDs.
+        @param context The gRPC context.
+        @param failure_response The response to return if the write fails.
+
+        @return The response.
+        """
+        with self.transactions_lock:
+            transaction = self.transactions.get(transaction_id)
+        if transaction is None:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("Transaction not found.")
+            return failure_response
+        with transaction.lock:
+            if transaction.closed:
+                context.set_code(grpc.StatusCode.NOT_FOUND)
+                context.set_details("Transaction not found.")
+                return failure_response
+            transaction.last_used = time.monotonic()
+            try:
+                response, changed_terrains = write(transaction.session)
+            except TileNotFoundError as e:
+                # The stores check updates before writing anything
+                context.set_code(grpc.StatusCode.NOT_FOUND)
+                context.set_details(str(e))
+                return failure_response
+            except Exception as e:
+                logger.error(f"Failed to store terrain in transaction {transaction_id}, rolling it back: {e}")
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details('Failed to store terrain')
+                abort = True
+            else:
+                abort = False
+                transaction.terrains.update(changed_terrains)
+                transaction.last_used = time.monotonic()
+        if abort:
+            with self.transactions_lock:
+                removed = self.transactions.pop(transaction_id, None)
+            if removed is not None:
+                TRANSACTIONS_OPEN.dec()
+            self._close_transaction(transaction, transaction_id)
+            return failure_response
+        logger.info(f"Stored terrain in transaction {transaction_id}.")
+        return response
+
+    def _invalidate_terrains(self, terrain_ids):
+        """
+        @brief Drops the cached responses of terrains whose tiles have changed.
+
+        @param terrain_ids The IDs of the changed terrains.
+        """
+        with self.cache_lock:
+            # Responses read before this point must not be cached after it
+            self.cache_generation += 1
+            for terrain_id in terrain_ids:
+                self.response_cache.invalidate((terrain_id, False))
+                self.response_cache.invalidate((terrain_id, True))
+
+    def GetCacheStats(self, request, context):
+        """
+        @brief Reports the counters of the RetrieveTerrain response cache.
+
+        @param request The CacheStatsRequest.
+        @param context The gRPC context.
+
+        @return A CacheStatsResponse.
+        """
+        return persistence_pb2.CacheStatsResponse(**self.response_cache.stats())
 
     def RetrieveTerrain(self, request, context):
+        """
+        @brief Retrieves the tiles of a terrain.
+
+        Each call reads through its own session, so retrievals run concurrently.
+        Responses are cached until a write to the terrain invalidates them.
+
+        @param request The request containing the terrain ID.
+        @param context The gRPC context.
+
+        @return A RetrieveTerrainResponse with all of the terrain's tiles.
+        """
         start_time = time.time()
-        with self.lock:
-            session = DbSession()
-            tiles = session.query(TerrainTile).filter_by(terrain_id=request.terrain_id).all()
-            if not tiles:
+        key = (request.terrain_id, request.packed)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            logger.info(f"Retrieved terrain with ID {request.terrain_id} from the cache")
+            return persistence_pb2.RetrieveTerrainResponse.FromString(cached)
+
+        generation = self.cache_generation
+        with TRACER.span('load_tiles'), self.DbSession() as session:
+            tiles = self.store.load(session, request.terrain_id)
+            version = self.store.version(session, request.terrain_id)
+        if not len(tiles):
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details('Terrain not found')
+            logger.error(f"Terrain with ID {request.terrain_id} not found")
+            return persistence_pb2.RetrieveTerrainResponse()
+        response = self._build_retrieve_response(tiles, request.packed, version)
+        payload = response.SerializeToString()
+        with self.cache_lock:
+            # Skip caching if the terrain may have changed while it was being read
+            if generation == self.cache_generation:
+                self.response_cache.put(key, payload, len(payload))
+        logger.info(f"Retrieved terrain with ID: {request.terrain_id}")
+        duration = time.time() - start_time
+        logger.info(f"RetrieveTerrain invocation duration: {duration:.2f} seconds")
+        return response
+
+    def RetrieveTerrainStream(self, request, context):
+        """
+        @brief Retrieves the tiles of a terrain as a stream of chunks.
+
+        Tiles are fetched from the storage backend chunk_size at a time, so only about
+        one chunk of a terrain is held in memory however large the terrain is.
+
+        @param request The request containing the terrain ID and the chunk size.
+        @param context The gRPC context.
+
+        @return An iterator of RetrieveTerrainResponse messages of at most chunk_size tiles.
+        """
+        start_time = time.time()
+        chunk_size = request.chunk_size or DEFAULT_RETRIEVE_CHUNK_SIZE
+        if chunk_size < 1:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('chunk_size must be greater than 0')
+            return
+        count = 0
+        with self.DbSession() as session:
+            version = self.store.version(session, request.terrain_id)
+            for tiles in self.store.iter_chunks(session, request.terrain_id, chunk_size):
+                count += len(tiles)
+                yield self._build_retrieve_response(tiles, request.packed, version)
+        if not count:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details('Terrain not found')
+            logger.error(f"Terrain with ID {request.terrain_id} not found")
+            return
+        logger.info(f"Streamed {count} tiles of terrain with ID: {request.terrain_id}")
+        duration = time.time() - start_time
+        logger.info(f"RetrieveTerrainStream invocation duration: {duration:.2f} seconds")
+
+    def RetrieveTerrainRegion(self, request, context):
+        """
+        @brief Retrieves the tiles of a terrain inside a box of coordinates or a hex range.
+
+        Only the tiles in the region are read from the storage backend, so the cost of a
+        call follows the size of the region rather than the size of the terrain.
+
+        @param request The request containing the terrain ID and the region.
+        @param context The gRPC context.
+
+        @return A RetrieveTerrainResponse with the tiles in the region, possibly none.
+        """
+        start_time = time.time()
+        if request.HasField('hex_range'):
+            hex_range = request.hex_range
+            if hex_range.radius < 0:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                context.set_details('radius must not be negative')
+                return persistence_pb2.RetrieveTerrainResponse()
+            bounds = (hex_range.center_x - hex_range.radius, hex_range.center_x + hex_range.radius,
+                      hex_range.center_y - hex_range.radius, hex_range.center_y + hex_range.radius)
+        else:
+            bounds = (request.min_x, request.max_x, request.min_y, request.max_y)
+            if request.min_x > request.max_x or request.min_y > request.max_y:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                context.set_details('Region minimum exceeds its maximum')
+                return persistence_pb2.RetrieveTerrainResponse()
+
+        with self.DbSession() as session:
+            tiles = self.store.load_region(session, request.terrain_id, *bounds)
+            version = self.store.version(session, request.terrain_id)
+            if not len(tiles) and not self.store.exists(session, request.terrain_id):
                 context.set_code(grpc.StatusCode.NOT_FOUND)
                 context.set_details('Terrain not found')
                 logger.error(f"Terrain with ID {request.terrain_id} not found")
                 return persistence_pb2.RetrieveTerrainResponse()
-            response = persistence_pb2.RetrieveTerrainResponse()
-            for tile in tiles:
-                response.tiles.add(x=tile.x, y=tile.y, terrain_type=tile.terrain_type)
-            session.close()
-            logger.info(f"Retrieved terrain with ID: {request.terrain_id}")
-            duration = time.time() - start_time
-            logger.info(f"RetrieveTerrain invocation duration: {duration:.2f} seconds")
+        if request.HasField('hex_range'):
+            # Axial coordinates: the range is the part of its bounding box within radius
+            # steps of the center along the third axis too
+            center = hex_range.center_x + hex_range.center_y
+            tiles = tiles.take(position for position, (x, y) in enumerate(zip(tiles.xs, tiles.ys))
+                               if abs(x + y - center) <= hex_range.radius)
+        response = self._build_retrieve_response(tiles, request.packed, version)
+        logger.info(f"Retrieved {len(tiles)} tiles of the region of terrain with ID: {request.terrain_id}")
+        duration = time.time() - start_time
+        logger.info(f"RetrieveTerrainRegion invocation duration: {duration:.2f} seconds")
+        return response
+
+    def _build_retrieve_response(self, tiles, packed, version):
+        """
+        @brief Builds a RetrieveTerrainResponse from loaded tiles.
+
+        @param tiles A TileArrays with tile IDs.
+        @param packed Whether to return the tiles in packed_tiles instead of tiles.
+        @param version The version of the terrain the tiles were read at.
+
+        @return The RetrieveTerrainResponse.
+        """
+        with TRACER.span('build_response', {'tiles': len(tiles), 'packed': packed}):
+            response = persistence_pb2.RetrieveTerrainResponse(version=version)
+            if packed:
+                # Columnar encoding: one array per field and a code per tile instead of a message per tile
+                tiles.fill_packed(response.packed_tiles)
+            else:
+                for tile in tiles:
+                    response.tiles.add(x=tile.x, y=tile.y, terrain_type=tile.terrain_type)
             return response
 
+class AsyncPersistenceService(PersistenceService):
+    """
+    @brief PersistenceService for a grpc.aio server.
+
+    The database work of each RPC runs on a thread executor, so the number of requests
+    in flight is not bounded by the number of threads.
+    """
+
+    def __init__(self, executor_workers=ASYNC_EXECUTOR_WORKERS, **kwargs):
+        """
+        @brief Initializes the AsyncPersistenceService.
+
+        @param executor_workers The number of threads running database work.
+        @param kwargs Keyword arguments for PersistenceService.
+        """
+        super().__init__(**kwargs)
+        self.executor = futures.ThreadPoolExecutor(max_workers=executor_workers)
+
+    BeginTransaction = offloaded(PersistenceService.BeginTransaction)
+    CommitTransaction = offloaded(PersistenceService.CommitTransaction)
+    RollbackTransaction = offloaded(PersistenceService.RollbackTransaction)
+    StoreTerrain = offloaded(PersistenceService.StoreTerrain)
+    StoreTerrainAtomic = offloaded(PersistenceService.StoreTerrainAtomic)
+    StoreTerrainBatch = offloaded(PersistenceService.StoreTerrainBatch)
+    StoreTerrainStream = offloaded_client_stream(PersistenceService.StoreTerrainStream)
+    UpdateTiles = offloaded(PersistenceService.UpdateTiles)
+    RetrieveTerrain = offloaded(PersistenceService.RetrieveTerrain)
+    RetrieveTerrainRegion = offloaded(PersistenceService.RetrieveTerrainRegion)
+    GetCacheStats = offloaded(PersistenceService.GetCacheStats)
+    RetrieveTerrainStream = offloaded_stream(PersistenceService.RetrieveTerrainStream)
+
+    def close(self):
+        """
+        @brief Shuts down the executor, then closes the service.
+        """
+        self.executor.shutdown()
+        super().close()
+
 LOCK_FILE = "/tmp/persistence_service.lock"
 
+async def serve_async():
+    """
+    @brief Runs the Persistence Service on a grpc.aio server until terminated.
+    """
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=server_options(),
+                             interceptors=[AsyncMetricsInterceptor(), AsyncTracingInterceptor(TRACER)])
+    service = AsyncPersistenceService()
+    persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(service, server)
+
+    # Enable reflection
+    SERVICE_NAMES = (
+        persistence_pb2.DESCRIPTOR.services_by_name['PersistenceService'].full_name,
+        reflection.SERVICE_NAME,
+    )
+    reflection.enable_server_reflection(SERVICE_NAMES, server)
+
+    server.add_secure_port('[::]:50052', server_credentials)
+
+    await server.start()
+    logger.info("Persistence Service started on port 50052 (asyncio)")
+    try:
+        await server.wait_for_termination()
+    finally:
+        service.close()
+
 def serve():
+    configure_logging()
     if os.path.exists(LOCK_FILE):
         logger.error("Persistence Service is already running.")
         return
@@ -174,8 +824,17 @@ def serve():
     with open(LOCK_FILE, 'w') as lock_file:
         lock_file.write(str(os.getpid()))
 
+    metrics_server = None
     try:
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        if METRICS_PORT:
+            metrics_server = start_metrics_server(METRICS_PORT, METRICS_ADDRESS)
+            logger.info(f"Metrics served on {METRICS_ADDRESS}:{METRICS_PORT}/metrics")
+        if use_asyncio():
+            asyncio.run(serve_async())
+            return
+
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=server_options(),
+                             interceptors=[MetricsInterceptor(), TracingInterceptor(TRACER)])
         persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(PersistenceService(), server)
         
         # Enable reflection
@@ -194,6 +853,8 @@ def serve():
     except Exception as e:
         logger.error(f"Error starting Persistence Service: {e}")
     finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
         if os.path.exists(LOCK_FILE):
             os.remove(LOCK_FILE)
 
@@ -0,0 +1,255 @@
+"""
+@file schema_migrations.py
+@brief Versioned schema migrations for the persistence database.
+
+Each migration is applied once, in version order, and recorded in the
+schema_migrations table, so a database created by any earlier release is brought up
+to date when the service starts. Migrations are written as plain SQL rather than
+against the ORM models so that they keep describing the schema as it was at their
+version.
+
+Run as a module to migrate a database without starting the service:
+
+    python -m persistence.schema_migrations [--remove-duplicate-tiles] [database_url]
+"""
+
+import argparse
+
+from sqlalchemy import create_engine, text
+
+from common.logging_config import setup_logger
+
+logger = setup_logger("SchemaMigrations")
+
+
+def _create_terrain_tiles(connection):
+    # The table as created by the original Base.metadata.create_all
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS terrain_tiles ("
+            "id INTEGER NOT NULL PRIMARY KEY, "
+            "x INTEGER, "
+            "y INTEGER, "
+            "terrain_type VARCHAR(50), "
+            "terrain_id VARCHAR(50))"
+        )
+    )
+
+
+class DuplicateTilesError(RuntimeError):
+    """
+    @brief Raised when migration 2 finds terrains holding several tiles at a coordinate
+    and was not allowed to remove them.
+    """
+
+
+def _index_terrain_coordinates(connection):
+    # A terrain holds one tile per coordinate, but earlier releases did not enforce it
+    duplicates = connection.execute(
+        text(
+            "SELECT COUNT(*) FROM terrain_tiles WHERE id NOT IN "
+            "(SELECT MAX(id) FROM terrain_tiles GROUP BY terrain_id, x, y)"
+        )
+    ).scalar()
+    if duplicates:
+        if not connection.info.get("remove_duplicate_tiles"):
+            raise DuplicateTilesError(
+                f"{duplicates} tiles share a coordinate with a more recently stored tile of their "
+                f"terrain, so terrain_tiles cannot get its unique index. Back up the database, then run "
+                f"'python -m persistence.schema_migrations --remove-duplicate-tiles <database_url>' to "
+                f"move them to the terrain_tiles_duplicates table and migrate."
+            )
+        # Keep the most recently stored tile of each coordinate, and the others in a side
+        # table rather than losing them
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS terrain_tiles_duplicates AS "
+                "SELECT * FROM terrain_tiles WHERE 0"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO terrain_tiles_duplicates SELECT * FROM terrain_tiles WHERE id NOT IN "
+                "(SELECT MAX(id) FROM terrain_tiles GROUP BY terrain_id, x, y)"
+            )
+        )
+        connection.execute(
+            text(
+                "DELETE FROM terrain_tiles WHERE id NOT IN "
+                "(SELECT MAX(id) FROM terrain_tiles GROUP BY terrain_id, x, y)"
+            )
+        )
+        logger.warning(
+            f"Moved {duplicates} duplicated tiles to terrain_tiles_duplicates."
+        )
+    # terrain_id leads the index, so it also serves lookups of a whole terrain
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_terrain_tiles_terrain_coords "
+            "ON terrain_tiles (terrain_id, x, y)"
+        )
+    )
+
+
+def _create_terrain_blobs(connection):
+    # Tables of the blob storage backend
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS terrain_blobs ("
+            "terrain_id VARCHAR(50) NOT NULL PRIMARY KEY, "
+            "version INTEGER NOT NULL, "
+            "tile_count INTEGER NOT NULL, "
+            "chunk_count INTEGER NOT NULL)"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS terrain_blob_chunks ("
+            "terrain_id VARCHAR(50) NOT NULL, "
+            "chunk_index INTEGER NOT NULL, "
+            "first_id INTEGER NOT NULL, "
+            "tile_count INTEGER NOT NULL, "
+            "version INTEGER NOT NULL, "
+            "data BLOB NOT NULL, "
+            "PRIMARY KEY (terrain_id, chunk_index))"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_terrain_blob_chunks_first_id "
+            "ON terrain_blob_chunks (first_id)"
+        )
+    )
+    # Single-row counter handing out tile IDs
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS blob_tile_ids ("
+            "id INTEGER NOT NULL PRIMARY KEY CHECK (id = 1), "
+            "next_id INTEGER NOT NULL)"
+        )
+    )
+    connection.execute(
+        text("INSERT OR IGNORE INTO blob_tile_ids (id, next_id) VALUES (1, 1)")
+    )
+
+
+def _add_blob_chunk_bounds(connection):
+    # Bounding boxes of blob chunks for region queries; chunks written before stay NULL
+    # and are read by every region query
+    for column in ("min_x", "max_x", "min_y", "max_y"):
+        connection.execute(
+            text(f"ALTER TABLE terrain_blob_chunks ADD COLUMN {column} INTEGER")
+        )
+
+
+def _create_terrain_versions(connection):
+    # Versions of the terrains of the relational store, starting at 1 for those stored
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS terrain_versions ("
+            "terrain_id VARCHAR(50) NOT NULL PRIMARY KEY, "
+            "version INTEGER NOT NULL)"
+        )
+    )
+    connection.execute(
+        text(
+            "INSERT OR IGNORE INTO terrain_versions (terrain_id, version) "
+            "SELECT DISTINCT terrain_id, 1 FROM terrain_tiles WHERE terrain_id IS NOT NULL"
+        )
+    )
+
+
+def _add_terrain_tile_sentinel(connection):
+    # Row numbers within a multi-row INSERT, written by the ORM to order the returned IDs
+    connection.execute(text("ALTER TABLE terrain_tiles ADD COLUMN _sentinel INTEGER"))
+
+
+# (version, description, function applying the migration to a connection)
+MIGRATIONS = [
+    (1, "Create terrain_tiles", _create_terrain_tiles),
+    (
+        2,
+        "Add unique (terrain_id, x, y) index to terrain_tiles",
+        _index_terrain_coordinates,
+    ),
+    (3, "Create blob storage tables", _create_terrain_blobs),
+    (4, "Add bounding boxes to terrain_blob_chunks", _add_blob_chunk_bounds),
+    (5, "Create terrain_versions", _create_terrain_versions),
+    (6, "Add insert sentinel to terrain_tiles", _add_terrain_tile_sentinel),
+]
+
+
+def current_version(connection):
+    """
+    @brief Returns the schema version of a database.
+
+    @param connection An open connection to the database.
+
+    @return The version of the last applied migration, or 0 for a new database.
+    """
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER NOT NULL PRIMARY KEY, "
+            "description VARCHAR(200) NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+    )
+    return (
+        connection.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar()
+        or 0
+    )
+
+
+def migrate(engine, target_version=None, remove_duplicate_tiles=False):
+    """
+    @brief Applies every pending migration to a database in one transaction.
+
+    If a migration fails, none is applied.
+
+    @param engine The SQLAlchemy engine of the database.
+    @param target_version The version to migrate to, or None for the latest.
+    @param remove_duplicate_tiles Whether migration 2 may move tiles sharing a coordinate
+           of their terrain with a more recent tile to the terrain_tiles_duplicates table.
+
+    @return The schema version after migrating.
+
+    @exception DuplicateTilesError If migration 2 finds such tiles and may not move them.
+    """
+    with engine.begin() as connection:
+        connection.info["remove_duplicate_tiles"] = remove_duplicate_tiles
+        version = current_version(connection)
+        for migration_version, description, apply in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            if target_version is not None and migration_version > target_version:
+                break
+            logger.info(f"Applying schema migration {migration_version}: {description}")
+            apply(connection)
+            connection.execute(
+                text(
+                    "INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"
+                ),
+                {"version": migration_version, "description": description},
+            )
+            version = migration_version
+    return version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate a persistence database to the latest schema."
+    )
+    parser.add_argument(
+        "database_url", nargs="?", default="sqlite:///persistence_service.db"
+    )
+    parser.add_argument(
+        "--remove-duplicate-tiles",
+        action="store_true",
+        help="move tiles duplicating a coordinate of their terrain to terrain_tiles_duplicates",
+    )
+    args = parser.parse_args()
+    engine = create_engine(args.database_url)
+    print(
+        f"Schema version: {migrate(engine, remove_duplicate_tiles=args.remove_duplicate_tiles)}"
+    )
@@ -0,0 +1,922 @@
+"""
+@file storage.py
+@brief Storage backends for terrain tiles.
+
+PersistenceService keeps transactions, caching and the gRPC surface, and hands the
+reading and writing of tiles to a TerrainStore working inside its database sessions.
+Two stores are available, selected with VIE_STORAGE_BACKEND:
+
+- "relational" stores one terrain_tiles row per tile.
+- "blob" stores each terrain as a header record and a sequence of compressed chunk
+  records holding packed coordinates and terrain codes, so a whole terrain loads
+  with one query and a decode per chunk, and a point update rewrites one chunk.
+  New tiles are grouped into chunks by square cell of coordinates, and each chunk
+  record keeps the bounding box of its tiles, so a region query decodes only the
+  chunks it overlaps.
+
+Both keep a version per terrain that increases with every write to it, so clients can
+tell whether changes they hold apply to the terrain they loaded.
+
+The stores do not share data: tiles written through one are not visible to the other.
+"""
+
+import abc
+import math
+import struct
+import sys
+import zlib
+from array import array
+
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    LargeBinary,
+    Sequence,
+    String,
+    bindparam,
+    insert,
+    insert_sentinel,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.orm import declarative_base
+
+from common.tile_arrays import TileArrays
+
+Base = declarative_base()
+
+# Number of tile IDs looked up per SELECT ... WHERE id IN, within SQLite's parameter limit
+ID_BATCH_SIZE = 500
+
+# Widest region the relational store reads with one index seek per x coordinate
+REGION_SEEK_MAX_COLUMNS = 500
+
+# Tiles per chunk record of the blob store
+BLOB_CHUNK_TILES = 4096
+
+# Version of the chunk record encoding, stored in each record's header
+BLOB_FORMAT_VERSION = 1
+
+# Format byte, tile count and length of the terrain type table of a chunk record
+_CHUNK_HEADER = struct.Struct("<BII")
+
+
+class TerrainTile(Base):
+    __tablename__ = "terrain_tiles"
+    id = Column(Integer, Sequence("tile_id_seq"), primary_key=True)
+    x = Column(Integer)
+    y = Column(Integer)
+    terrain_type = Column(String(50))
+    terrain_id = Column(String(50))
+    # Added by schema migration 6; numbers the rows of a multi-row INSERT so that the
+    # IDs it returns can be put in the order of the rows
+    _sentinel = insert_sentinel("_sentinel")
+    # Created by schema migration 2
+    __table_args__ = (
+        Index("ix_terrain_tiles_terrain_coords", "terrain_id", "x", "y", unique=True),
+    )
+
+
+class TerrainVersion(Base):
+    # Created by schema migration 5; the relational store's terrain versions
+    __tablename__ = "terrain_versions"
+    terrain_id = Column(String(50), primary_key=True)
+    version = Column(
+        Integer, nullable=False
+    )  # Incremented on every write to the terrain
+
+
+class TerrainBlob(Base):
+    # Created by schema migration 3
+    __tablename__ = "terrain_blobs"
+    terrain_id = Column(String(50), primary_key=True)
+    version = Column(
+        Integer, nullable=False
+    )  # Incremented on every write to the terrain
+    tile_count = Column(Integer, nullable=False)
+    chunk_count = Column(Integer, nullable=False)
+
+
+class TerrainBlobChunk(Base):
+    # Created by schema migration 3
+    __tablename__ = "terrain_blob_chunks"
+    terrain_id = Column(String(50), primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    first_id = Column(
+        Integer, nullable=False
+    )  # The chunk's tiles have consecutive IDs from here
+    tile_count = Column(Integer, nullable=False)
+    version = Column(
+        Integer, nullable=False
+    )  # Incremented on every rewrite of the chunk
+    data = Column(LargeBinary, nullable=False)
+    # Bounding box of the chunk's tiles, added by schema migration 4; NULL for chunks
+    # written before it, which every region query reads
+    min_x = Column(Integer)
+    max_x = Column(Integer)
+    min_y = Column(Integer)
+    max_y = Column(Integer)
+    __table_args__ = (
+        Index("ix_terrain_blob_chunks_first_id", "first_id", unique=True),
+    )
+
+
+class TileNotFoundError(LookupError):
+    """
+    @brief Raised when an update refers to a tile that is not stored.
+    """
+
+    def __init__(self, tile_id):
+        super().__init__(f"Tile with ID {tile_id} not found for update")
+        self.tile_id = tile_id
+
+
+class CoordinateNotFoundError(TileNotFoundError):
+    """
+    @brief Raised when an update refers to a coordinate at which a terrain has no tile.
+    """
+
+    def __init__(self, terrain_id, x, y):
+        LookupError.__init__(
+            self, f"No tile at ({x}, {y}) in terrain {terrain_id} for update"
+        )
+        self.tile_id = None
+        self.terrain_id = terrain_id
+        self.x = x
+        self.y = y
+
+
+class TerrainExistsError(Exception):
+    """
+    @brief Raised when a new terrain is given the ID of a stored terrain that does not
+    hold its tiles, so the request is not a retry of the one that stored it.
+    """
+
+    def __init__(self, terrain_id, x, y):
+        super().__init__(
+            f"Terrain {terrain_id} is already stored without a tile at ({x}, {y})"
+        )
+        self.terrain_id = terrain_id
+        self.x = x
+        self.y = y
+
+
+class TerrainStore(abc.ABC):
+    """
+    @brief Interface of the storage backends.
+
+    Every method works inside the caller's session and leaves committing to it.
+    """
+
+    @abc.abstractmethod
+    def store(self, session, terrain_id, tiles):
+        """
+        @brief Inserts and updates tiles.
+
+        @param session The database session.
+        @param terrain_id The terrain new tiles are added to.
+        @param tiles TerrainTile messages; those with an ID update that tile, the others are new.
+
+        @return A pair of the tile IDs in request order and the set of changed terrain IDs.
+
+        @exception TileNotFoundError If an updated tile is not stored; nothing is written.
+        """
+
+    @abc.abstractmethod
+    def store_new(self, session, terrain_id, tiles):
+        """
+        @brief Inserts new tiles straight from their columns.
+
+        @param session The database session.
+        @param terrain_id The terrain the tiles are added to.
+        @param tiles A non-empty TileArrays of new tiles.
+
+        @return The IDs of the tiles, in order.
+        """
+
+    @abc.abstractmethod
+    def update_tiles(self, session, terrain_id, changes):
+        """
+        @brief Changes the terrain type of tiles addressed by coordinate.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+        @param changes TileChange messages with the x, y and new terrain_type of each
+               tile, applied in order.
+
+        @return The version of the terrain after the update; with no changes, its
+                current version.
+
+        @exception CoordinateNotFoundError If the terrain has no tile at a coordinate;
+                   nothing is written.
+        """
+
+    @abc.abstractmethod
+    def version(self, session, terrain_id):
+        """
+        @brief Returns the version of a terrain, which increases with every write to it.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+
+        @return The version, 0 if the terrain is not stored.
+        """
+
+    @abc.abstractmethod
+    def exists(self, session, terrain_id):
+        """
+        @brief Returns whether any tile of a terrain is stored.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+        """
+
+    @abc.abstractmethod
+    def load(self, session, terrain_id):
+        """
+        @brief Loads all tiles of a terrain.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+
+        @return A TileArrays with tile IDs, empty if the terrain is not stored.
+        """
+
+    @abc.abstractmethod
+    def iter_chunks(self, session, terrain_id, chunk_size):
+        """
+        @brief Loads the tiles of a terrain a chunk at a time.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+        @param chunk_size The maximum number of tiles per chunk.
+
+        @return An iterator of TileArrays with tile IDs; empty if the terrain is not stored.
+        """
+
+    @abc.abstractmethod
+    def load_region(self, session, terrain_id, min_x, max_x, min_y, max_y):
+        """
+        @brief Loads the tiles of a terrain within a box of coordinates.
+
+        @param session The database session.
+        @param terrain_id The ID of the terrain.
+        @param min_x The smallest x coordinate in the box.
+        @param max_x The largest x coordinate in the box.
+        @param min_y The smallest y coordinate in the box.
+        @param max_y The largest y coordinate in the box.
+
+        @return A TileArrays with tile IDs of the tiles inside the box, bounds included.
+        """
+
+
+class RelationalTerrainStore(TerrainStore):
+    """
+    @brief Stores one terrain_tiles row per tile.
+    """
+
+    def store(self, session, terrain_id, tiles):
+        tile_ids = [tile.id for tile in tiles]
+        updates = [tile for tile in tiles if tile.id]  # Tiles with an ID are updates
+        new_positions = [position for position, tile in enumerate(tiles) if not tile.id]
+        changed_terrains = {terrain_id} if new_positions else set()
+
+        if updates:
+            tile_terrains = self._find_tile_terrains(
+                session, [tile.id for tile in updates]
+            )
+            missing_id = next(
+                (tile.id for tile in updates if tile.id not in tile_terrains), None
+            )
+            if missing_id is not None:
+                raise TileNotFoundError(missing_id)
+            # One executemany of UPDATE ... WHERE id = ? for all updated tiles
+            session.execute(
+                update(TerrainTile),
+                [
+                    {
+                        "id": tile.id,
+                        "x": tile.x,
+                        "y": tile.y,
+                        "terrain_type": tile.terrain_type,
+                    }
+                    for tile in updates
+                ],
+            )
+            changed_terrains.update(tile_terrains.values())
+
+        if new_positions:
+            new_ids = self._insert(
+                session,
+                [
+                    {
+                        "x": tiles[position].x,
+                        "y": tiles[position].y,
+                        "terrain_type": tiles[position].terrain_type,
+                        "terrain_id": terrain_id,
+                    }
+                    for position in new_positions
+                ],
+            )
+            for position, tile_id in zip(new_positions, new_ids):
+                tile_ids[position] = tile_id
+        for changed_terrain in changed_terrains:
+            self._increment_version(session, changed_terrain)
+        return tile_ids, changed_terrains
+
+    def store_new(self, session, terrain_id, tiles):
+        terrain_types = tiles.terrain_types
+        tile_ids = self._insert(
+            session,
+            [
+                {
+                    "x": x,
+                    "y": y,
+                    "terrain_type": terrain_types[code],
+                    "terrain_id": terrain_id,
+                }
+                for x, y, code in zip(tiles.xs, tiles.ys, tiles.codes)
+            ],
+        )
+        self._increment_version(session, terrain_id)
+        return tile_ids
+
+    def update_tiles(self, session, terrain_id, changes):
+        if not changes:
+            return self.version(session, terrain_id)
+        coordinates = list({(change.x, change.y) for change in changes})
+        found = set()
+        # Joined from a VALUES table, so each coordinate is one seek of the (terrain_id,
+        # x, y) index; SQLite plans (x, y) IN (VALUES ...) as a scan of the terrain.
+        # Two parameters per coordinate
+        for start in range(0, len(coordinates), ID_BATCH_SIZE // 2):
+            batch = coordinates[start : start + ID_BATCH_SIZE // 2]
+            parameters = {"terrain_id": terrain_id}
+            for index, (x, y) in enumerate(batch):
+                parameters[f"x{index}"] = x
+                parameters[f"y{index}"] = y
+            rows = ", ".join(f"(:x{index}, :y{index})" for index in range(len(batch)))
+            found.update(
+                session.execute(
+                    text(
+                        f"WITH changes (x, y) AS (VALUES {rows}) "
+                        "SELECT tiles.x, tiles.y FROM changes JOIN terrain_tiles AS tiles "
+                        "ON tiles.terrain_id = :terrain_id AND tiles.x = changes.x AND tiles.y = changes.y"
+                    ),
+                    parameters,
+                ).tuples()
+            )
+        missing = next(
+            (change for change in changes if (change.x, change.y) not in found), None
+        )
+        if missing is not None:
+            raise CoordinateNotFoundError(terrain_id, missing.x, missing.y)
+        # One executemany of UPDATE ... WHERE terrain_id = ? AND x = ? AND y = ?, a
+        # lookup of the (terrain_id, x, y) index per tile
+        table = TerrainTile.__table__
+        session.execute(
+            update(table)
+            .where(
+                table.c.terrain_id == terrain_id,
+                table.c.x == bindparam("change_x"),
+                table.c.y == bindparam("change_y"),
+            )
+            .values(terrain_type=bindparam("change_terrain_type")),
+            [
+                {
+                    "change_x": change.x,
+                    "change_y": change.y,
+                    "change_terrain_type": change.terrain_type,
+                }
+                for change in changes
+            ],
+        )
+        return self._increment_version(session, terrain_id)
+
+    def version(self, session, terrain_id):
+        return (
+            session.scalar(
+                select(TerrainVersion.version).where(
+                    TerrainVersion.terrain_id == terrain_id
+                )
+            )
+            or 0
+        )
+
+    def _increment_version(self, session, terrain_id):
+        """
+        @brief Increments the version of a terrain, starting it at 1.
+
+        @return The new version.
+        """
+        return session.execute(
+            text(
+                "INSERT INTO terrain_versions (terrain_id, version) VALUES (:terrain_id, 1) "
+                "ON CONFLICT (terrain_id) DO UPDATE SET version = version + 1 RETURNING version"
+            ),
+            {"terrain_id": terrain_id},
+        ).scalar_one()
+
+    def _insert(self, session, rows):
+        # Multi-row INSERT ... RETURNING id; SQLAlchemy puts the IDs in the order of
+        # the rows by their _sentinel values
+        statement = insert(TerrainTile).returning(
+            TerrainTile.id, sort_by_parameter_order=True
+        )
+        return session.scalars(statement, rows).all()
+
+    def _find_tile_terrains(self, session, tile_ids):
+        """
+        @brief Looks up the terrains of stored tiles.
+
+        @param session The database session.
+        @param tile_ids The tile IDs to look for.
+
+        @return A dictionary from each stored tile ID to its terrain ID; missing tiles are left out.
+        """
+        found = {}
+        for start in range(0, len(tile_ids), ID_BATCH_SIZE):
+            batch = tile_ids[start : start + ID_BATCH_SIZE]
+            found.update(
+                session.execute(
+                    select(TerrainTile.id, TerrainTile.terrain_id).where(
+                        TerrainTile.id.in_(batch)
+                    )
+                )
+                .tuples()
+                .all()
+            )
+        return found
+
+    def _tiles_query(self, terrain_id):
+        return select(
+            TerrainTile.id, TerrainTile.x, TerrainTile.y, TerrainTile.terrain_type
+        ).where(TerrainTile.terrain_id == terrain_id)
+
+    def _to_arrays(self, rows):
+        tiles = TileArrays(with_ids=True)
+        for row in rows:
+            tiles.append(row.x, row.y, tiles.code_of(row.terrain_type), row.id)
+        return tiles
+
+    def exists(self, session, terrain_id):
+        return (
+            session.execute(self._tiles_query(terrain_id).limit(1)).first() is not None
+        )
+
+    def load(self, session, terrain_id):
+        return self._to_arrays(session.execute(self._tiles_query(terrain_id)))
+
+    def iter_chunks(self, session, terrain_id, chunk_size):
+        # Ordered along the (terrain_id, x, y) index, so no sort is needed
+        query = (
+            self._tiles_query(terrain_id)
+            .order_by(TerrainTile.x, TerrainTile.y)
+            .execution_options(yield_per=chunk_size)
+        )
+        for rows in session.execute(query).partitions():
+            yield self._to_arrays(rows)
+
+    def load_region(self, session, terrain_id, min_x, max_x, min_y, max_y):
+        # Along the (terrain_id, x, y) index, so only the rows of tiles inside the box
+        # are read. Up to REGION_SEEK_MAX_COLUMNS columns each x is a seek followed by a
+        # range of y; wider boxes scan the x range and check y in the index
+        if max_x - min_x < REGION_SEEK_MAX_COLUMNS:
+            x_filter = TerrainTile.x.in_(range(min_x, max_x + 1))
+        else:
+            x_filter = TerrainTile.x.between(min_x, max_x)
+        query = self._tiles_query(terrain_id).where(
+            x_filter, TerrainTile.y.between(min_y, max_y)
+        )
+        return self._to_arrays(session.execute(query))
+
+
+def encode_chunk(tiles, start=0, stop=None):
+    """
+    @brief Encodes tiles as a compressed chunk record, without their IDs.
+
+    @param tiles The TileArrays holding the tiles.
+    @param start The index of the first tile to encode.
+    @param stop The index after the last tile to encode, or None for the end.
+
+    @return The record bytes.
+    """
+    stop = len(tiles) if stop is None else min(stop, len(tiles))
+    xs, ys = tiles.xs[start:stop], tiles.ys[start:stop]
+    if sys.byteorder == "big":
+        xs.byteswap()
+        ys.byteswap()
+    types = "\n".join(tiles.terrain_types).encode()
+    header = _CHUNK_HEADER.pack(BLOB_FORMAT_VERSION, stop - start, len(types))
+    return zlib.compress(
+        header + types + xs.tobytes() + ys.tobytes() + bytes(tiles.codes[start:stop])
+    )
+
+
+def decode_chunk(data, first_id, tiles):
+    """
+    @brief Decodes a chunk record and appends its tiles.
+
+    @param data The record bytes.
+    @param first_id The ID of the chunk's first tile.
+    @param tiles The TileArrays with tile IDs to append to.
+    """
+    raw = zlib.decompress(data)
+    version, count, types_length = _CHUNK_HEADER.unpack_from(raw)
+    if version != BLOB_FORMAT_VERSION:
+        raise ValueError(f"Unsupported terrain chunk format {version}")
+    offset = _CHUNK_HEADER.size
+    types = (
+        raw[offset : offset + types_length].decode().split("\n") if types_length else []
+    )
+    offset += types_length
+    xs, ys = array("i"), array("i")
+    xs.frombytes(raw[offset : offset + 4 * count])
+    ys.frombytes(raw[offset + 4 * count : offset + 8 * count])
+    if sys.byteorder == "big":
+        xs.byteswap()
+        ys.byteswap()
+    codes = raw[offset + 8 * count : offset + 9 * count]
+    table = bytes(tiles.code_of(terrain_type) for terrain_type in types)
+    if table != bytes(range(len(table))):
+        # Map the chunk's codes onto the codes of the tiles appended to
+        codes = codes.translate(table + bytes(256 - len(table)))
+    tiles.xs.extend(xs)
+    tiles.ys.extend(ys)
+    tiles.codes.extend(codes)
+    tiles.ids.extend(range(first_id, first_id + count))
+
+
+class BlobTerrainStore(TerrainStore):
+    """
+    @brief Stores each terrain as compressed chunk records of packed tiles.
+
+    Tiles get IDs from a counter shared by all terrains, in consecutive runs per chunk,
+    so a tile ID locates its chunk through the first_id index. New tiles are appended
+    as new chunks; an update decodes, changes and re-encodes the chunks it touches.
+
+    New tiles are sorted by the square cell of coordinates they fall in, a cell holding
+    as many hexes as a chunk, and no chunk spans two cells. Tiles are therefore loaded
+    in cell order rather than the order they were stored in.
+    """
+
+    def __init__(self, chunk_tiles=BLOB_CHUNK_TILES):
+        """
+        @brief Creates a blob store.
+
+        @param chunk_tiles The maximum number of tiles per chunk record.
+        """
+        self.chunk_tiles = chunk_tiles
+
+    def store(self, session, terrain_id, tiles):
+        tile_ids = [tile.id for tile in tiles]
+        changed_terrains = set()
+
+        updates = [tile for tile in tiles if tile.id]
+        if updates:
+            changed_terrains.update(self._update(session, updates))
+
+        new_positions = [position for position, tile in enumerate(tiles) if not tile.id]
+        if new_positions:
+            new_ids = self.store_new(
+                session,
+                terrain_id,
+                TileArrays.from_tiles(tiles[position] for position in new_positions),
+            )
+            for position, tile_id in zip(new_positions, new_ids):
+                tile_ids[position] = tile_id
+            changed_terrains.add(terrain_id)
+        return tile_ids, changed_terrains
+
+    def store_new(self, session, terrain_id, tiles):
+        cell_size = max(1, math.isqrt(self.chunk_tiles))
+        xs, ys = tiles.xs, tiles.ys
+        cells = [(y // cell_size, x // cell_size) for x, y in zip(xs, ys)]
+        order = sorted(range(len(tiles)), key=cells.__getitem__)
+        # Chunk boundaries: a new chunk at every change of cell and every chunk_tiles tiles
+        starts = []
+        for rank, position in enumerate(order):
+            if (
+                not starts
+                or rank - starts[-1] == self.chunk_tiles
+                or cells[position] != cells[order[rank - 1]]
+            ):
+                starts.append(rank)
+
+        first_id = self._allocate_ids(session, len(tiles))
+        self._append(session, terrain_id, tiles.take(order), first_id, starts)
+        tile_ids = [0] * len(tiles)
+        for rank, position in enumerate(order):
+            tile_ids[position] = first_id + rank
+        return tile_ids
+
+    def _allocate_ids(self, session, count):
+        """
+        @brief Reserves a run of consecutive tile IDs.
+
+        @return The first ID of the run.
+        """
+        next_id = session.execute(
+            text(
+                "UPDATE blob_tile_ids SET next_id = next_id + :count WHERE id = 1 RETURNING next_id"
+            ),
+            {"count": count},
+        ).scalar_one()
+        return next_id - count
+
+    def _append(self, session, terrain_id, tiles, first_id, starts):
+        """
+        @brief Writes tiles with consecutive IDs as new chunks at the end of a terrain.
+
+        @param starts The index of the first tile of each chunk, ascending from 0.
+        """
+        header = session.get(TerrainBlob, terrain_id, with_for_update=True)
+        if header is None:
+            header = TerrainBlob(
+                terrain_id=terrain_id, version=0, tile_count=0, chunk_count=0
+            )
+            session.add(header)
+        stops = starts[1:] + [len(tiles)]
+        session.execute(
+            insert(TerrainBlobChunk),
+            [
+                {
+                    "terrain_id": terrain_id,
+                    "chunk_index": header.chunk_count + index,
+                    "first_id": first_id + start,
+                    "tile_count": stop - start,
+                    "version": 1,
+                    "data": encode_chunk(tiles, start, stop),
+                    **_bounds(tiles, start, stop),
+                }
+                for index, (start, stop) in enumerate(zip(starts, stops))
+            ],
+        )
+        header.chunk_count += len(starts)
+        header.tile_count += len(tiles)
+        header.version += 1
+        session.flush()
+
+    def _update(self, session, updates):
+        """
+        @brief Applies tile updates by rewriting the chunks holding the tiles.
+
+        @return The IDs of the changed terrains.
+        """
+        chunks = []  # (chunk record, decoded tiles) pairs in tile ID order
+        for tile in sorted(updates, key=lambda tile: tile.id):
+            chunk, chunk_tiles = chunks[-1] if chunks else (None, None)
+            if (
+                chunk is None
+                or not chunk.first_id <= tile.id < chunk.first_id + chunk.tile_count
+            ):
+                chunk = session.scalars(
+                    select(TerrainBlobChunk)
+                    .where(TerrainBlobChunk.first_id <= tile.id)
+                    .order_by(TerrainBlobChunk.first_id.desc())
+                    .limit(1)
+                ).first()
+                if chunk is None or tile.id >= chunk.first_id + chunk.tile_count:
+                    raise TileNotFoundError(tile.id)
+                chunk_tiles = TileArrays(with_ids=True)
+                decode_chunk(chunk.data, chunk.first_id, chunk_tiles)
+                chunks.append((chunk, chunk_tiles))
+            index = tile.id - chunk.first_id
+            chunk_tiles.xs[index] = tile.x
+            chunk_tiles.ys[index] = tile.y
+            chunk_tiles.codes[index] = chunk_tiles.code_of(tile.terrain_type)
+
+        return set(self._rewrite(session, chunks))
+
+    def update_tiles(self, session, terrain_id, changes):
+        if not changes:
+            return self.version(session, terrain_id)
+        chunk = TerrainBlobChunk
+        boxes = session.execute(
+            select(
+                chunk.chunk_index, chunk.min_x, chunk.max_x, chunk.min_y, chunk.max_y
+            )
+            .where(chunk.terrain_id == terrain_id)
+            .order_by(chunk.chunk_index)
+        ).all()
+        # The chunks whose bounding box holds each change's coordinate
+        candidates = [
+            [
+                chunk_index
+                for chunk_index, min_x, max_x, min_y, max_y in boxes
+                if min_x is None
+                or (min_x <= change.x <= max_x and min_y <= change.y <= max_y)
+            ]
+            for change in changes
+        ]
+        needed = sorted(
+            {chunk_index for indexes in candidates for chunk_index in indexes}
+        )
+        records = {}
+        for start in range(0, len(needed), ID_BATCH_SIZE):
+            records.update(
+                (record.chunk_index, record)
+                for record in session.scalars(
+                    select(chunk).where(
+                        chunk.terrain_id == terrain_id,
+                        chunk.chunk_index.in_(needed[start : start + ID_BATCH_SIZE]),
+                    )
+                )
+            )
+
+        decoded = {}  # Chunk index to the chunk's decoded tiles
+        located = []  # (chunk index, position, change) per change
+        for change, indexes in zip(changes, candidates):
+            for chunk_index in indexes:
+                if chunk_index not in decoded:
+                    decoded[chunk_index] = TileArrays(with_ids=True)
+                    decode_chunk(
+                        records[chunk_index].data,
+                        records[chunk_index].first_id,
+                        decoded[chunk_index],
+                    )
+                position = _find_tile(decoded[chunk_index], change.x, change.y)
+                if position is not None:
+                    located.append((chunk_index, position, change))
+                    break
+            else:
+                raise CoordinateNotFoundError(terrain_id, change.x, change.y)
+        for chunk_index, position, change in located:
+            chunk_tiles = decoded[chunk_index]
+            chunk_tiles.codes[position] = chunk_tiles.code_of(change.terrain_type)
+        touched = sorted({chunk_index for chunk_index, _, _ in located})
+        return self._rewrite(
+            session,
+            [(records[chunk_index], decoded[chunk_index]) for chunk_index in touched],
+        )[terrain_id]
+
+    def _rewrite(self, session, chunks):
+        """
+        @brief Re-encodes changed chunks and increments the versions of their terrains.
+
+        @param chunks (chunk record, decoded tiles) pairs.
+
+        @return A dictionary from each changed terrain ID to its new version.
+        """
+        changed_terrains = set()
+        for chunk, chunk_tiles in chunks:
+            chunk.data = encode_chunk(chunk_tiles)
+            for column, value in _bounds(chunk_tiles, 0, len(chunk_tiles)).items():
+                setattr(chunk, column, value)
+            chunk.version += 1
+            changed_terrains.add(chunk.terrain_id)
+        versions = {
+            terrain_id: session.execute(
+                update(TerrainBlob)
+                .where(TerrainBlob.terrain_id == terrain_id)
+                .values(version=TerrainBlob.version + 1)
+                .returning(TerrainBlob.version)
+            ).scalar_one()
+            for terrain_id in changed_terrains
+        }
+        session.flush()
+        return versions
+
+    def version(self, session, terrain_id):
+        return (
+            session.scalar(
+                select(TerrainBlob.version).where(TerrainBlob.terrain_id == terrain_id)
+            )
+            or 0
+        )
+
+    def _chunks_query(self, terrain_id):
+        return (
+            select(TerrainBlobChunk.first_id, TerrainBlobChunk.data)
+            .where(TerrainBlobChunk.terrain_id == terrain_id)
+            .order_by(TerrainBlobChunk.chunk_index)
+        )
+
+    def exists(self, session, terrain_id):
+        header = session.get(TerrainBlob, terrain_id)
+        return header is not None and header.tile_count > 0
+
+    def load(self, session, terrain_id):
+        tiles = TileArrays(with_ids=True)
+        for first_id, data in session.execute(self._chunks_query(terrain_id)):
+            decode_chunk(data, first_id, tiles)
+        return tiles
+
+    def iter_chunks(self, session, terrain_id, chunk_size):
+        pending = TileArrays(with_ids=True)
+        query = self._chunks_query(terrain_id).execution_options(yield_per=1)
+        for first_id, data in session.execute(query):
+            decode_chunk(data, first_id, pending)
+            while len(pending) >= chunk_size:
+                chunk = TileArrays(pending.terrain_types, with_ids=True)
+                for column, source in (
+                    (chunk.xs, pending.xs),
+                    (chunk.ys, pending.ys),
+                    (chunk.codes, pending.codes),
+                    (chunk.ids, pending.ids),
+                ):
+                    column.extend(source[:chunk_size])
+                    del source[:chunk_size]
+                yield chunk
+        if len(pending):
+            yield pending
+
+    def load_region(self, session, terrain_id, min_x, max_x, min_y, max_y):
+        chunk = TerrainBlobChunk
+        query = (
+            select(
+                chunk.first_id,
+                chunk.data,
+                chunk.min_x,
+                chunk.max_x,
+                chunk.min_y,
+                chunk.max_y,
+            )
+            .where(
+                chunk.terrain_id == terrain_id,
+                chunk.min_x.is_(None)
+                | (
+                    (chunk.min_x <= max_x)
+                    & (chunk.max_x >= min_x)
+                    & (chunk.min_y <= max_y)
+                    & (chunk.max_y >= min_y)
+                ),
+            )
+            .order_by(chunk.chunk_index)
+        )
+        tiles = TileArrays(with_ids=True)
+        for (
+            first_id,
+            data,
+            chunk_min_x,
+            chunk_max_x,
+            chunk_min_y,
+            chunk_max_y,
+        ) in session.execute(query):
+            if (
+                chunk_min_x is not None
+                and min_x <= chunk_min_x
+                and chunk_max_x <= max_x
+                and min_y <= chunk_min_y
+                and chunk_max_y <= max_y
+            ):
+                decode_chunk(data, first_id, tiles)  # The chunk lies inside the box
+                continue
+            chunk_tiles = TileArrays(tiles.terrain_types, with_ids=True)
+            decode_chunk(data, first_id, chunk_tiles)
+            for x, y, code, tile_id in zip(
+                chunk_tiles.xs, chunk_tiles.ys, chunk_tiles.codes, chunk_tiles.ids
+            ):
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    tiles.append(
+                        x, y, tiles.code_of(chunk_tiles.terrain_types[code]), tile_id
+                    )
+        return tiles
+
+
+def _find_tile(tiles, x, y):
+    """
+    @brief Returns the position of the tile at (x, y) in a TileArrays, or None.
+    """
+    # array.index finds each tile in the column of x at C speed; only those are checked for y
+    xs, ys = tiles.xs, tiles.ys
+    position = -1
+    try:
+        while True:
+            position = xs.index(x, position + 1)
+            if ys[position] == y:
+                return position
+    except ValueError:
+        return None
+
+
+def _bounds(tiles, start, stop):
+    """
+    @brief Returns the bounding box columns of a chunk record holding tiles[start:stop].
+    """
+    xs, ys = tiles.xs[start:stop], tiles.ys[start:stop]
+    return {"min_x": min(xs), "max_x": max(xs), "min_y": min(ys), "max_y": max(ys)}
+
+
+STORES = {
+    "relational": RelationalTerrainStore,
+    "blob": BlobTerrainStore,
+}
+
+
+def create_store(name):
+    """
+    @brief Creates the storage backend with the given name.
+
+    @param name "relational" or "blob".
+
+    @return The TerrainStore.
+
+    @exception ValueError If there is no backend with that name.
+    """
+    try:
+        return STORES[name.strip().lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown storage backend {name!r}") from None
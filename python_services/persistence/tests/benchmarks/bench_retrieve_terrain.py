@@ -0,0 +1,115 @@
+"""
+@file bench_retrieve_terrain.py
+@brief Measures RetrieveTerrain latency as the number of stored tiles grows.
+
+A 1,000-tile probe terrain is stored in a fresh database, which is then filled with
+other terrains up to each size. At each size the median latency of retrieving the
+probe terrain is measured, both on the migrated schema and on a copy without the
+(terrain_id, x, y) index.
+
+Run from python_services:
+
+    python -m persistence.tests.benchmarks.bench_retrieve_terrain [--max-tiles N]
+"""
+
+import argparse
+import logging
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from persistence.persistence_pb2 import (
+    RetrieveTerrainRequest,
+    StoreTerrainRequest,
+    TerrainTile,
+)
+from persistence.persistence_service import PersistenceService
+
+PROBE_TILES = 1000
+FILLER_TERRAIN_TILES = 10_000
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def fill_tiles(engine, stored, target):
+    """
+    @brief Stores filler terrains of FILLER_TERRAIN_TILES tiles until target tiles are stored.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        while stored < target:
+            count = min(FILLER_TERRAIN_TILES, target - stored)
+            terrain_id = f"filler-{stored}"
+            cursor.executemany(
+                "INSERT INTO terrain_tiles (x, y, terrain_type, terrain_id) VALUES (?, ?, 'plains', ?)",
+                ((i % 100, i // 100, terrain_id) for i in range(count)),
+            )
+            stored += count
+        connection.commit()
+    finally:
+        connection.close()
+    return stored
+
+
+def _median_latency(service, terrain_id, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        response = service.RetrieveTerrain(
+            RetrieveTerrainRequest(terrain_id=terrain_id), MagicMock()
+        )
+        durations.append(time.perf_counter() - start)
+        assert len(response.tiles) == PROBE_TILES
+    return statistics.median(durations)
+
+
+def run(max_tiles, repeats):
+    """
+    @brief Runs the benchmark and prints one line per database size.
+
+    @param max_tiles The largest number of stored tiles to measure at.
+    @param repeats The number of retrievals per measurement.
+    """
+    logging.disable(logging.INFO)
+    sizes = [size for size in SIZES if size <= max_tiles]
+    with tempfile.TemporaryDirectory() as directory:
+        services = {}
+        for label, indexed in (("indexed", True), ("unindexed", False)):
+            url = f"sqlite:///{Path(directory) / label}.db"
+            service = PersistenceService(url, cache_max_entries=0)
+            if not indexed:
+                # Drop the index added by the second migration, keeping the later tables
+                with service.engine.begin() as connection:
+                    connection.exec_driver_sql(
+                        "DROP INDEX ix_terrain_tiles_terrain_coords"
+                    )
+            tiles = [
+                TerrainTile(x=i % 40, y=i // 40, terrain_type="hills")
+                for i in range(PROBE_TILES)
+            ]
+            terrain_id = service.StoreTerrain(
+                StoreTerrainRequest(tiles=tiles), MagicMock()
+            ).terrain_id
+            services[label] = (service, terrain_id, PROBE_TILES)
+
+        print(f"{'stored tiles':>14} {'indexed':>12} {'unindexed':>12}")
+        for size in sizes:
+            latencies = []
+            for label, (service, terrain_id, stored) in services.items():
+                stored = fill_tiles(service.engine, stored, size)
+                services[label] = (service, terrain_id, stored)
+                latencies.append(_median_latency(service, terrain_id, repeats))
+            print(
+                f"{size:>14,} "
+                + " ".join(f"{latency * 1000:>10.2f}ms" for latency in latencies)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--max-tiles", type=int, default=SIZES[-1])
+    parser.add_argument("--repeats", type=int, default=5)
+    arguments = parser.parse_args()
+    run(arguments.max_tiles, arguments.repeats)
@@ -0,0 +1,124 @@
+"""
+@file bench_storage_backends.py
+@brief Compares the relational and blob storage backends on whole-terrain workloads.
+
+For each backend a terrain is stored in a fresh database, then the median latencies
+of loading it, of retrieving it packed (bypassing the response cache), of retrieving
+a 100x60 viewport of it and of a single-tile update are measured, along with the size
+of the database file.
+
+Run from python_services:
+
+    python -m persistence.tests.benchmarks.bench_storage_backends [--tiles N]
+"""
+
+import argparse
+import logging
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from persistence.persistence_pb2 import (
+    RetrieveTerrainRegionRequest,
+    RetrieveTerrainRequest,
+    StoreTerrainRequest,
+    TerrainTile,
+)
+from persistence.persistence_service import PersistenceService
+
+TERRAIN_TYPES = ("plains", "forest", "hills", "mountain", "lake", "desert")
+
+
+def _median(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def run(tile_count, repeats):
+    """
+    @brief Runs the benchmark and prints one line per backend.
+
+    @param tile_count The number of tiles of the stored terrain.
+    @param repeats The number of runs per measurement.
+    """
+    logging.disable(logging.INFO)
+    side = int(tile_count**0.5) + 1
+    tiles = [
+        TerrainTile(
+            x=i % side, y=i // side, terrain_type=TERRAIN_TYPES[(i * 7 // side) % 6]
+        )
+        for i in range(tile_count)
+    ]
+    print(
+        f"{'backend':>10} {'store':>10} {'load':>10} {'retrieve':>10} {'viewport':>10} {'update':>10} "
+        f"{'db size':>10}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ("relational", "blob"):
+            path = Path(directory) / f"{backend}.db"
+            service = PersistenceService(
+                f"sqlite:///{path}", cache_max_entries=0, storage_backend=backend
+            )
+            start = time.perf_counter()
+            response = service.StoreTerrain(
+                StoreTerrainRequest(tiles=tiles), MagicMock()
+            )
+            store = time.perf_counter() - start
+
+            def load():
+                with service.DbSession() as session:
+                    assert (
+                        len(service.store.load(session, response.terrain_id))
+                        == tile_count
+                    )
+
+            request = RetrieveTerrainRequest(
+                terrain_id=response.terrain_id, packed=True
+            )
+            viewport = RetrieveTerrainRegionRequest(
+                terrain_id=response.terrain_id,
+                packed=True,
+                min_x=side // 2,
+                max_x=side // 2 + 99,
+                min_y=side // 3,
+                max_y=side // 3 + 59,
+            )
+            update = StoreTerrainRequest(
+                tiles=[
+                    TerrainTile(
+                        id=response.tile_ids[tile_count // 2],
+                        x=-1,
+                        y=-1,
+                        terrain_type="lake",
+                    )
+                ]
+            )
+            load_time = _median(load, repeats)
+            retrieve = _median(
+                lambda: service.RetrieveTerrain(request, MagicMock()), repeats
+            )
+            region = _median(
+                lambda: service.RetrieveTerrainRegion(viewport, MagicMock()), repeats
+            )
+            update_time = _median(
+                lambda: service.StoreTerrain(update, MagicMock()), repeats
+            )
+            service.engine.dispose()
+            print(
+                f"{backend:>10} {store * 1000:>8.0f}ms {load_time * 1000:>8.0f}ms {retrieve * 1000:>8.0f}ms "
+                f"{region * 1000:>8.1f}ms {update_time * 1000:>8.1f}ms {path.stat().st_size / 2 ** 20:>8.1f}MB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--tiles", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    arguments = parser.parse_args()
+    run(arguments.tiles, arguments.repeats)
@@ -0,0 +1,145 @@
+"""
+@file bench_suite.py
+@brief Regression-gated benchmarks of storing, retrieving and serializing terrains.
+
+Measures StoreTerrain insert throughput, the RetrieveTerrain latency of a
+1,000-tile terrain as the database grows, with the response cache disabled, and the
+cost of serializing and parsing RetrieveTerrainResponse messages with the tiles as
+messages and packed. The results are compared with baseline.json next to this file;
+the run fails when a gated metric is worse than its baseline by more than its
+threshold.
+
+Run from python_services:
+
+    python -m persistence.tests.benchmarks.bench_suite [--update-baseline]
+"""
+
+import logging
+import sys
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from common.benchmarking import Metric, best_time, run_suite
+from persistence.persistence_pb2 import (
+    RetrieveTerrainRequest,
+    RetrieveTerrainResponse,
+    StoreTerrainRequest,
+    TerrainTile,
+)
+from persistence.persistence_service import PersistenceService
+from persistence.tests.benchmarks.bench_retrieve_terrain import PROBE_TILES, fill_tiles
+
+BASELINE = Path(__file__).with_name("baseline.json")
+TERRAIN_TYPES = ("plains", "forest", "hills", "mountain", "lake", "desert")
+STORED_TILES = 10_000
+DATABASE_SIZES = (10_000, 100_000, 1_000_000)
+SERIALIZED_TILES = 10_000
+REPEATS = 5
+# Serialization takes under a millisecond, so each of its samples times several calls
+SERIALIZATION_CALLS = 20
+
+
+def _tiles(count, side=100):
+    return [
+        TerrainTile(x=i % side, y=i // side, terrain_type=TERRAIN_TYPES[i % 6])
+        for i in range(count)
+    ]
+
+
+def bench_store_terrain():
+    """
+    @brief Measures StoreTerrain throughput for new terrains of STORED_TILES tiles.
+    """
+    request = StoreTerrainRequest(tiles=_tiles(STORED_TILES))
+    with tempfile.TemporaryDirectory() as directory:
+        service = PersistenceService(
+            f"sqlite:///{directory}/bench.db", cache_max_entries=0
+        )
+        seconds = best_time(lambda: service.StoreTerrain(request, MagicMock()), REPEATS)
+        service.engine.dispose()
+    yield Metric(
+        f"store_terrain[{STORED_TILES}]",
+        STORED_TILES / seconds,
+        "tiles/s",
+        higher_is_better=True,
+    )
+
+
+def bench_retrieve_terrain():
+    """
+    @brief Measures RetrieveTerrain latency of a PROBE_TILES-tile terrain at each of DATABASE_SIZES stored tiles.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        service = PersistenceService(
+            f"sqlite:///{directory}/bench.db", cache_max_entries=0
+        )
+        terrain_id = service.StoreTerrain(
+            StoreTerrainRequest(tiles=_tiles(PROBE_TILES, 40)), MagicMock()
+        ).terrain_id
+        request = RetrieveTerrainRequest(terrain_id=terrain_id)
+        stored = PROBE_TILES
+        for size in DATABASE_SIZES:
+            stored = fill_tiles(service.engine, stored, size)
+            for packed in (False, True):
+                request.packed = packed
+                seconds = best_time(
+                    lambda: service.RetrieveTerrain(request, MagicMock()), REPEATS
+                )
+                yield Metric(
+                    f"retrieve_terrain[{size}{',packed' if packed else ''}]",
+                    seconds,
+                    "s",
+                )
+        service.engine.dispose()
+
+
+def bench_response_serialization():
+    """
+    @brief Times serializing and parsing a RetrieveTerrainResponse of SERIALIZED_TILES tiles, with and without
+    packing.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        service = PersistenceService(
+            f"sqlite:///{directory}/bench.db", cache_max_entries=0
+        )
+        terrain_id = service.StoreTerrain(
+            StoreTerrainRequest(tiles=_tiles(SERIALIZED_TILES)), MagicMock()
+        ).terrain_id
+        responses = {
+            label: service.RetrieveTerrain(
+                RetrieveTerrainRequest(terrain_id=terrain_id, packed=packed),
+                MagicMock(),
+            )
+            for label, packed in (("tiles", False), ("packed", True))
+        }
+        service.engine.dispose()
+    for label, response in responses.items():
+        payload = response.SerializeToString()
+        yield Metric(
+            f"serialize_response[{label}]",
+            best_time(response.SerializeToString, REPEATS, SERIALIZATION_CALLS),
+            "s",
+        )
+        yield Metric(
+            f"parse_response[{label}]",
+            best_time(
+                lambda: RetrieveTerrainResponse.FromString(payload),
+                REPEATS,
+                SERIALIZATION_CALLS,
+            ),
+            "s",
+        )
+        yield Metric(f"response_size[{label}]", len(payload), "bytes")
+
+
+BENCHMARKS = {
+    "store_terrain": bench_store_terrain,
+    "retrieve_terrain": bench_retrieve_terrain,
+    "response_serialization": bench_response_serialization,
+}
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    sys.exit(run_suite(__doc__.split("\n")[2], BENCHMARKS, BASELINE))
@@ -1,14 +1,34 @@
+import asyncio
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from unittest.mock import MagicMock, patch
-from persistence.persistence_service import PersistenceService
+from persistence.persistence_service import PersistenceService, AsyncPersistenceService
+from persistence.schema_migrations import DuplicateTilesError, migrate, MIGRATIONS
+from persistence.storage import BlobTerrainStore, RelationalTerrainStore, TerrainBlob, TerrainBlobChunk, create_store
+import persistence.persistence_pb2_grpc as persistence_pb2_grpc
 from persistence.persistence_pb2 import (
     TerrainTile,
     StoreTerrainRequest,
+    StoreTerrainAtomicRequest,
+    StoreTerrainBatchRequest,
+    StoreTerrainChunk,
+    UpdateTilesRequest,
+    TileChange,
     RetrieveTerrainRequest,
+    RetrieveTerrainRegionRequest,
+    HexRange,
     BeginTransactionRequest,
     CommitTransactionRequest,
     RollbackTransactionRequest,
+    CacheStatsRequest,
 )
+from common.metrics import start_metrics_server
+from common.metrics_interceptor import AsyncMetricsInterceptor, MetricsInterceptor
+from common.tile_arrays import TileArrays
+from sqlalchemy import create_engine, event, select, text
 import grpc
 
 @pytest.fixture(scope='module')
@@ -230,10 +250,766 @@ def test_store_terrain_error_handling(persistence_service):
     # Mock the session to raise an exception during commit
     with patch.object(persistence_service, 'DbSession', autospec=True) as mock_session:
         mock_session.return_value.commit.side_effect = Exception("Simulated database error")
+        mock_session.return_value.__enter__.return_value.commit.side_effect = Exception("Simulated database error")
 
         response = persistence_service.StoreTerrain(request, mock_context)
 
         # Verify that the error was handled
         mock_context.set_code.assert_called_once_with(grpc.StatusCode.INTERNAL)
         mock_context.set_details.assert_called_once_with('Failed to store terrain')
-        assert not response.success
\ No newline at end of file
+        assert not response.success
+
+def test_retrieve_terrain_packed(persistence_service):
+    """
+    @test Retrieve Terrain Packed
+    Tests retrieving stored terrain tiles in the packed columnar encoding.
+    
+    @pre Terrain tiles are stored and a valid terrain ID is available
+    @post The packed columns decode to the stored tiles, with their IDs
+    """
+    tiles = [
+        TerrainTile(x=1, y=-1, terrain_type="Mountain"),
+        TerrainTile(x=2, y=2, terrain_type="Forest"),
+        TerrainTile(x=-3, y=0, terrain_type="Mountain")
+    ]
+    store_response = persistence_service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock())
+    request = RetrieveTerrainRequest(terrain_id=store_response.terrain_id, packed=True)
+    response = persistence_service.RetrieveTerrain(request, MagicMock())
+    assert len(response.tiles) == 0
+    decoded = TileArrays.from_packed(response.packed_tiles)
+    assert sorted((tile.x, tile.y, tile.terrain_type) for tile in decoded) == \
+        sorted((tile.x, tile.y, tile.terrain_type) for tile in tiles)
+    assert len(set(response.packed_tiles.ids)) == 3
+    assert sorted(response.packed_tiles.terrain_types) == ["Forest", "Mountain"]
+
+def test_async_persistence_service():
+    """
+    @test Async Persistence Service
+    Tests serving the persistence service from a grpc.aio server with more requests in flight than executor threads.
+    
+    @pre An AsyncPersistenceService with two executor threads and room for one open transaction is served on a local grpc.aio server
+    @post Concurrent stores through a grpc.aio stub all succeed, a second open transaction is refused, and a transaction round trip works
+    """
+    async def run():
+        service = AsyncPersistenceService(executor_workers=2, max_open_transactions=1)
+        server = grpc.aio.server()
+        persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(service, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                stub = persistence_pb2_grpc.PersistenceServiceStub(channel)
+                tiles = [TerrainTile(x=i, y=-i, terrain_type="Plains") for i in range(10)]
+                responses = await asyncio.gather(
+                    *(stub.StoreTerrain(StoreTerrainRequest(tiles=tiles)) for _ in range(30))
+                )
+                assert all(response.success for response in responses)
+                assert len({response.terrain_id for response in responses}) == 30
+
+                begin_response = await stub.BeginTransaction(BeginTransactionRequest())
+                with pytest.raises(grpc.aio.AioRpcError) as error:
+                    await stub.BeginTransaction(BeginTransactionRequest())
+                assert error.value.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+                await stub.CommitTransaction(CommitTransactionRequest(transaction_id=begin_response.transaction_id))
+                retrieve_response = await stub.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=responses[0].terrain_id))
+                assert len(retrieve_response.tiles) == 10
+                chunks = [chunk async for chunk in stub.RetrieveTerrainStream(
+                    RetrieveTerrainRequest(terrain_id=responses[0].terrain_id, chunk_size=4))]
+                assert [len(chunk.tiles) for chunk in chunks] == [4, 4, 2]
+        finally:
+            await server.stop(None)
+            service.close()
+
+    asyncio.run(run())
+
+def test_store_terrain_bulk(persistence_service):
+    """
+    @test Store Terrain Bulk
+    Tests that storing and updating tiles takes a fixed number of statements rather than one per tile.
+    
+    @pre PersistenceService is initialized
+    @post Tile IDs are returned in request order, updates are applied, and the statement count does not grow with the tile count
+    """
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(persistence_service.engine, 'before_cursor_execute', count)
+    try:
+        tiles = [TerrainTile(x=i, y=i % 7, terrain_type="Plains") for i in range(2000)]
+        response = persistence_service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock())
+        assert response.success
+        assert len(response.tile_ids) == 2000
+        assert list(response.tile_ids) == sorted(response.tile_ids)
+        assert len(statements) < 10
+
+        statements.clear()
+        updates = [TerrainTile(id=tile_id, x=-i - 1, y=-1, terrain_type="Lake")
+                   for i, tile_id in enumerate(response.tile_ids[:1500])]
+        mixed = updates + [TerrainTile(x=5, y=5, terrain_type="Hills")]
+        update_response = persistence_service.StoreTerrain(StoreTerrainRequest(tiles=mixed), MagicMock())
+        assert update_response.success
+        assert list(update_response.tile_ids[:1500]) == list(response.tile_ids[:1500])
+        assert update_response.tile_ids[1500] > response.tile_ids[-1]
+        assert len(statements) < 15
+    finally:
+        event.remove(persistence_service.engine, 'before_cursor_execute', count)
+
+    retrieve_response = persistence_service.RetrieveTerrain(
+        RetrieveTerrainRequest(terrain_id=response.terrain_id), MagicMock())
+    assert sorted(tile.terrain_type for tile in retrieve_response.tiles).count("Lake") == 1500
+
+def test_store_terrain_update_missing_tile(persistence_service):
+    """
+    @test Store Terrain Update Missing Tile
+    Tests that updating a tile that does not exist fails without storing anything.
+    
+    @pre PersistenceService is initialized
+    @post The gRPC context is set with NOT_FOUND status code and the request's new tiles are not stored
+    """
+    request = StoreTerrainRequest(tiles=[
+        TerrainTile(x=1, y=1, terrain_type="Mountain"),
+        TerrainTile(id=2 ** 31 - 1, x=2, y=2, terrain_type="Forest")
+    ])
+    mock_context = MagicMock()
+    response = persistence_service.StoreTerrain(request, mock_context)
+    assert not response.success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    mock_context.set_details.assert_called_once_with(f"Tile with ID {2 ** 31 - 1} not found for update")
+
+def test_schema_migration(tmp_path):
+    """
+    @test Schema Migration
+    Tests migrating a database created before schema versioning.
+    
+    @pre A database has an unindexed terrain_tiles table holding a duplicated coordinate
+    @post Migrating fails without changes until duplicate removal is allowed, then the database is at the latest version, the duplicate is moved to a side table, retrieval uses the index, the stored terrain has a version, and migrating again changes nothing
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE terrain_tiles (id INTEGER NOT NULL PRIMARY KEY, x INTEGER, "
+                                "y INTEGER, terrain_type VARCHAR(50), terrain_id VARCHAR(50))"))
+        connection.execute(text("INSERT INTO terrain_tiles (x, y, terrain_type, terrain_id) VALUES "
+                                "(0, 0, 'lake', 't'), (0, 0, 'hills', 't'), (1, 0, 'lake', 't')"))
+
+    latest = MIGRATIONS[-1][0]
+    with pytest.raises(DuplicateTilesError, match="--remove-duplicate-tiles"):
+        migrate(engine)
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM terrain_tiles")).scalar() == 3
+        assert connection.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar() is None
+    assert migrate(engine, remove_duplicate_tiles=True) == latest
+    assert migrate(engine) == latest
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT x, y, terrain_type FROM terrain_tiles ORDER BY x")).all()
+        assert [tuple(row) for row in rows] == [(0, 0, 'hills'), (1, 0, 'lake')]
+        removed = connection.execute(text("SELECT x, y, terrain_type FROM terrain_tiles_duplicates")).all()
+        assert [tuple(row) for row in removed] == [(0, 0, 'lake')]
+        versions = connection.execute(text("SELECT version FROM schema_migrations")).scalars().all()
+        assert versions == [version for version, _, _ in MIGRATIONS]
+        plan = connection.execute(text("EXPLAIN QUERY PLAN SELECT * FROM terrain_tiles WHERE terrain_id = 't'")).all()
+        assert 'ix_terrain_tiles_terrain_coords' in str(plan)
+        assert connection.execute(text("SELECT terrain_id, version FROM terrain_versions")).all() == [('t', 1)]
+
+    service = PersistenceService(f"sqlite:///{tmp_path / 'legacy.db'}")
+    tiles = [TerrainTile(x=0, y=0, terrain_type="Forest"), TerrainTile(x=0, y=0, terrain_type="Forest")]
+    mock_context = MagicMock()
+    assert not service.StoreTerrain(StoreTerrainRequest(tiles=tiles), mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.INTERNAL)
+
+def test_retrieve_terrain_concurrent():
+    """
+    @test Retrieve Terrain Concurrently
+    Tests that retrievals run concurrently, each in its own session, and that no session is left open.
+    
+    @pre Terrain tiles are stored by a PersistenceService without a response cache
+    @post Concurrent retrievals all return the terrain, and every session opened, including on NOT_FOUND, is closed
+    """
+    persistence_service = PersistenceService(cache_max_entries=0)
+    tiles = [TerrainTile(x=i, y=0, terrain_type="Desert") for i in range(500)]
+    terrain_id = persistence_service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock()).terrain_id
+    sessions = []
+    session_factory = persistence_service.DbSession
+    def open_session():
+        session = session_factory()
+        sessions.append(session)
+        return session
+
+    with patch.object(persistence_service, 'DbSession', side_effect=open_session):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            requests = [RetrieveTerrainRequest(terrain_id=terrain_id)] * 16 + [RetrieveTerrainRequest(terrain_id="missing")]
+            responses = list(executor.map(lambda request: persistence_service.RetrieveTerrain(request, MagicMock()), requests))
+    assert [len(response.tiles) for response in responses] == [500] * 16 + [0]
+    assert len(set(map(id, sessions))) == 17
+    assert all(not session.in_transaction() for session in sessions)
+
+def test_retrieve_terrain_stream(persistence_service):
+    """
+    @test Retrieve Terrain Stream
+    Tests streaming a stored terrain in chunks.
+    
+    @pre Terrain tiles are stored and a valid terrain ID is available
+    @post The terrain arrives in chunks of at most chunk_size tiles, in packed or unpacked form, and a missing terrain is NOT_FOUND
+    """
+    tiles = [TerrainTile(x=i % 50, y=i // 50, terrain_type="Lake" if i % 3 else "Hills") for i in range(2500)]
+    terrain_id = persistence_service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock()).terrain_id
+    expected = sorted((tile.x, tile.y, tile.terrain_type) for tile in tiles)
+
+    request = RetrieveTerrainRequest(terrain_id=terrain_id, chunk_size=1000)
+    chunks = list(persistence_service.RetrieveTerrainStream(request, MagicMock()))
+    assert [len(chunk.tiles) for chunk in chunks] == [1000, 1000, 500]
+    assert [(tile.x, tile.y, tile.terrain_type) for chunk in chunks for tile in chunk.tiles] == expected
+
+    request = RetrieveTerrainRequest(terrain_id=terrain_id, chunk_size=1000, packed=True)
+    chunks = list(persistence_service.RetrieveTerrainStream(request, MagicMock()))
+    decoded = [(tile.x, tile.y, tile.terrain_type) for chunk in chunks for tile in TileArrays.from_packed(chunk.packed_tiles)]
+    assert decoded == expected
+
+    mock_context = MagicMock()
+    assert list(persistence_service.RetrieveTerrainStream(RetrieveTerrainRequest(terrain_id="missing"), mock_context)) == []
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+
+def test_retrieve_terrain_cache(persistence_service):
+    """
+    @test Retrieve Terrain Cache
+    Tests that repeated retrievals are served from the response cache until a write invalidates it.
+    
+    @pre Terrain tiles are stored in a committed transaction
+    @post Repeats are cache hits that skip the database, and updates and commits invalidate the terrain's entries
+    """
+    begin_response = persistence_service.BeginTransaction(BeginTransactionRequest(), MagicMock())
+    transaction_id = begin_response.transaction_id
+    tiles = [TerrainTile(x=i, y=1, terrain_type="Forest") for i in range(20)]
+    store_response = persistence_service.StoreTerrain(
+        StoreTerrainRequest(tiles=tiles, transaction_id=transaction_id), MagicMock())
+    persistence_service.CommitTransaction(CommitTransactionRequest(transaction_id=transaction_id), MagicMock())
+    request = RetrieveTerrainRequest(terrain_id=store_response.terrain_id)
+    before = persistence_service.GetCacheStats(CacheStatsRequest(), MagicMock())
+
+    first = persistence_service.RetrieveTerrain(request, MagicMock())
+    with patch.object(persistence_service, 'DbSession') as mock_session:
+        second = persistence_service.RetrieveTerrain(request, MagicMock())
+        mock_session.assert_not_called()
+    assert second == first
+    stats = persistence_service.GetCacheStats(CacheStatsRequest(), MagicMock())
+    assert (stats.hits - before.hits, stats.misses - before.misses) == (1, 1)
+    assert 0 < stats.hit_ratio <= 1
+    assert stats.bytes >= first.ByteSize()
+
+    # An update through StoreTerrain invalidates the terrain
+    update = TerrainTile(id=store_response.tile_ids[0], x=0, y=1, terrain_type="Lake")
+    persistence_service.StoreTerrain(StoreTerrainRequest(tiles=[update]), MagicMock())
+    assert (request.terrain_id, False) not in persistence_service.response_cache
+    updated = persistence_service.RetrieveTerrain(request, MagicMock())
+    assert [tile.terrain_type for tile in updated.tiles].count("Lake") == 1
+
+    # So does committing a transaction that wrote to it, but not the uncommitted write
+    transaction_id = persistence_service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    update = TerrainTile(id=store_response.tile_ids[1], x=1, y=1, terrain_type="Lake")
+    persistence_service.StoreTerrain(StoreTerrainRequest(tiles=[update], transaction_id=transaction_id), MagicMock())
+    assert (request.terrain_id, False) in persistence_service.response_cache
+    persistence_service.CommitTransaction(CommitTransactionRequest(transaction_id=transaction_id), MagicMock())
+    assert (request.terrain_id, False) not in persistence_service.response_cache
+
+def test_retrieve_terrain_cache_eviction():
+    """
+    @test Retrieve Terrain Cache Eviction
+    Tests that the response cache stays within its byte budget by evicting the least recently used terrain.
+    
+    @pre A PersistenceService with a small response cache
+    @post Evictions are counted and the cache holds no more than its budget
+    """
+    service = PersistenceService(cache_max_bytes=4000)
+    for _ in range(3):
+        tiles = [TerrainTile(x=i, y=2, terrain_type="Plains") for i in range(100)]
+        terrain_id = service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock()).terrain_id
+        service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=terrain_id), MagicMock())
+    stats = service.GetCacheStats(CacheStatsRequest(), MagicMock())
+    assert stats.evictions >= 1
+    assert stats.bytes <= 4000
+    assert stats.entries == len(service.response_cache)
+
+def test_blob_store(tmp_path):
+    """
+    @test Blob Store
+    Tests storing, updating and retrieving terrains through the blob storage backend.
+    
+    @pre A PersistenceService using the blob backend with small chunks
+    @post Tiles round-trip in every form grouped into chunks by cell, a point update rewrites only its chunk, and a missing tile is NOT_FOUND
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'blob.db'}", storage_backend='blob')
+    assert isinstance(service.store, BlobTerrainStore)
+    service.store.chunk_tiles = 100
+    tiles = [TerrainTile(x=i % 25, y=i // 25, terrain_type=("Lake", "Hills", "Forest")[i % 3]) for i in range(250)]
+    response = service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock())
+    assert response.success and len(set(response.tile_ids)) == 250
+    other = service.StoreTerrain(StoreTerrainRequest(tiles=tiles[:10]), MagicMock())
+    expected = sorted((tile.x, tile.y, tile.terrain_type) for tile in tiles)
+
+    retrieved = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=response.terrain_id), MagicMock())
+    assert sorted((tile.x, tile.y, tile.terrain_type) for tile in retrieved.tiles) == expected
+    packed = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=response.terrain_id, packed=True), MagicMock())
+    decoded = TileArrays.from_packed(packed.packed_tiles)
+    # Loaded cell by cell: the 10x10 cells with x < 10, 10 <= x < 20 and x >= 20
+    assert [tile.x // 10 for tile in decoded] == [0] * 100 + [1] * 100 + [2] * 50
+    assert {tile.id: (tile.x, tile.y, tile.terrain_type) for tile in decoded} == \
+        {tile_id: (tile.x, tile.y, tile.terrain_type) for tile_id, tile in zip(response.tile_ids, tiles)}
+    chunks = list(service.RetrieveTerrainStream(
+        RetrieveTerrainRequest(terrain_id=response.terrain_id, chunk_size=60), MagicMock()))
+    assert [len(chunk.tiles) for chunk in chunks] == [60, 60, 60, 60, 10]
+
+    update = TerrainTile(id=response.tile_ids[120], x=100, y=100, terrain_type="Desert")
+    assert service.StoreTerrain(StoreTerrainRequest(tiles=[update]), MagicMock()).success
+    with service.DbSession() as session:
+        versions = session.scalars(select(TerrainBlobChunk.version)
+                                   .where(TerrainBlobChunk.terrain_id == response.terrain_id)
+                                   .order_by(TerrainBlobChunk.chunk_index)).all()
+        assert versions == [1, 1, 2]
+        assert session.get(TerrainBlob, response.terrain_id).version == 2
+    packed = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=response.terrain_id, packed=True), MagicMock())
+    decoded = {tile.id: tile for tile in TileArrays.from_packed(packed.packed_tiles)}
+    assert decoded[response.tile_ids[120]][:3] == (100, 100, "Desert")
+    assert len(service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=other.terrain_id), MagicMock()).tiles) == 10
+
+    mock_context = MagicMock()
+    missing = TerrainTile(id=response.tile_ids[-1] + 1000, x=0, y=0, terrain_type="Lake")
+    assert not service.StoreTerrain(StoreTerrainRequest(tiles=[missing]), mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+
+def test_create_store():
+    """
+    @test Create Store
+    Tests selecting a storage backend by name.
+    
+    @pre None
+    @post Known names give their backend and an unknown name raises ValueError
+    """
+    assert isinstance(create_store('relational'), RelationalTerrainStore)
+    assert isinstance(create_store(' Blob '), BlobTerrainStore)
+    with pytest.raises(ValueError):
+        create_store('columnar')
+
+def test_transaction_isolation(tmp_path):
+    """
+    @test Transaction Isolation
+    Tests that writes carrying a transaction ID go through the transaction's session.
+    
+    @pre A PersistenceService on an empty database
+    @post Writes are invisible until committed, a rollback discards them, and unknown transactions are NOT_FOUND
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'transactions.db'}")
+    tiles = [TerrainTile(x=i, y=0, terrain_type="Hills") for i in range(10)]
+
+    transaction_id = service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    response = service.StoreTerrain(StoreTerrainRequest(tiles=tiles, transaction_id=transaction_id), MagicMock())
+    assert response.success and response.terrain_id == transaction_id
+    update = TerrainTile(id=response.tile_ids[0], x=0, y=0, terrain_type="Lake")
+    assert service.StoreTerrain(StoreTerrainRequest(tiles=[update], transaction_id=transaction_id), MagicMock()).success
+    mock_context = MagicMock()
+    service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=transaction_id), mock_context)
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    service.CommitTransaction(CommitTransactionRequest(transaction_id=transaction_id), MagicMock())
+    retrieved = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=transaction_id), MagicMock())
+    assert [tile.terrain_type for tile in retrieved.tiles].count("Lake") == 1
+
+    transaction_id = service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    service.StoreTerrain(StoreTerrainRequest(tiles=tiles, transaction_id=transaction_id), MagicMock())
+    service.RollbackTransaction(RollbackTransactionRequest(transaction_id=transaction_id), MagicMock())
+    with service.engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM terrain_tiles")).scalar() == 10
+
+    mock_context = MagicMock()
+    assert not service.StoreTerrain(StoreTerrainRequest(tiles=tiles, transaction_id="unknown"), mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    service.close()
+
+def test_transaction_reaper_and_bound():
+    """
+    @test Transaction Reaper and Bound
+    Tests that idle transactions are rolled back and that the transaction table stays bounded.
+    
+    @pre A PersistenceService allowing two open transactions
+    @post A third transaction is RESOURCE_EXHAUSTED, unknown IDs add no entries, idle transactions are reaped, and the background reaper runs
+    """
+    service = PersistenceService(transaction_idle_timeout=60, max_open_transactions=2)
+    first = service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    second = service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    mock_context = MagicMock()
+    assert not service.BeginTransaction(BeginTransactionRequest(), mock_context).transaction_id
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.RESOURCE_EXHAUSTED)
+    for _ in range(100):
+        service.CommitTransaction(CommitTransactionRequest(transaction_id=str(uuid.uuid4())), MagicMock())
+    assert set(service.transactions) == {first, second}
+
+    service.transactions[second].last_used += 30
+    assert service.reap_idle_transactions() == 0
+    assert service.reap_idle_transactions(now=time.monotonic() + 61) == 1
+    assert set(service.transactions) == {second}
+    mock_context = MagicMock()
+    service.CommitTransaction(CommitTransactionRequest(transaction_id=first), mock_context)
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    service.close()
+    assert not service.transactions
+
+    service = PersistenceService(transaction_idle_timeout=0.05)
+    service.BeginTransaction(BeginTransactionRequest(), MagicMock())
+    deadline = time.monotonic() + 5
+    while service.transactions and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not service.transactions
+    service.close()
+
+@pytest.mark.parametrize('storage_backend', ['relational', 'blob'])
+def test_store_terrain_atomic(tmp_path, storage_backend):
+    """
+    @test Store Terrain Atomic
+    Tests storing packed tiles as a committed terrain in one call.
+    
+    @pre A PersistenceService using the given storage backend
+    @post The tiles are retrievable at once, tile IDs are returned only on request, a retry under the stored ID returns the same tile IDs, another terrain under it is refused, and a failed store leaves nothing behind
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'atomic.db'}", storage_backend=storage_backend)
+    tiles = TileArrays.from_tiles(TerrainTile(x=i, y=-i, terrain_type=("Lake", "Desert")[i % 2]) for i in range(50))
+    request = StoreTerrainAtomicRequest()
+    tiles.fill_packed(request.packed_tiles)
+    response = service.StoreTerrainAtomic(request, MagicMock())
+    assert response.success and not response.tile_ids
+    retrieved = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=response.terrain_id), MagicMock())
+    assert sorted((tile.x, tile.y, tile.terrain_type) for tile in retrieved.tiles) == \
+        sorted((tile.x, tile.y, tile.terrain_type) for tile in tiles)
+
+    request.return_tile_ids = True
+    response = service.StoreTerrainAtomic(request, MagicMock())
+    assert len(set(response.tile_ids)) == 50
+
+    # A retry whose first response was lost writes nothing but still returns the tile IDs
+    request.terrain_id = response.terrain_id
+    retried = service.StoreTerrainAtomic(request, MagicMock())
+    assert retried.success and retried.tile_ids == response.tile_ids
+    assert len(service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=response.terrain_id), MagicMock()).tiles) == 50
+    other = StoreTerrainAtomicRequest(terrain_id=response.terrain_id, return_tile_ids=True)
+    TileArrays.from_tiles([TerrainTile(x=100, y=0, terrain_type="Lake")]).fill_packed(other.packed_tiles)
+    mock_context = MagicMock()
+    assert not service.StoreTerrainAtomic(other, mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.ALREADY_EXISTS)
+    request.terrain_id = ""
+
+    # An update of a missing tile fails the whole request
+    request.packed_tiles.ids.extend([0] * 49 + [2 ** 31 - 1])
+    mock_context = MagicMock()
+    assert not service.StoreTerrainAtomic(request, mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+
+    request = StoreTerrainAtomicRequest()
+    request.packed_tiles.x.extend([1, 2])
+    request.packed_tiles.y.append(1)
+    request.packed_tiles.terrain_codes = bytes(2)
+    request.packed_tiles.terrain_types.append("Lake")
+    mock_context = MagicMock()
+    assert not service.StoreTerrainAtomic(request, mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+    service.close()
+
+def test_store_terrain_batch(tmp_path):
+    """
+    @test Store Terrain Batch
+    Tests storing several terrains with one commit under caller-chosen IDs.
+    
+    @pre A PersistenceService on an empty database
+    @post Every terrain is stored under its ID, storing an existing ID again writes nothing, and a failing batch stores none of its terrains
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'batch.db'}")
+    requests = []
+    for index in range(3):
+        request = StoreTerrainAtomicRequest(terrain_id=f"terrain-{index}")
+        TileArrays.from_tiles(TerrainTile(x=i, y=index, terrain_type="Plains") for i in range(10)) \
+            .fill_packed(request.packed_tiles)
+        requests.append(request)
+    response = service.StoreTerrainBatch(StoreTerrainBatchRequest(terrains=requests), MagicMock())
+    assert [terrain.terrain_id for terrain in response.terrains] == ["terrain-0", "terrain-1", "terrain-2"]
+    assert service.StoreTerrainBatch(StoreTerrainBatchRequest(terrains=requests), MagicMock()).terrains[0].success
+
+    bad = StoreTerrainAtomicRequest(terrain_id="terrain-bad")
+    bad.packed_tiles.x.append(0)
+    bad.packed_tiles.y.append(0)
+    bad.packed_tiles.terrain_codes = bytes(1)
+    bad.packed_tiles.terrain_types.append("Plains")
+    bad.packed_tiles.ids.append(2 ** 31 - 1)
+    new = StoreTerrainAtomicRequest(terrain_id="terrain-new")
+    new.CopyFrom(requests[0])
+    new.terrain_id = "terrain-new"
+    mock_context = MagicMock()
+    assert not service.StoreTerrainBatch(StoreTerrainBatchRequest(terrains=[new, bad]), mock_context).terrains
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    with service.engine.connect() as connection:
+        counts = connection.execute(text("SELECT terrain_id, COUNT(*) FROM terrain_tiles GROUP BY terrain_id")).all()
+    assert sorted(map(tuple, counts)) == [("terrain-0", 10), ("terrain-1", 10), ("terrain-2", 10)]
+    service.close()
+
+@pytest.mark.parametrize('storage_backend', ['relational', 'blob'])
+def test_store_terrain_stream(tmp_path, storage_backend):
+    """
+    @test Store Terrain Stream
+    Tests uploading a terrain as a stream of packed chunks, both directly and through a grpc.aio server.
+    
+    @pre A PersistenceService using the given storage backend
+    @post The tiles of all chunks are stored under one terrain with contiguous ID ranges, a known terrain ID writes nothing but returns the stored IDs or is refused for other tiles, and a bad chunk or an empty stream stores nothing
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'stream.db'}", storage_backend=storage_backend)
+
+    def chunks(terrain_id="", count=3, size=20):
+        for index in range(count):
+            chunk = StoreTerrainChunk(terrain_id=terrain_id if index == 0 else "")
+            TileArrays.from_tiles(TerrainTile(x=i, y=index, terrain_type=("Lake", "Hills")[i % 2])
+                                  for i in range(size)).fill_packed(chunk.packed_tiles)
+            yield chunk
+
+    response = service.StoreTerrainStream(chunks("streamed"), MagicMock())
+    assert response.success and response.terrain_id == "streamed" and response.tile_count == 60
+    assert sum(id_range.count for id_range in response.tile_id_ranges) == 60
+    retrieved = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id="streamed"), MagicMock())
+    assert sorted((tile.x, tile.y) for tile in retrieved.tiles) == [(x, y) for x in range(20) for y in range(3)]
+    packed = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id="streamed", packed=True), MagicMock())
+    assert sorted(packed.packed_tiles.ids) == sorted(
+        id_range.first_id + i for id_range in response.tile_id_ranges for i in range(id_range.count))
+
+    # A retried upload of a stored terrain writes nothing but returns the same IDs
+    retried = service.StoreTerrainStream(chunks("streamed"), MagicMock())
+    assert retried.success and retried.tile_count == 60
+    assert retried.tile_id_ranges == response.tile_id_ranges
+    assert len(service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id="streamed"), MagicMock()).tiles) == 60
+    mock_context = MagicMock()
+    assert not service.StoreTerrainStream(chunks("streamed", count=4), mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.ALREADY_EXISTS)
+
+    bad = StoreTerrainChunk()
+    bad.packed_tiles.x.extend([1, 2])
+    bad.packed_tiles.y.append(1)
+    mock_context = MagicMock()
+    response = service.StoreTerrainStream(iter([*chunks("broken", count=1), bad]), mock_context)
+    assert not response.success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+    assert not service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id="broken"), MagicMock()).tiles
+
+    mock_context = MagicMock()
+    response = service.StoreTerrainStream(iter([]), mock_context)
+    assert not response.success and not response.terrain_id
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+    mock_context.set_details.assert_called_once_with('Empty terrain stream')
+    service.close()
+
+    async def run():
+        async_service = AsyncPersistenceService(executor_workers=2, database_url=f"sqlite:///{tmp_path / 'aio.db'}",
+                                                storage_backend=storage_backend)
+        server = grpc.aio.server()
+        persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(async_service, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                stub = persistence_pb2_grpc.PersistenceServiceStub(channel)
+                response = await stub.StoreTerrainStream(chunks(count=4, size=5))
+                assert response.success and response.terrain_id and response.tile_count == 20
+        finally:
+            await server.stop(None)
+            async_service.close()
+
+    asyncio.run(run())
+
+@pytest.mark.parametrize('storage_backend', ['relational', 'blob'])
+def test_retrieve_terrain_region(tmp_path, storage_backend):
+    """
+    @test Retrieve Terrain Region
+    Tests retrieving the tiles of a terrain inside a box of coordinates and within a hex range.
+    
+    @pre A PersistenceService using the given storage backend, with small blob chunks, holding a 40x40 terrain
+    @post Exactly the tiles in the region are returned, moved tiles are found at their new place, chunks without bounds are still read, and bad regions are rejected
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'region.db'}", storage_backend=storage_backend)
+    service.store.chunk_tiles = 64
+    tiles = [TerrainTile(x=x, y=y, terrain_type=("Lake", "Hills", "Forest")[(x + y) % 3])
+             for x in range(-20, 20) for y in range(-20, 20)]
+    response = service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock())
+
+    def region(**kwargs):
+        request = RetrieveTerrainRegionRequest(terrain_id=response.terrain_id, packed=True, **kwargs)
+        packed = service.RetrieveTerrainRegion(request, MagicMock()).packed_tiles
+        return sorted((tile.x, tile.y, tile.terrain_type) for tile in TileArrays.from_packed(packed))
+
+    def expected(inside):
+        return sorted((tile.x, tile.y, tile.terrain_type) for tile in tiles if inside(tile.x, tile.y))
+
+    assert region(min_x=-3, max_x=5, min_y=2, max_y=11) == expected(lambda x, y: -3 <= x <= 5 and 2 <= y <= 11)
+    assert region(min_x=19, max_x=30, min_y=-20, max_y=-20) == [(19, -20, "Forest")]
+    assert region(min_x=50, max_x=60, min_y=0, max_y=10) == []
+    assert region(min_x=-1000, max_x=1000, min_y=-2, max_y=-2) == expected(lambda x, y: y == -2)
+    assert region(hex_range=HexRange(center_x=2, center_y=-1, radius=4)) == \
+        expected(lambda x, y: max(abs(x - 2), abs(y + 1), abs(x + y - 1)) <= 4)
+    assert region(hex_range=HexRange(center_x=0, center_y=0, radius=0)) == [(0, 0, "Lake")]
+
+    moved = TerrainTile(id=response.tile_ids[0], x=100, y=100, terrain_type="Desert")
+    assert service.StoreTerrain(StoreTerrainRequest(tiles=[moved]), MagicMock()).success
+    assert region(min_x=90, max_x=110, min_y=90, max_y=110) == [(100, 100, "Desert")]
+    if storage_backend == 'blob':
+        # Chunks written before schema migration 4 have no bounding box
+        with service.engine.begin() as connection:
+            connection.execute(text("UPDATE terrain_blob_chunks SET min_x = NULL, max_x = NULL, "
+                                    "min_y = NULL, max_y = NULL"))
+        assert region(min_x=-3, max_x=5, min_y=2, max_y=11) == expected(lambda x, y: -3 <= x <= 5 and 2 <= y <= 11)
+
+    mock_context = MagicMock()
+    service.RetrieveTerrainRegion(RetrieveTerrainRegionRequest(terrain_id="missing", max_x=10, max_y=10), mock_context)
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    for request in (RetrieveTerrainRegionRequest(terrain_id=response.terrain_id, min_x=1, max_x=0),
+                    RetrieveTerrainRegionRequest(terrain_id=response.terrain_id, hex_range=HexRange(radius=-1))):
+        mock_context = MagicMock()
+        service.RetrieveTerrainRegion(request, mock_context)
+        mock_context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+    service.close()
+
+@pytest.mark.parametrize('storage_backend', ['relational', 'blob'])
+def test_update_tiles(tmp_path, storage_backend):
+    """
+    @test Update Tiles
+    Tests changing tiles by coordinate, on their own and in a transaction, and the terrain versions reported.
+    
+    @pre A PersistenceService using the given storage backend, with small blob chunks, holding two terrains
+    @post Changes are applied in order and invalidate cached responses, each call increments the version by one, a missing coordinate writes nothing, and transactional changes appear on commit
+    """
+    service = PersistenceService(f"sqlite:///{tmp_path / 'update.db'}", storage_backend=storage_backend)
+    service.store.chunk_tiles = 64
+    tiles = [TerrainTile(x=x, y=y, terrain_type="Plains") for x in range(20) for y in range(20)]
+    terrain_id = service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock()).terrain_id
+    other_id = service.StoreTerrain(StoreTerrainRequest(tiles=tiles), MagicMock()).terrain_id
+
+    def retrieve(terrain):
+        response = service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=terrain), MagicMock())
+        return response.version, {(tile.x, tile.y): tile.terrain_type for tile in response.tiles}
+
+    version, _ = retrieve(terrain_id)
+    assert version >= 1
+    changes = [TileChange(x=3, y=4, terrain_type="Lake"), TileChange(x=19, y=0, terrain_type="Forest"),
+               TileChange(x=3, y=4, terrain_type="Desert")]
+    response = service.UpdateTiles(UpdateTilesRequest(terrain_id=terrain_id, changes=changes), MagicMock())
+    assert response.success and response.version == version + 1
+    new_version, types = retrieve(terrain_id)
+    assert new_version == response.version
+    assert (types[(3, 4)], types[(19, 0)], types[(0, 0)]) == ("Desert", "Forest", "Plains")
+    assert set(retrieve(other_id)[1].values()) == {"Plains"}
+    empty = service.UpdateTiles(UpdateTilesRequest(terrain_id=terrain_id), MagicMock())
+    assert empty.success and empty.version == response.version
+
+    mock_context = MagicMock()
+    missing = [TileChange(x=5, y=5, terrain_type="Lake"), TileChange(x=20, y=0, terrain_type="Lake")]
+    assert not service.UpdateTiles(UpdateTilesRequest(terrain_id=terrain_id, changes=missing), mock_context).success
+    mock_context.set_code.assert_called_once_with(grpc.StatusCode.NOT_FOUND)
+    assert retrieve(terrain_id) == (new_version, types)
+
+    transaction_id = service.BeginTransaction(BeginTransactionRequest(), MagicMock()).transaction_id
+    request = UpdateTilesRequest(terrain_id=terrain_id, changes=missing[:1], transaction_id=transaction_id)
+    assert service.UpdateTiles(request, MagicMock()).version == new_version + 1
+    assert retrieve(terrain_id)[1][(5, 5)] == "Plains"
+    service.CommitTransaction(CommitTransactionRequest(transaction_id=transaction_id), MagicMock())
+    assert retrieve(terrain_id)[0] == new_version + 1
+    assert retrieve(terrain_id)[1][(5, 5)] == "Lake"
+    service.close()
+
+def test_metrics_interceptor(tmp_path):
+    """
+    @test Metrics Interceptor
+    Tests that the metrics interceptors record every RPC of the sync and grpc.aio servers and that the metrics endpoint serves them with the service counters.
+
+    @pre PersistenceService and AsyncPersistenceService served with the metrics interceptors, and a metrics endpoint on a free port
+    @post Request counts by status code, latencies, message sizes, in-flight RPCs, stored tiles and open transactions change by the expected amounts
+    """
+    metrics_server = start_metrics_server(0)
+    url = f'http://127.0.0.1:{metrics_server.server_address[1]}/metrics'
+
+    def scrape():
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            lines = response.read().decode().splitlines()
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in lines if not line.startswith('#')}
+
+    def sample(samples, name, method=None, **labels):
+        if method is not None:
+            labels = {'grpc_service': 'persistence.PersistenceService', 'grpc_method': method, **labels}
+        key = name + ('{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else '')
+        return samples.get(key, 0)
+
+    tiles = [TerrainTile(x=i, y=0, terrain_type="Plains") for i in range(10)]
+    before = scrape()
+    service = PersistenceService(f'sqlite:///{tmp_path}/sync.db')
+    server = grpc.server(ThreadPoolExecutor(max_workers=4), interceptors=[MetricsInterceptor()])
+    persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(service, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+            stub = persistence_pb2_grpc.PersistenceServiceStub(channel)
+            terrain_id = stub.StoreTerrain(StoreTerrainRequest(tiles=tiles)).terrain_id
+            stub.StoreTerrain(StoreTerrainRequest(tiles=tiles))
+            with pytest.raises(grpc.RpcError) as error:
+                stub.RetrieveTerrain(RetrieveTerrainRequest(terrain_id='missing'))
+            assert error.value.code() == grpc.StatusCode.NOT_FOUND
+            assert len(list(stub.RetrieveTerrainStream(RetrieveTerrainRequest(terrain_id=terrain_id,
+                                                                                 chunk_size=4)))) == 3
+            transaction_id = stub.BeginTransaction(BeginTransactionRequest()).transaction_id
+            during = scrape()
+            stub.RollbackTransaction(RollbackTransactionRequest(transaction_id=transaction_id))
+    finally:
+        server.stop(None)
+        service.close()
+
+    after = scrape()
+    assert sample(after, 'grpc_server_started_total', 'StoreTerrain') - sample(before, 'grpc_server_started_total',
+                                                                                'StoreTerrain') == 2
+    assert sample(after, 'grpc_server_handled_total', 'StoreTerrain', grpc_code='OK') - sample(
+        before, 'grpc_server_handled_total', 'StoreTerrain', grpc_code='OK') == 2
+    assert sample(after, 'grpc_server_handled_total', 'RetrieveTerrain', grpc_code='NOT_FOUND') - sample(
+        before, 'grpc_server_handled_total', 'RetrieveTerrain', grpc_code='NOT_FOUND') == 1
+    assert sample(after, 'grpc_server_handling_seconds_count', 'StoreTerrain') - sample(
+        before, 'grpc_server_handling_seconds_count', 'StoreTerrain') == 2
+    assert sample(after, 'grpc_server_handling_seconds_bucket', 'StoreTerrain', le='+Inf') == sample(
+        after, 'grpc_server_handling_seconds_count', 'StoreTerrain')
+    # Each streamed chunk is a response message
+    assert sample(after, 'grpc_server_response_message_bytes_count', 'RetrieveTerrainStream') - sample(
+        before, 'grpc_server_response_message_bytes_count', 'RetrieveTerrainStream') == 3
+    request_bytes = StoreTerrainRequest(tiles=tiles).ByteSize()
+    assert sample(after, 'grpc_server_request_message_bytes_sum', 'StoreTerrain') - sample(
+        before, 'grpc_server_request_message_bytes_sum', 'StoreTerrain') == 2 * request_bytes
+    assert sample(after, 'grpc_server_in_flight_rpcs', 'StoreTerrain') == 0
+    assert sample(after, 'vie_tiles_stored_total') - sample(before, 'vie_tiles_stored_total') == 20
+    assert sample(during, 'vie_transaction_sessions_open') - sample(before, 'vie_transaction_sessions_open') == 1
+    assert sample(after, 'vie_transaction_sessions_open') == sample(before, 'vie_transaction_sessions_open')
+
+    async def run():
+        service = AsyncPersistenceService(executor_workers=2, database_url=f'sqlite:///{tmp_path}/aio.db')
+        server = grpc.aio.server(interceptors=[AsyncMetricsInterceptor()])
+        persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(service, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                stub = persistence_pb2_grpc.PersistenceServiceStub(channel)
+                terrain_id = (await stub.StoreTerrain(StoreTerrainRequest(tiles=tiles))).terrain_id
+                with pytest.raises(grpc.aio.AioRpcError):
+                    await stub.RetrieveTerrainRegion(RetrieveTerrainRegionRequest(terrain_id=terrain_id, min_x=1))
+                chunks = [chunk async for chunk in stub.RetrieveTerrainStream(
+                    RetrieveTerrainRequest(terrain_id=terrain_id, chunk_size=4))]
+                assert len(chunks) == 3
+        finally:
+            await server.stop(None)
+            service.close()
+
+    asyncio.run(run())
+    final = scrape()
+    assert sample(final, 'grpc_server_handled_total', 'StoreTerrain', grpc_code='OK') - sample(
+        after, 'grpc_server_handled_total', 'StoreTerrain', grpc_code='OK') == 1
+    assert sample(final, 'grpc_server_handled_total', 'RetrieveTerrainRegion', grpc_code='INVALID_ARGUMENT') - sample(
+        after, 'grpc_server_handled_total', 'RetrieveTerrainRegion', grpc_code='INVALID_ARGUMENT') == 1
+    assert sample(final, 'grpc_server_handled_total', 'RetrieveTerrainStream', grpc_code='OK') - sample(
+        after, 'grpc_server_handled_total', 'RetrieveTerrainStream', grpc_code='OK') == 1
+    assert sample(final, 'grpc_server_response_message_bytes_count', 'RetrieveTerrainStream') - sample(
+        after, 'grpc_server_response_message_bytes_count', 'RetrieveTerrainStream') == 3
+    assert sample(final, 'grpc_server_in_flight_rpcs', 'RetrieveTerrainStream') == 0
+    metrics_server.shutdown()
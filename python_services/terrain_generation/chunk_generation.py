@@ -0,0 +1,193 @@
+"""
+@file chunk_generation.py
+@brief Lazy generation of fixed-size chunks of an unbounded world.
+
+The world plane is cut into square chunks of axial coordinates by seam lines at every
+multiple of the chunk size, as in parallel generation, except that the seam network is
+unbounded and so cannot be generated up front. Instead each seam is split into
+segments between the points where seam lines cross, and every corner and segment is
+generated from its own seed with a fixed set of neighbours: corners see nothing,
+horizontal segments see their two corners, and vertical segments see their corners
+and the horizontal seam tiles touching them. A chunk interior is generated last with
+all of its surrounding seam tiles in place.
+
+A tile therefore depends only on the world seed and its position, whichever chunks
+were generated before, and every pair of adjacent hexes is seen by one of the two, so
+terrain transitions stay consistent across chunk borders.
+"""
+
+import random
+
+import numpy as np
+
+from terrain_generation.elevation import perlin_noise_2d
+from terrain_generation.parallel_generation import _block_frame, _fill_region
+from terrain_generation.terrain_engine import (
+    HEX_NEIGHBOR_OFFSETS,
+    make_terrain_chooser,
+    noise_offset,
+)
+
+
+class WorldSeams:
+    """
+    @brief Generates and remembers the seam tiles of a world as they are needed.
+    """
+
+    def __init__(self, world_seed, chunk_size, settings, sampler):
+        """
+        @brief Creates an empty seam network.
+
+        @param world_seed The seed of the world.
+        @param chunk_size The side of the square chunks in hexes, at least 2.
+        @param settings The GenerationSettings to generate with.
+        @param sampler The TerrainSampler holding the compiled transition weights.
+        """
+        if chunk_size < 2:
+            raise ValueError("chunk_size must be at least 2")
+        self.world_seed = world_seed
+        self.chunk_size = chunk_size
+        self.settings = settings
+        self.sampler = sampler
+        self.offset = noise_offset(random.Random(world_seed))
+        self.placed = {}
+        self._generated = set()
+
+    def heights(self, xs, ys):
+        """
+        @brief Returns the elevation of each of the given hexes.
+
+        @param xs The x coordinates of the hexes.
+        @param ys The y coordinates of the hexes.
+
+        @return A list of elevations.
+        """
+        scale = self.settings.noise_scale
+        xs = np.asarray(xs, dtype=float) * scale + self.offset[0]
+        ys = np.asarray(ys, dtype=float) * scale + self.offset[1]
+        return perlin_noise_2d(xs, ys).tolist()
+
+    def _chooser(self, kind, x, y):
+        seed = f"{self.world_seed}:{kind}:{x}:{y}"
+        return make_terrain_chooser(self.settings, self.sampler, random.Random(seed))
+
+    def _once(self, key):
+        if key in self._generated:
+            return False
+        self._generated.add(key)
+        return True
+
+    def corner(self, x, y):
+        """
+        @brief Generates the corner where seam lines cross at (x, y).
+        """
+        if self._once(("corner", x, y)):
+            choose = self._chooser("corner", x, y)
+            self.placed[(x, y)] = choose(self.heights([x], [y])[0], [])
+
+    def row(self, low_x, y):
+        """
+        @brief Generates the horizontal segment from (low_x, y) to (low_x + size, y).
+
+        Each tile sees the previous tile of the segment and the corner at either end.
+        """
+        if not self._once(("row", low_x, y)):
+            return
+        high_x = low_x + self.chunk_size
+        self.corner(low_x, y)
+        self.corner(high_x, y)
+        choose = self._chooser("row", low_x, y)
+        xs = range(low_x + 1, high_x)
+        placed = self.placed
+        for x, height in zip(xs, self.heights(xs, [y] * len(xs))):
+            neighbor_codes = [
+                placed[coord] for coord in ((x - 1, y), (x + 1, y)) if coord in placed
+            ]
+            placed[(x, y)] = choose(height, neighbor_codes)
+
+    def column(self, x, low_y):
+        """
+        @brief Generates the vertical segment from (x, low_y) to (x, low_y + size).
+
+        Each tile sees the previous tile of the segment, the corner at either end and
+        the tiles of the two horizontal segments it touches.
+        """
+        if not self._once(("column", x, low_y)):
+            return
+        size = self.chunk_size
+        high_y = low_y + size
+        self.row(x, low_y)
+        self.row(x - size, high_y)
+        choose = self._chooser("column", x, low_y)
+        ys = range(low_y + 1, high_y)
+        placed = self.placed
+        for y, height in zip(ys, self.heights([x] * len(ys), ys)):
+            neighbor_codes = []
+            for dx, dy in HEX_NEIGHBOR_OFFSETS:
+                code = placed.get((x + dx, y + dy))
+                if code is not None:
+                    neighbor_codes.append(code)
+            placed[(x, y)] = choose(height, neighbor_codes)
+
+    def frame(self, chunk_q, chunk_r):
+        """
+        @brief Generates the seams around a chunk.
+
+        @return A dictionary from (x, y) to terrain code of the seam tiles around it.
+        """
+        size = self.chunk_size
+        low_x, low_y = chunk_q * size, chunk_r * size
+        self.row(low_x, low_y)
+        self.row(low_x, low_y + size)
+        self.column(low_x, low_y)
+        self.column(low_x + size, low_y)
+        return {
+            coord: self.placed[coord] for coord in _block_frame(chunk_q, chunk_r, size)
+        }
+
+
+def generate_chunk(world_seed, chunk_q, chunk_r, chunk_size, settings, sampler):
+    """
+    @brief Generates one chunk of a world.
+
+    Chunk (q, r) holds the hexes with q * size <= x < (q + 1) * size and
+    r * size <= y < (r + 1) * size, including the seam tiles on its lower edges.
+
+    @param world_seed The seed of the world.
+    @param chunk_q The chunk's position along the x axis.
+    @param chunk_r The chunk's position along the y axis.
+    @param chunk_size The side of the square chunks in hexes, at least 2.
+    @param settings The GenerationSettings to generate with.
+    @param sampler The TerrainSampler holding the compiled transition weights.
+
+    @return A list of (x, y, terrain_code) tuples ordered by x, then y.
+    """
+    seams = WorldSeams(world_seed, chunk_size, settings, sampler)
+    frame = seams.frame(chunk_q, chunk_r)
+
+    low_x, low_y = chunk_q * chunk_size, chunk_r * chunk_size
+    interior = [
+        (x, y)
+        for x in range(low_x + 1, low_x + chunk_size)
+        for y in range(low_y + 1, low_y + chunk_size)
+    ]
+    xs = [x for x, _ in interior]
+    ys = [y for _, y in interior]
+    codes = _fill_region(
+        (
+            xs,
+            ys,
+            seams.heights(xs, ys),
+            frame,
+            f"{world_seed}:chunk:{chunk_q}:{chunk_r}",
+            settings,
+            sampler,
+        )
+    )
+    tiles = dict(zip(interior, codes))
+    tiles.update(seams.placed)
+    return [
+        (x, y, tiles[(x, y)])
+        for x in range(low_x, low_x + chunk_size)
+        for y in range(low_y, low_y + chunk_size)
+    ]
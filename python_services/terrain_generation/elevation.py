@@ -0,0 +1,113 @@
+"""
+@file elevation.py
+@brief Vectorised Perlin elevation field for terrain generation.
+
+The noise function reproduces noise.pnoise2 with a single octave and its default
+repeat and base, but evaluates a whole array of points in one NumPy pass.
+"""
+
+import numpy as np
+
+# Ken Perlin's reference permutation, doubled so lookups never wrap.
+# fmt: off
+_PERM = np.array(
+    [
+        151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+        140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148,
+        247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32,
+        57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175,
+        74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+        60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+        65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+        200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64,
+        52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212,
+        207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213,
+        119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9,
+        129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104,
+        218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241,
+        81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157,
+        184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93,
+        222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180,
+    ]
+    * 2,
+    dtype=np.intp,
+)
+# fmt: on
+
+# The x and y components of the sixteen gradients noise.pnoise2 selects from.
+_GRAD_X = np.array([1, -1, 1, -1, 1, -1, 1, -1, 0, 0, 0, 0, 1, -1, 0, 0], dtype=float)
+_GRAD_Y = np.array([1, 1, -1, -1, 0, 0, 0, 0, 1, -1, 1, -1, 0, 0, -1, 1], dtype=float)
+
+_REPEAT = 1024
+
+
+def _gradient(hashes, x, y):
+    h = hashes & 15
+    return _GRAD_X[h] * x + _GRAD_Y[h] * y
+
+
+def _lerp(t, a, b):
+    return a + t * (b - a)
+
+
+def perlin_noise_2d(x, y):
+    """
+    @brief Evaluates 2D Perlin noise at every point of the given coordinate arrays.
+
+    @param x Array of x coordinates in noise space.
+    @param y Array of y coordinates in noise space, broadcastable against x.
+
+    @return An array of noise values in roughly [-1, 1].
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    i = np.floor(np.fmod(x, _REPEAT)).astype(np.intp)
+    j = np.floor(np.fmod(y, _REPEAT)).astype(np.intp)
+    ii = np.fmod(i + 1, _REPEAT) & 255
+    jj = np.fmod(j + 1, _REPEAT) & 255
+    i &= 255
+    j &= 255
+
+    x = x - np.floor(x)
+    y = y - np.floor(y)
+    fx = x * x * x * (x * (x * 6 - 15) + 10)
+    fy = y * y * y * (y * (y * 6 - 15) + 10)
+
+    a = _PERM[i]
+    b = _PERM[ii]
+    aa = _PERM[a + j]
+    ab = _PERM[a + jj]
+    ba = _PERM[b + j]
+    bb = _PERM[b + jj]
+
+    return _lerp(
+        fy,
+        _lerp(fx, _gradient(_PERM[aa], x, y), _gradient(_PERM[ba], x - 1, y)),
+        _lerp(fx, _gradient(_PERM[ab], x, y - 1), _gradient(_PERM[bb], x - 1, y - 1)),
+    )
+
+
+class ElevationField:
+    """
+    @brief Elevation of every hex in the square bounding box of an island.
+    """
+
+    def __init__(self, radius, scale, offset=(0.0, 0.0)):
+        """
+        @brief Computes the elevation of every hex with |x| and |y| at most radius.
+
+        @param radius The half width of the bounding box in hexes.
+        @param scale The distance in noise space between adjacent hexes.
+        @param offset The (x, y) position in noise space of the origin hex.
+        """
+        self.radius = radius
+        coords = np.arange(-radius, radius + 1, dtype=float) * scale
+        self.values = perlin_noise_2d(
+            coords[:, np.newaxis] + offset[0], coords[np.newaxis, :] + offset[1]
+        )
+
+    def at(self, x, y):
+        """
+        @brief Returns the elevation of the hex at (x, y).
+        """
+        return self.values[x + self.radius, y + self.radius]
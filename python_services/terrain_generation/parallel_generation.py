@@ -0,0 +1,169 @@
+"""
+@file parallel_generation.py
+@brief Multi-process terrain generation for very large maps.
+
+The island is laid out up front as every hex within its radius, and cut into square
+blocks of axial coordinates by seam lines at every multiple of the block size. Seam
+tiles are generated first in the calling process; the block interiors, which only
+touch each other through seams, are then generated concurrently with the seam tiles
+around them already in place. Every pair of adjacent hexes is therefore seen by the
+one placed second, exactly as in the sequential flood fill, so terrain transitions
+stay consistent across block borders.
+"""
+
+import random
+
+import numpy as np
+
+from terrain_generation.elevation import perlin_noise_2d
+from terrain_generation.terrain_engine import (
+    HEX_NEIGHBOR_OFFSETS,
+    island_radius,
+    make_terrain_chooser,
+    noise_offset,
+)
+
+
+def island_coordinates(total_land_hexagons):
+    """
+    @brief Lays out a contiguous island of hexes around the origin, ring by ring.
+
+    Every ring inside the island radius is complete and the outermost ring is filled
+    partially; each hex of that ring touches the ring inside it, so the island is
+    contiguous.
+
+    @param total_land_hexagons The number of hexes in the island.
+
+    @return A pair of integer arrays with the x and y of each hex, nearest rings first.
+    """
+    radius = island_radius(total_land_hexagons)
+    span = np.arange(-radius, radius + 1)
+    xs, ys = np.meshgrid(span, span, indexing="ij")
+    xs = xs.ravel()
+    ys = ys.ravel()
+    distance = np.maximum(np.maximum(np.abs(xs), np.abs(ys)), np.abs(xs + ys))
+    order = np.argsort(distance, kind="stable")[:total_land_hexagons]
+    return xs[order], ys[order]
+
+
+def _fill_region(task):
+    """
+    @brief Generates the terrain of one block interior; runs in a worker process.
+
+    @param task A tuple of the block's x, y and elevation lists in generation order,
+           the already placed surrounding tiles as a dictionary from (x, y) to terrain
+           code, the block's seed, the GenerationSettings and the TerrainSampler.
+
+    @return The terrain codes of the block's tiles as bytes, in generation order.
+    """
+    xs, ys, heights, placed, region_seed, settings, sampler = task
+    choose = make_terrain_chooser(settings, sampler, random.Random(region_seed))
+    codes = bytearray()
+    for x, y, height in zip(xs, ys, heights):
+        neighbor_codes = []
+        for dx, dy in HEX_NEIGHBOR_OFFSETS:
+            code = placed.get((x + dx, y + dy))
+            if code is not None:
+                neighbor_codes.append(code)
+        code = choose(height, neighbor_codes)
+        placed[(x, y)] = code
+        codes.append(code)
+    return bytes(codes)
+
+
+def _block_frame(block_x, block_y, block_size):
+    """
+    @brief Yields the coordinates of the seam lines surrounding a block.
+    """
+    low_x, low_y = block_x * block_size, block_y * block_size
+    high_x, high_y = low_x + block_size, low_y + block_size
+    for offset in range(block_size + 1):
+        yield low_x + offset, low_y
+        yield low_x + offset, high_y
+        yield low_x, low_y + offset
+        yield high_x, low_y + offset
+
+
+def generate_island_parallel(
+    total_land_hexagons, seed, settings, sampler, executor, block_size=64
+):
+    """
+    @brief Generates a contiguous island, spreading the work over an executor.
+
+    The result depends only on the seed, size, settings and block size, not on the
+    number of workers. It differs from the sequential flood fill for the same seed.
+
+    @param total_land_hexagons The number of hexes to generate.
+    @param seed The seed to generate from.
+    @param settings The GenerationSettings to generate with.
+    @param sampler The TerrainSampler holding the compiled transition weights.
+    @param executor The concurrent.futures executor the block interiors run on.
+    @param block_size The side of the square blocks in hexes.
+
+    @return A list of (x, y, terrain_code) tuples, nearest rings first.
+    """
+    rng = random.Random(seed)
+    offset = noise_offset(rng)
+    xs, ys = island_coordinates(total_land_hexagons)
+    heights = perlin_noise_2d(
+        xs * settings.noise_scale + offset[0], ys * settings.noise_scale + offset[1]
+    )
+    codes = np.zeros(len(xs), dtype=np.uint8)
+    on_seam = (xs % block_size == 0) | (ys % block_size == 0)
+
+    # Generate the seam network sequentially so every block sees its borders
+    choose = make_terrain_chooser(settings, sampler, rng)
+    seam_codes = {}
+    seam_index = np.flatnonzero(on_seam)
+    for index, x, y, height in zip(
+        seam_index.tolist(),
+        xs[seam_index].tolist(),
+        ys[seam_index].tolist(),
+        heights[seam_index].tolist(),
+    ):
+        neighbor_codes = []
+        for dx, dy in HEX_NEIGHBOR_OFFSETS:
+            code = seam_codes.get((x + dx, y + dy))
+            if code is not None:
+                neighbor_codes.append(code)
+        code = choose(height, neighbor_codes)
+        seam_codes[(x, y)] = code
+        codes[index] = code
+
+    # Group the interior tiles by block, keeping generation order within each block
+    interior = np.flatnonzero(~on_seam)
+    block_xs = xs[interior] // block_size
+    block_ys = ys[interior] // block_size
+    order = np.lexsort((block_ys, block_xs))
+    interior, block_xs, block_ys = interior[order], block_xs[order], block_ys[order]
+    boundaries = np.flatnonzero((np.diff(block_xs) != 0) | (np.diff(block_ys) != 0)) + 1
+    blocks = np.split(np.arange(len(interior)), boundaries) if len(interior) else []
+
+    tasks = []
+    block_indices = []
+    for members in blocks:
+        block_x, block_y = int(block_xs[members[0]]), int(block_ys[members[0]])
+        indices = interior[members]
+        frame = {
+            coord: seam_codes[coord]
+            for coord in _block_frame(block_x, block_y, block_size)
+            if coord in seam_codes
+        }
+        tasks.append(
+            (
+                xs[indices].tolist(),
+                ys[indices].tolist(),
+                heights[indices].tolist(),
+                frame,
+                f"{seed}:{block_x}:{block_y}",
+                settings,
+                sampler,
+            )
+        )
+        block_indices.append(indices)
+
+    # Stitch the blocks back into the island
+    for indices, block_codes in zip(block_indices, executor.map(_fill_region, tasks)):
+        codes[indices] = np.frombuffer(block_codes, dtype=np.uint8)
+
+    return list(zip(xs.tolist(), ys.tolist(), codes.tolist()))
@@ -0,0 +1,150 @@
+"""
+@file terrain_engine.py
+@brief Coordinate-indexed hex flood fill used by the terrain generation service.
+"""
+
+import math
+from collections import deque
+from typing import NamedTuple
+
+# Axial offsets of the six neighbours of a hex, in the order they are explored.
+HEX_NEIGHBOR_OFFSETS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, -1), (-1, 1))
+
+TERRAIN_TYPES = ["mountain", "hills", "forest", "plains", "desert", "lake"]
+
+# Distance in noise space between adjacent hexes
+NOISE_SCALE = 0.1
+
+# Elevation thresholds that override the neighbour-weighted terrain choice
+MOUNTAIN_ELEVATION = 0.4
+HILLS_ELEVATION = 0.25
+LAKE_ELEVATION = -0.35
+
+
+class GenerationSettings(NamedTuple):
+    """
+    @brief Parameters that, together with the seed and size, determine a terrain.
+    """
+
+    noise_scale: float = NOISE_SCALE
+    mountain_elevation: float = MOUNTAIN_ELEVATION
+    hills_elevation: float = HILLS_ELEVATION
+    lake_elevation: float = LAKE_ELEVATION
+
+
+def noise_offset(rng):
+    """
+    @brief Draws the position in noise space of an island's origin hex.
+
+    @param rng The random.Random generating the island.
+
+    @return An (x, y) offset within one period of the noise permutation.
+    """
+    return rng.uniform(0, 256), rng.uniform(0, 256)
+
+
+def make_terrain_chooser(settings, sampler, rng):
+    """
+    @brief Builds the function that picks the terrain code of a new hex.
+
+    High and low ground are decided by the elevation thresholds; everything in between
+    is drawn from the transition weights of the already placed neighbours.
+
+    @param settings The GenerationSettings with the elevation thresholds.
+    @param sampler The TerrainSampler holding the compiled transition weights.
+    @param rng The random.Random to draw from.
+
+    @return A function taking the hex's elevation and its placed neighbours' terrain
+            codes and returning the hex's terrain code.
+    """
+    mountain = sampler.codes["mountain"]
+    hills = sampler.codes["hills"]
+    lake = sampler.codes["lake"]
+    all_codes = list(range(len(sampler.terrain_types)))
+    key_weight = sampler.key_weight
+    draw = sampler.draw
+
+    def choose_terrain_code(height, neighbor_codes):
+        if height >= settings.mountain_elevation:
+            return mountain
+        if height >= settings.hills_elevation:
+            return hills
+        if height <= settings.lake_elevation:
+            return lake
+        if not neighbor_codes:
+            return rng.choice(all_codes)
+        code = draw(sum(key_weight[neighbor] for neighbor in neighbor_codes), rng)
+        if code is None:
+            return rng.choice(all_codes)
+        return code
+
+    return choose_terrain_code
+
+
+def island_radius(total_land_hexagons):
+    """
+    @brief Returns the largest hex distance from the origin a flood-filled island reaches.
+
+    The breadth-first fill completes each ring of hexes before starting the next, and
+    the first r rings around the origin hold 3r(r + 1) + 1 hexes.
+
+    @param total_land_hexagons The number of hexes in the island.
+
+    @return The radius, which also bounds |x| and |y| of every tile.
+    """
+    radius = max(0, math.ceil((math.sqrt(12 * total_land_hexagons - 3) - 3) / 6))
+    while 3 * radius * (radius + 1) + 1 < total_land_hexagons:
+        radius += 1
+    return radius
+
+
+def iter_island(total_land_hexagons, choose_terrain_type, origin=(0, 0)):
+    """
+    @brief Grows a contiguous island breadth-first and yields each tile as it is placed.
+
+    Tiles are indexed by their (x, y) coordinate so neighbour lookups are constant
+    time, and each coordinate enters the frontier at most once.
+
+    @param total_land_hexagons The number of hexes to place.
+    @param choose_terrain_type Callable taking the x and y of the new hex and the terrain
+           of its already placed neighbours (possibly empty), and returning the terrain
+           for the new hex. Terrain values may be type names or codes, but not None.
+    @param origin The (x, y) coordinate the island grows from.
+
+    @return An iterator of (x, y, terrain) tuples in generation order.
+    """
+    placed = {}
+    seen = {origin}
+    frontier = deque((origin,))
+    while frontier and len(placed) < total_land_hexagons:
+        x, y = frontier.popleft()
+        neighbor_types = []
+        for dx, dy in HEX_NEIGHBOR_OFFSETS:
+            coord = (x + dx, y + dy)
+            terrain_type = placed.get(coord)
+            if terrain_type is not None:
+                neighbor_types.append(terrain_type)
+            elif coord not in seen:
+                seen.add(coord)
+                frontier.append(coord)
+        terrain_type = choose_terrain_type(x, y, neighbor_types)
+        placed[(x, y)] = terrain_type
+        yield x, y, terrain_type
+
+
+def generate_island(total_land_hexagons, choose_terrain_type, origin=(0, 0)):
+    """
+    @brief Grows a contiguous island breadth-first from the origin.
+
+    @param total_land_hexagons The number of hexes to place.
+    @param choose_terrain_type Callable choosing a terrain type, as for iter_island.
+    @param origin The (x, y) coordinate the island grows from.
+
+    @return A dictionary mapping (x, y) to terrain, in generation order.
+    """
+    return {
+        (x, y): terrain_type
+        for x, y, terrain_type in iter_island(
+            total_land_hexagons, choose_terrain_type, origin
+        )
+    }
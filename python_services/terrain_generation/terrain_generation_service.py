@@ -3,23 +3,58 @@ import grpc
 from concurrent import futures
 from timeit import default_timer as timer
 from persistence.persistence_pb2 import (
-    TerrainTile,
-    StoreTerrainRequest,
-    CommitTransactionRequest,
-    RollbackTransactionRequest,
-    BeginTransactionRequest,
+    StoreTerrainAtomicRequest,
+    StoreTerrainBatchRequest,
+    StoreTerrainChunk,
 )
 from persistence.persistence_pb2_grpc import PersistenceServiceStub
 import terrain_generation.terrain_generation_pb2 as terrain_generation_pb2
 import terrain_generation.terrain_generation_pb2_grpc as terrain_generation_pb2_grpc
+from terrain_generation.terrain_engine import (
+    GenerationSettings,
+    iter_island,
+    island_radius,
+    make_terrain_chooser,
+    noise_offset,
+    TERRAIN_TYPES,
+)
+from terrain_generation.elevation import ElevationField
+from terrain_generation.parallel_generation import generate_island_parallel
+from terrain_generation.chunk_generation import generate_chunk
+from terrain_generation.terrain_sampler import TerrainSampler
+import asyncio
+import multiprocessing
+import queue
 import random
-import math
-import noise
 import socket
 import os
+import threading
+import uuid
 from grpc_reflection.v1alpha import reflection
-from common.logging_config import setup_logger
-from persistence.persistence_pb2 import BeginTransactionRequest
+from common.logging_config import configure_logging, log_sample, setup_logger
+from common.config import env_float, env_int, env_str
+from common.async_server import (
+    ASYNC_EXECUTOR_WORKERS,
+    MAX_CONCURRENT_RPCS,
+    offload,
+    offloaded,
+    use_asyncio,
+)
+from common.channel_pool import (
+    call_compression,
+    server_options,
+    shared_aio_channel,
+    shared_channel,
+)
+from common.keyed_locks import AsyncKeyedLocks, KeyedLocks
+from common.lru_cache import LRUCache
+from common.metrics import counter, start_metrics_server
+from common.metrics_interceptor import AsyncMetricsInterceptor, MetricsInterceptor
+from common.tile_arrays import TileArrays
+from common.tracing import CLIENT, Tracer, current_span, outgoing_metadata
+from common.tracing_interceptor import AsyncTracingInterceptor, TracingInterceptor
+from common import write_behind
+from common.write_behind import WriteBehindQueue
 import ssl
 from pathlib import Path
 
@@ -41,6 +76,92 @@ server_credentials = grpc.ssl_server_credentials(
     [(key_data, cert_data)], root_certificates=None, require_client_auth=False
 )
 
+# Port of the local Prometheus metrics endpoint, 0 to disable it, and its address
+METRICS_PORT = env_int("VIE_TERRAIN_GENERATION_METRICS_PORT", 9101)
+METRICS_ADDRESS = env_str("VIE_METRICS_ADDRESS", "127.0.0.1")
+
+TILES_GENERATED = counter(
+    "vie_tiles_generated_total",
+    "Tiles generated, excluding terrains and world chunks served from the caches.",
+)
+
+TRACER = Tracer("terrain_generation")
+
+# Address of the persistence service
+PERSISTENCE_TARGET = env_str("VIE_PERSISTENCE_TARGET", "localhost:50052")
+
+# Names of the client spans of persistence calls
+_STORE_TERRAIN_ATOMIC = "persistence.PersistenceService/StoreTerrainAtomic"
+_STORE_TERRAIN_STREAM = "persistence.PersistenceService/StoreTerrainStream"
+
+# Tiles per chunk when a streaming request does not choose a chunk size
+DEFAULT_CHUNK_SIZE = 1000
+
+# Bounds of the in-process cache of generated terrains
+TERRAIN_CACHE_MAX_ENTRIES = env_int("VIE_TERRAIN_CACHE_MAX_ENTRIES", 64)
+TERRAIN_CACHE_MAX_BYTES = env_int("VIE_TERRAIN_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+
+# Maps of at least this many tiles are generated on a process pool
+PARALLEL_GENERATION_THRESHOLD = env_int("VIE_PARALLEL_GENERATION_THRESHOLD", 200_000)
+GENERATION_WORKERS = env_int("VIE_GENERATION_WORKERS", os.cpu_count() or 1)
+PARALLEL_BLOCK_SIZE = env_int("VIE_PARALLEL_BLOCK_SIZE", 64)
+
+# Side in hexes of the chunks served by GetTerrainChunk, and the bounds of their cache
+WORLD_CHUNK_SIZE = env_int("VIE_WORLD_CHUNK_SIZE", 32)
+CHUNK_CACHE_MAX_ENTRIES = env_int("VIE_CHUNK_CACHE_MAX_ENTRIES", 4096)
+CHUNK_CACHE_MAX_BYTES = env_int("VIE_CHUNK_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# Range of tile coordinates, which are int32 fields of TerrainTile
+INT32_MIN = -(2**31)
+INT32_MAX = 2**31 - 1
+
+# Namespace of the terrain IDs persisted world chunks are stored under
+CHUNK_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "vie:world-chunk")
+
+# Terrains of more tiles than this are uploaded with StoreTerrainStream, in batches of
+# PERSIST_STREAM_BATCH_SIZE tiles, so no message comes near the gRPC message size limit
+STREAM_PERSIST_THRESHOLD = env_int("VIE_STREAM_PERSIST_THRESHOLD", 250_000)
+PERSIST_STREAM_BATCH_SIZE = env_int("VIE_PERSIST_STREAM_BATCH_SIZE", 50_000)
+
+# Background persistence of terrains requested with persist_async: the bound on queued
+# terrains, the terrains stored per StoreTerrainBatch call, the attempts per batch and
+# the first retry delay, and how long a request waits for room in a full queue
+WRITE_BEHIND_MAX_PENDING = env_int("VIE_WRITE_BEHIND_MAX_PENDING", 64)
+WRITE_BEHIND_BATCH_SIZE = env_int("VIE_WRITE_BEHIND_BATCH_SIZE", 8)
+WRITE_BEHIND_MAX_ATTEMPTS = env_int("VIE_WRITE_BEHIND_MAX_ATTEMPTS", 5)
+WRITE_BEHIND_RETRY_DELAY = env_float("VIE_WRITE_BEHIND_RETRY_DELAY", 0.2)
+WRITE_BEHIND_ENQUEUE_TIMEOUT = env_float("VIE_WRITE_BEHIND_ENQUEUE_TIMEOUT", 5.0)
+
+# Persistence statuses by WriteBehindQueue status
+PERSISTENCE_STATUSES = {
+    write_behind.PENDING: terrain_generation_pb2.PERSISTENCE_STATUS_PENDING,
+    write_behind.DURABLE: terrain_generation_pb2.PERSISTENCE_STATUS_DURABLE,
+    write_behind.FAILED: terrain_generation_pb2.PERSISTENCE_STATUS_FAILED,
+}
+
+
+def _timed(function, span, attribute):
+    """
+    @brief Wraps a function to add the seconds spent in it to a span attribute.
+
+    @param function The function to time.
+    @param span The recording span.
+    @param attribute The attribute accumulating the time.
+
+    @return The wrapped function.
+    """
+    span.set_attribute(attribute, 0.0)
+
+    def timed(*args):
+        start_time = timer()
+        try:
+            return function(*args)
+        finally:
+            span.attributes[attribute] += timer() - start_time
+
+    return timed
+
 
 class TerrainGeneratorService(
     terrain_generation_pb2_grpc.TerrainGenerationServiceServicer
@@ -49,22 +170,50 @@ class TerrainGeneratorService(
     @brief Service for generating terrain.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        cache_max_entries=TERRAIN_CACHE_MAX_ENTRIES,
+        cache_max_bytes=TERRAIN_CACHE_MAX_BYTES,
+        parallel_threshold=PARALLEL_GENERATION_THRESHOLD,
+        generation_workers=GENERATION_WORKERS,
+        parallel_block_size=PARALLEL_BLOCK_SIZE,
+        world_chunk_size=WORLD_CHUNK_SIZE,
+        chunk_cache_max_entries=CHUNK_CACHE_MAX_ENTRIES,
+        chunk_cache_max_bytes=CHUNK_CACHE_MAX_BYTES,
+    ):
         """
         @brief Initializes the TerrainGeneratorService.
-        """
-        # Create channel options to disable SSL verification (for testing only)
-        channel_options = [
-            ("grpc.ssl_target_name_override", "localhost"),
-            ("grpc.default_authority", "localhost"),
-        ]
 
-        # Use SSL but with verification disabled
-        credentials = grpc.ssl_channel_credentials(root_certificates=cert_data)
+        @param cache_max_entries The maximum number of generated terrains to cache.
+        @param cache_max_bytes The maximum total size of the cached terrains in bytes.
+        @param parallel_threshold The map size from which generation uses a process pool.
+        @param generation_workers The number of generation processes; 1 disables the pool.
+        @param parallel_block_size The side in hexes of the blocks generated in parallel.
+        @param world_chunk_size The side in hexes of the chunks served by GetTerrainChunk.
+        @param chunk_cache_max_entries The maximum number of world chunks to cache.
+        @param chunk_cache_max_bytes The maximum total size of the cached chunks in bytes.
+        """
+        self.terrain_cache = LRUCache(cache_max_entries, cache_max_bytes)
+        self.terrain_sampler = TerrainSampler(
+            self._get_terrain_weights(), TERRAIN_TYPES
+        )
+        self.parallel_threshold = parallel_threshold
+        self.generation_workers = generation_workers
+        self.parallel_block_size = parallel_block_size
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        if world_chunk_size < 2:
+            raise ValueError("world_chunk_size must be at least 2")
+        self.world_chunk_size = world_chunk_size
+        self.chunk_cache = LRUCache(chunk_cache_max_entries, chunk_cache_max_bytes)
+        self._chunk_persist_locks = KeyedLocks()
+        self._write_behind = None
+        self._write_behind_lock = threading.Lock()
 
-        # Connect with secure but unverified channel
+        # The process-wide channel, verified against the localhost certificate whatever
+        # the target's host name
         self.persistence_stub = PersistenceServiceStub(
-            grpc.secure_channel("localhost:50052", credentials, options=channel_options)
+            shared_channel(PERSISTENCE_TARGET, cert_data, authority="localhost")
         )
         logger.info("TerrainGeneratorService initialized with secure channel.")
 
@@ -85,15 +234,20 @@ class TerrainGeneratorService(
         try:
             total_land_hexagons = request.total_land_hexagons
             self._validate_request(total_land_hexagons)
+            seed = self._resolve_seed(request)
+            settings = self._resolve_settings(request)
 
-            tiles = self._generate_terrain_tiles(total_land_hexagons)
+            tiles = self._generate_terrain_tiles(total_land_hexagons, seed, settings)
 
             terrain_id = ""
-            if request.persist:
+            if request.persist and request.persist_async:
+                terrain_id = self._persist_terrain_later(tiles)
+            elif request.persist:
                 terrain_id = self._persist_terrain(tiles)
 
             self._log_generated_tiles(tiles)
-            response = self._create_response(tiles, terrain_id)
+            response = self._create_response(tiles, terrain_id, request.packed)
+            response.seed = seed
 
             duration = time.time() - start_time
             logger.info(f"GenerateTerrain completed in {duration:.2f} seconds.")
@@ -103,6 +257,11 @@ class TerrainGeneratorService(
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details(str(e))
             return terrain_generation_pb2.TerrainResponse()
+        except queue.Full:
+            logger.error("Persistence queue is full")
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details("Persistence queue is full")
+            return terrain_generation_pb2.TerrainResponse()
         except Exception as e:
             logger.error(f"Error during terrain generation: {e}")
             context.set_code(grpc.StatusCode.INTERNAL)
@@ -120,156 +279,584 @@ class TerrainGeneratorService(
         if total_land_hexagons < 1:
             raise ValueError("total_land_hexagons must be greater than 0")
 
-    def _generate_terrain_tiles(self, total_land_hexagons):
+    def _resolve_seed(self, request):
+        """
+        @brief Returns the seed requested, or a fresh random seed if none was given.
+
+        @param request The TerrainRequest.
+
+        @return The seed to generate the terrain from.
+        """
+        if request.HasField("seed"):
+            return request.seed
+        return random.getrandbits(63)
+
+    def _resolve_settings(self, request):
+        """
+        @brief Builds the generation settings from the request parameters.
+
+        @param request The TerrainRequest.
+
+        @return A GenerationSettings with defaults for every unset parameter.
+
+        @exception ValueError If noise_scale is not positive.
+        """
+        params = request.params
+        settings = GenerationSettings(
+            **{
+                field: getattr(params, field)
+                for field in GenerationSettings._fields
+                if params.HasField(field)
+            }
+        )
+        if settings.noise_scale <= 0:
+            raise ValueError("noise_scale must be greater than 0")
+        return settings
+
+    def GenerateTerrainStream(self, request, context):
+        """
+        @brief Generates terrain and streams its tiles in chunks as they are generated.
+
+        Only one chunk of tile messages is held at a time unless the terrain is also
+        being persisted, in which case the tiles are kept until they are stored.
+        Terrains of parallel_threshold tiles or more are the exception: the process
+        pool generates them whole, so all their tiles are held before the first chunk
+        is sent, and peak memory grows with the terrain as for GenerateTerrain.
+
+        @param request The request containing the total number of land hexagons and the
+               chunk size.
+        @param context The gRPC context.
+
+        @return An iterator of TerrainChunk messages, the last of which has final set
+                and carries the terrain ID.
+        """
+        start_time = timer()
+        logger.debug("GenerateTerrainStream invocation started.")
+
+        try:
+            total_land_hexagons = request.total_land_hexagons
+            self._validate_request(total_land_hexagons)
+            chunk_size = request.chunk_size or DEFAULT_CHUNK_SIZE
+            if chunk_size < 1:
+                raise ValueError("chunk_size must be greater than 0")
+            seed = self._resolve_seed(request)
+            settings = self._resolve_settings(request)
+
+            # Replay a cached terrain if there is one, otherwise stream as it is generated
+            cached = self.terrain_cache.get((seed, total_land_hexagons, settings))
+            if cached is not None:
+                source = zip(cached.xs, cached.ys, cached.codes)
+            else:
+                source = self._iter_terrain_codes(total_land_hexagons, seed, settings)
+
+            terrain_types = self.terrain_sampler.terrain_types
+            persisted_tiles = TileArrays(terrain_types)
+            chunk_tiles = TileArrays(terrain_types)
+            for x, y, code in source:
+                chunk_tiles.append(x, y, code)
+                if request.persist:
+                    persisted_tiles.append(x, y, code)
+                if len(chunk_tiles) >= chunk_size:
+                    yield self._create_chunk(chunk_tiles, request.packed)
+                    chunk_tiles = TileArrays(terrain_types)
+            if len(chunk_tiles):
+                yield self._create_chunk(chunk_tiles, request.packed)
+
+            terrain_id = ""
+            if request.persist and request.persist_async:
+                terrain_id = self._persist_terrain_later(persisted_tiles)
+            elif request.persist:
+                terrain_id = self._persist_terrain(persisted_tiles)
+
+            if cached is None:
+                TILES_GENERATED.inc(total_land_hexagons)
+            logger.info("Generated terrain with %d tiles", total_land_hexagons)
+            yield terrain_generation_pb2.TerrainChunk(
+                terrain_id=terrain_id, final=True, seed=seed
+            )
+
+            duration = timer() - start_time
+            logger.info(f"GenerateTerrainStream completed in {duration:.2f} seconds.")
+        except ValueError as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+        except queue.Full:
+            logger.error("Persistence queue is full")
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details("Persistence queue is full")
+        except Exception as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details("Failed to generate terrain")
+
+    def GetTerrainChunk(self, request, context):
+        """
+        @brief Returns one chunk of an unbounded world, generating it on first use.
+
+        A chunk depends only on the world seed, its coordinates and the generation
+        parameters, and matches its neighbours at the borders whatever order chunks
+        are requested in. Generated chunks, and the IDs of persisted ones, are kept in
+        chunk_cache so repeated requests neither regenerate nor persist them again. A
+        persisted chunk is stored under an ID derived from its key, so persisting it
+        again after it left the cache stores nothing new and returns the same ID.
+
+        @param request The WorldChunkRequest.
+        @param context The gRPC context.
+
+        @return A WorldChunkResponse containing the chunk's tiles.
+        """
+        start_time = timer()
+        logger.debug("GetTerrainChunk invocation started.")
+
+        try:
+            key = self._chunk_key(request)
+            tiles, terrain_id = self._get_world_chunk(key)
+
+            if request.persist and not terrain_id:
+                with self._chunk_persist_locks.hold(key):
+                    # Another request may have persisted the chunk in the meantime
+                    tiles, terrain_id = self._get_world_chunk(key)
+                    if not terrain_id:
+                        terrain_id = self._persist_terrain(
+                            tiles, self._chunk_terrain_id(key)
+                        )
+                        self.chunk_cache.put(key, (tiles, terrain_id), tiles.nbytes)
+
+            response = terrain_generation_pb2.WorldChunkResponse(
+                terrain_id=terrain_id,
+                world_seed=request.world_seed,
+                chunk_q=request.chunk_q,
+                chunk_r=request.chunk_r,
+                chunk_size=self.world_chunk_size,
+            )
+            if request.packed:
+                tiles.fill_packed(response.packed_tiles)
+            else:
+                tiles.add_to(response.tiles)
+
+            duration = timer() - start_time
+            logger.info(f"GetTerrainChunk completed in {duration:.2f} seconds.")
+            return response
+        except ValueError as e:
+            logger.error(f"Error during chunk generation: {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return terrain_generation_pb2.WorldChunkResponse()
+        except Exception as e:
+            logger.error(f"Error during chunk generation: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details("Failed to generate chunk")
+            return terrain_generation_pb2.WorldChunkResponse()
+
+    def _chunk_key(self, request):
+        """
+        @brief Returns the key of the world chunk a request asks for.
+
+        @param request The WorldChunkRequest.
+
+        @return The (world_seed, chunk_q, chunk_r, settings) of the chunk.
+
+        @exception ValueError If the settings are invalid or the chunk holds tiles whose
+                   coordinates do not fit in a 32-bit integer.
+        """
+        # Chunks whose tiles and far seam line have 32-bit coordinates
+        size = self.world_chunk_size
+        lowest, highest = -(-INT32_MIN // size), INT32_MAX // size - 1
+        for name in ("chunk_q", "chunk_r"):
+            if not lowest <= getattr(request, name) <= highest:
+                raise ValueError(
+                    f"{name} must be between {lowest} and {highest} for chunks of "
+                    f"{size} hexes"
+                )
+        settings = self._resolve_settings(request)
+        return (request.world_seed, request.chunk_q, request.chunk_r, settings)
+
+    def _chunk_terrain_id(self, key):
+        """
+        @brief Returns the terrain ID a world chunk is persisted under.
+
+        @param key The (world_seed, chunk_q, chunk_r, settings) of the chunk.
+
+        @return A UUID determined by the key and world_chunk_size.
+        """
+        world_seed, chunk_q, chunk_r, settings = key
+        name = ":".join(
+            map(repr, (world_seed, chunk_q, chunk_r, self.world_chunk_size, *settings))
+        )
+        return str(uuid.uuid5(CHUNK_ID_NAMESPACE, name))
+
+    def _get_world_chunk(self, key):
+        """
+        @brief Returns a world chunk from the cache, generating it if it is not there.
+
+        @param key The (world_seed, chunk_q, chunk_r, settings) of the chunk.
+
+        @return A pair of the chunk's TileArrays and the ID it was persisted under, or
+                an empty string if it has not been persisted.
+        """
+        cached = self.chunk_cache.get(key)
+        if cached is not None:
+            return cached
+
+        world_seed, chunk_q, chunk_r, settings = key
+        tiles = TileArrays(self.terrain_sampler.terrain_types)
+        for x, y, code in generate_chunk(
+            world_seed,
+            chunk_q,
+            chunk_r,
+            self.world_chunk_size,
+            settings,
+            self.terrain_sampler,
+        ):
+            tiles.append(x, y, code)
+        TILES_GENERATED.inc(len(tiles))
+        self.chunk_cache.put(key, (tiles, ""), tiles.nbytes)
+        return tiles, ""
+
+    def _generate_terrain_tiles(
+        self, total_land_hexagons, seed=None, settings=GenerationSettings()
+    ):
         """
         @brief Generates terrain tiles using a flood fill algorithm.
 
+        Terrains are cached by seed, size and settings, so repeating a request returns
+        the cached tiles instead of generating them again. Callers must not modify the
+        returned tiles.
+
         @param total_land_hexagons The total number of land hexagons to generate.
+        @param seed The seed to generate from, or None for a random seed.
+        @param settings The GenerationSettings to generate with.
 
-        @return A list of generated TerrainTile objects.
+        @return The generated tiles as TileArrays.
         """
-        terrain_types = ["mountain", "hills", "forest", "plains", "desert", "lake"]
-        terrain_weights = self._get_terrain_weights()
+        if seed is None:
+            seed = random.getrandbits(63)
+        key = (seed, total_land_hexagons, settings)
+        with TRACER.span(
+            "generate_terrain_tiles", {"tiles.requested": total_land_hexagons}
+        ) as span:
+            cached = self.terrain_cache.get(key)
+            span.set_attribute("cache_hit", cached is not None)
+            if cached is not None:
+                logger.debug(f"Terrain cache hit for seed {seed}.")
+                return cached
 
-        def choose_terrain_type(neighbors):
-            if not neighbors:
-                return random.choice(terrain_types)
-            neighbor_types = [tile.terrain_type for tile in neighbors]
-            weights = {
-                terrain: sum(
-                    terrain_weights[neighbor].get(terrain, 0)
-                    for neighbor in neighbor_types
-                )
-                for terrain in terrain_types
-            }
-            total_weight = sum(weights.values())
-            if total_weight == 0:
-                return random.choice(terrain_types)
-            return random.choices(
-                list(weights.keys()), weights=list(weights.values()), k=1
-            )[0]
-
-        def generate_island():
-            tiles = []
-            visited = set()
-            queue = [(0, 0)]
-            while queue and len(tiles) < total_land_hexagons:
-                x, y = queue.pop(0)
-                if (x, y) in visited:
-                    continue
-                visited.add((x, y))
-                nx = x * scale
-                ny = y * scale
-                elevation = noise.pnoise2(nx, ny)
-                neighbors = [
-                    tile
-                    for tile in tiles
-                    if (tile.x, tile.y)
-                    in [
-                        (x + 1, y),
-                        (x - 1, y),
-                        (x, y + 1),
-                        (x, y - 1),
-                        (x + 1, y - 1),
-                        (x - 1, y + 1),
-                    ]
-                ]
-                terrain_type = choose_terrain_type(neighbors)
-                tiles.append(
-                    terrain_generation_pb2.TerrainTile(
-                        x=x, y=y, terrain_type=terrain_type
+            tiles = TileArrays(self.terrain_sampler.terrain_types)
+            with TRACER.span("flood_fill"):
+                for x, y, code in self._iter_terrain_codes(
+                    total_land_hexagons, seed, settings
+                ):
+                    tiles.append(x, y, code)
+            TILES_GENERATED.inc(len(tiles))
+            self.terrain_cache.put(key, tiles, tiles.nbytes)
+            return tiles
+
+    def _iter_terrain_codes(
+        self, total_land_hexagons, seed=None, settings=GenerationSettings()
+    ):
+        """
+        @brief Generates terrain tiles as terrain codes, one at a time.
+
+        @param total_land_hexagons The total number of land hexagons to generate.
+        @param seed The seed to generate from, or None for a random seed.
+        @param settings The GenerationSettings to generate with.
+
+        @return An iterator of (x, y, terrain_code) tuples in generation order, where
+                codes index terrain_sampler.terrain_types. Tiles are generated as the
+                iterator advances, except from parallel_threshold tiles up, where the
+                whole terrain is generated before the first is returned.
+        """
+        if (
+            self.generation_workers > 1
+            and total_land_hexagons >= self.parallel_threshold
+        ):
+            logger.info(
+                f"Generating {total_land_hexagons} tiles on "
+                f"{self.generation_workers} processes."
+            )
+            with TRACER.span(
+                "parallel_generation", {"workers": self.generation_workers}
+            ):
+                return iter(
+                    generate_island_parallel(
+                        total_land_hexagons,
+                        seed,
+                        settings,
+                        self.terrain_sampler,
+                        self._get_process_pool(),
+                        self.parallel_block_size,
                     )
                 )
-                # Add neighboring hexes to the queue
-                neighbors_coords = [
-                    (x + 1, y),
-                    (x - 1, y),
-                    (x, y + 1),
-                    (x, y - 1),
-                    (x + 1, y - 1),
-                    (x - 1, y + 1),
-                ]
-                queue.extend(neighbors_coords)
-            return tiles
+
+        rng = random.Random(seed)
+
+        # Compute the elevation of the whole island bounding box in one pass, placing
+        # the island at a seed-dependent position in the noise field
+        with TRACER.span("elevation_field"):
+            elevation = ElevationField(
+                island_radius(total_land_hexagons),
+                settings.noise_scale,
+                noise_offset(rng),
+            )
+        choose = make_terrain_chooser(settings, self.terrain_sampler, rng)
+
+        def choose_terrain_code(x, y, neighbor_codes):
+            return choose(elevation.at(x, y), neighbor_codes)
+
+        # Terrain choice is interleaved with the flood fill tile by tile, so a traced
+        # request records its total time as an attribute of the enclosing span rather
+        # than as a span per tile
+        span = current_span()
+        if span.recording:
+            choose_terrain_code = _timed(
+                choose_terrain_code, span, "terrain_choice.seconds"
+            )
 
         # Generate terrain tiles using a flood fill algorithm to ensure contiguity
-        radius = math.ceil(math.sqrt(total_land_hexagons / math.pi))
-        scale = 0.1
-        tiles = generate_island()
+        return iter_island(total_land_hexagons, choose_terrain_code)
 
-        # Retry if not enough tiles are generated
-        while len(tiles) < total_land_hexagons:
-            logger.warning("Not enough tiles generated, retrying...")
-            tiles = generate_island()
+    def _get_process_pool(self):
+        """
+        @brief Returns the generation process pool, starting it on first use.
 
-        return tiles
+        Workers are spawned rather than forked so they do not inherit gRPC state.
 
-    def _persist_terrain(self, tiles):
+        @return A ProcessPoolExecutor with generation_workers processes.
+        """
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                self._process_pool = futures.ProcessPoolExecutor(
+                    max_workers=self.generation_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._process_pool
+
+    def close(self):
+        """
+        @brief Stores the terrains still queued for background persistence, then shuts
+        down the generation process pool, if it was started.
+        """
+        with self._write_behind_lock:
+            if self._write_behind is not None:
+                self._write_behind.close()
+                self._write_behind = None
+        with self._process_pool_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
+    def _persist_terrain(self, tiles, terrain_id=""):
         """
         @brief Persists the generated terrain tiles.
 
-        @param tiles The list of generated TerrainTile objects.
+        The persistence service stores and commits them in a single StoreTerrainAtomic
+        call, so persisting takes one round trip, or, for terrains of more than
+        STREAM_PERSIST_THRESHOLD tiles, a single StoreTerrainStream upload. On failure
+        nothing is stored.
+
+        @param tiles The generated TileArrays.
+        @param terrain_id The ID to store the terrain under, or empty to have one assigned.
 
         @return The ID of the persisted terrain.
-        """
-        transaction_id = None  # Initialize transaction_id
 
+        @exception grpc.RpcError If the persistence service fails to store the tiles.
+        """
+        compression = call_compression(tiles.nbytes)
         try:
-            # Begin a transaction
-            begin_response = self.persistence_stub.BeginTransaction(
-                BeginTransactionRequest()
-            )
-            transaction_id = begin_response.transaction_id
-
-            # Persist the generated terrain
-            store_request = StoreTerrainRequest(
-                tiles=[
-                    TerrainTile(x=tile.x, y=tile.y, terrain_type=tile.terrain_type)
-                    for tile in tiles
-                ],
-                transaction_id=transaction_id,
-            )
-            store_response = self.persistence_stub.StoreTerrain(store_request)
-            terrain_id = store_response.terrain_id
+            with TRACER.span("persist_terrain", {"tiles": len(tiles)}):
+                if len(tiles) > STREAM_PERSIST_THRESHOLD:
+                    with TRACER.span(_STORE_TERRAIN_STREAM, kind=CLIENT):
+                        return self.persistence_stub.StoreTerrainStream(
+                            self._iter_store_chunks(tiles, terrain_id),
+                            compression=compression,
+                            metadata=outgoing_metadata(),
+                        ).terrain_id
+                store_request = self._build_store_request(tiles, terrain_id)
+                with TRACER.span(_STORE_TERRAIN_ATOMIC, kind=CLIENT):
+                    return self.persistence_stub.StoreTerrainAtomic(
+                        store_request,
+                        compression=compression,
+                        metadata=outgoing_metadata(),
+                    ).terrain_id
+        except Exception as e:
+            logger.error(f"Error during terrain persistence: {e}")
+            raise
+
+    def _iter_store_chunks(self, tiles, terrain_id=""):
+        """
+        @brief Splits generated tiles into the messages of a StoreTerrainStream upload.
+
+        @param tiles The generated TileArrays.
+        @param terrain_id The ID to store the terrain under, or empty to have one assigned.
 
-            # Commit the transaction
-            self.persistence_stub.CommitTransaction(
-                CommitTransactionRequest(transaction_id=transaction_id)
+        @return An iterator of StoreTerrainChunk messages of at most
+                PERSIST_STREAM_BATCH_SIZE tiles, built as they are sent.
+        """
+        for start in range(0, len(tiles), PERSIST_STREAM_BATCH_SIZE):
+            chunk = StoreTerrainChunk(terrain_id=terrain_id if not start else "")
+            tiles.fill_packed(
+                chunk.packed_tiles, start, start + PERSIST_STREAM_BATCH_SIZE
             )
+            yield chunk
 
-            return terrain_id
-        except Exception as e:
-            logger.error(f"Error during terrain persistence: {e}")
-            if transaction_id:
-                # Rollback the transaction in case of error
-                self.persistence_stub.RollbackTransaction(
-                    RollbackTransactionRequest(transaction_id=transaction_id)
+    def _persist_terrain_later(self, tiles):
+        """
+        @brief Queues the generated terrain tiles for persisting in the background.
+
+        The terrain ID is chosen here, so it can be returned before the terrain is
+        stored; GetPersistenceStatus reports when it is durable.
+
+        @param tiles The generated TileArrays.
+
+        @return The ID the terrain will be stored under.
+
+        @exception queue.Full If the queue stays full for WRITE_BEHIND_ENQUEUE_TIMEOUT.
+        """
+        terrain_id = str(uuid.uuid4())
+        self._get_write_behind().submit(
+            terrain_id, (terrain_id, tiles), timeout=WRITE_BEHIND_ENQUEUE_TIMEOUT
+        )
+        return terrain_id
+
+    def _get_write_behind(self):
+        """
+        @brief Returns the background persistence queue, starting it on first use.
+
+        @return A WriteBehindQueue of (terrain_id, tiles) pairs.
+        """
+        with self._write_behind_lock:
+            if self._write_behind is None:
+                self._write_behind = WriteBehindQueue(
+                    self._store_terrain_batch,
+                    max_pending=WRITE_BEHIND_MAX_PENDING,
+                    batch_size=WRITE_BEHIND_BATCH_SIZE,
+                    max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+                    retry_delay=WRITE_BEHIND_RETRY_DELAY,
                 )
-            return ""
+            return self._write_behind
+
+    def _store_terrain_batch(self, items):
+        """
+        @brief Stores queued terrains.
+
+        Terrains are stored together, with one commit per StoreTerrainBatch call of at
+        most STREAM_PERSIST_THRESHOLD tiles; larger terrains are uploaded on their own.
+        Each terrain is stored under the ID it was queued with, so retrying a batch
+        that was committed but not acknowledged stores nothing twice.
+
+        @param items The queued (terrain_id, tiles) pairs.
+        """
+        batch, batch_tiles, batch_bytes = [], 0, 0
+        for terrain_id, tiles in items:
+            if len(tiles) > STREAM_PERSIST_THRESHOLD:
+                self._persist_terrain(tiles, terrain_id)
+                continue
+            if batch and batch_tiles + len(tiles) > STREAM_PERSIST_THRESHOLD:
+                self.persistence_stub.StoreTerrainBatch(
+                    StoreTerrainBatchRequest(terrains=batch),
+                    compression=call_compression(batch_bytes),
+                )
+                batch, batch_tiles, batch_bytes = [], 0, 0
+            batch.append(self._build_store_request(tiles, terrain_id))
+            batch_tiles += len(tiles)
+            batch_bytes += tiles.nbytes
+        if batch:
+            self.persistence_stub.StoreTerrainBatch(
+                StoreTerrainBatchRequest(terrains=batch),
+                compression=call_compression(batch_bytes),
+            )
+
+    def GetPersistenceStatus(self, request, context):
+        """
+        @brief Reports whether a terrain persisted with persist_async has been stored.
+
+        @param request The PersistenceStatusRequest.
+        @param context The gRPC context.
+
+        @return A PersistenceStatusResponse.
+        """
+        status = None
+        with self._write_behind_lock:
+            if self._write_behind is not None:
+                status = self._write_behind.status(request.terrain_id)
+        if status is None:
+            return terrain_generation_pb2.PersistenceStatusResponse()
+        return terrain_generation_pb2.PersistenceStatusResponse(
+            status=PERSISTENCE_STATUSES[status[0]], error=status[1]
+        )
+
+    def _build_store_request(self, tiles, terrain_id=""):
+        """
+        @brief Builds the request storing generated tiles as a new terrain.
+
+        The tiles are sent in the columnar encoding the generator already holds them
+        in, so no message is built per tile.
+
+        @param tiles The generated TileArrays.
+        @param terrain_id The ID to store the terrain under, or empty to have one assigned.
+
+        @return A StoreTerrainAtomicRequest.
+        """
+        with TRACER.span("build_store_request", {"tiles": len(tiles)}):
+            request = StoreTerrainAtomicRequest(terrain_id=terrain_id)
+            tiles.fill_packed(request.packed_tiles)
+            return request
 
     def _log_generated_tiles(self, tiles):
         """
-        @brief Logs each generated terrain tile.
+        @brief Logs a sample of the generated terrain tiles at DEBUG level.
 
-        @param tiles The list of generated TerrainTile objects.
+        @param tiles The generated TileArrays.
         """
-        for tile in tiles:
-            logger.info(f"Generated tile: {tile.x}, {tile.y}, {tile.terrain_type}")
+        terrain_types = tiles.terrain_types
+        log_sample(
+            logger,
+            logging.DEBUG,
+            "Generated tile: %d, %d, %s",
+            len(tiles),
+            lambda index: (
+                tiles.xs[index],
+                tiles.ys[index],
+                terrain_types[tiles.codes[index]],
+            ),
+        )
 
-    def _create_response(self, tiles, terrain_id):
+    def _create_response(self, tiles, terrain_id, packed=False):
         """
         @brief Creates a TerrainResponse object.
 
-        @param tiles The list of generated TerrainTile objects.
+        @param tiles The generated TileArrays.
         @param terrain_id The ID of the persisted terrain.
+        @param packed Whether to return the tiles in packed_tiles instead of tiles.
 
         @return A TerrainResponse object containing the tiles and terrain ID.
         """
         logger.info("Generated terrain with %d tiles", len(tiles))
         logger.info("Terrain generated successfully.")
-        return terrain_generation_pb2.TerrainResponse(
-            tiles=tiles, terrain_id=terrain_id
-        )
+        with TRACER.span("build_response", {"tiles": len(tiles), "packed": packed}):
+            response = terrain_generation_pb2.TerrainResponse(terrain_id=terrain_id)
+            if packed:
+                tiles.fill_packed(response.packed_tiles)
+            else:
+                tiles.add_to(response.tiles)
+            return response
+
+    def _create_chunk(self, tiles, packed=False):
+        """
+        @brief Creates a TerrainChunk object for a streamed batch of tiles.
+
+        @param tiles The TileArrays holding the batch.
+        @param packed Whether to send the tiles in packed_tiles instead of tiles.
+
+        @return A TerrainChunk object containing the tiles.
+        """
+        chunk = terrain_generation_pb2.TerrainChunk()
+        if packed:
+            tiles.fill_packed(chunk.packed_tiles)
+        else:
+            tiles.add_to(chunk.tiles)
+        return chunk
 
     def _get_terrain_weights(self):
         """
@@ -332,7 +919,325 @@ class TerrainGeneratorService(
 LOCK_FILE = "/tmp/terrain_generation_service.lock"
 
 
+class AsyncTerrainGeneratorService(TerrainGeneratorService):
+    """
+    @brief TerrainGeneratorService for a grpc.aio server.
+
+    Generation and message building run on a thread executor (and, for very large
+    maps, on the generation process pool as before), while calls to the persistence
+    service go through a grpc.aio stub, so requests waiting on I/O hold no thread.
+    """
+
+    def __init__(self, executor_workers=ASYNC_EXECUTOR_WORKERS, **kwargs):
+        """
+        @brief Initializes the AsyncTerrainGeneratorService.
+
+        @param executor_workers The number of threads running CPU-bound work.
+        @param kwargs Keyword arguments for TerrainGeneratorService.
+        """
+        super().__init__(**kwargs)
+        self.executor = futures.ThreadPoolExecutor(max_workers=executor_workers)
+        self._async_persistence_stub = None
+        self._async_chunk_persist_locks = AsyncKeyedLocks()
+
+    def _get_async_persistence_stub(self):
+        """
+        @brief Returns the grpc.aio persistence stub, creating it on first use.
+
+        The stub uses the process-wide grpc.aio channel of the running event loop, so
+        it is created lazily.
+
+        @return A PersistenceServiceStub over a grpc.aio channel.
+        """
+        if self._async_persistence_stub is None:
+            self._async_persistence_stub = PersistenceServiceStub(
+                shared_aio_channel(PERSISTENCE_TARGET, cert_data, authority="localhost")
+            )
+        return self._async_persistence_stub
+
+    async def GenerateTerrain(self, request, context):
+        """
+        @brief Generates terrain based on the provided request; see
+        TerrainGeneratorService.GenerateTerrain.
+        """
+        start_time = timer()
+        logger.debug("GenerateTerrain invocation started.")
+
+        try:
+            total_land_hexagons = request.total_land_hexagons
+            self._validate_request(total_land_hexagons)
+            seed = self._resolve_seed(request)
+            settings = self._resolve_settings(request)
+
+            tiles = await offload(
+                self.executor,
+                self._generate_terrain_tiles,
+                total_land_hexagons,
+                seed,
+                settings,
+            )
+
+            terrain_id = ""
+            if request.persist and request.persist_async:
+                terrain_id = await offload(
+                    self.executor, self._persist_terrain_later, tiles
+                )
+            elif request.persist:
+                terrain_id = await self._persist_terrain_async(tiles)
+
+            await offload(self.executor, self._log_generated_tiles, tiles)
+            response = await offload(
+                self.executor, self._create_response, tiles, terrain_id, request.packed
+            )
+            response.seed = seed
+
+            duration = timer() - start_time
+            logger.info(f"GenerateTerrain completed in {duration:.2f} seconds.")
+            return response
+        except ValueError as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return terrain_generation_pb2.TerrainResponse()
+        except queue.Full:
+            logger.error("Persistence queue is full")
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details("Persistence queue is full")
+            return terrain_generation_pb2.TerrainResponse()
+        except Exception as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details("Failed to store terrain")
+            return terrain_generation_pb2.TerrainResponse()
+
+    async def GenerateTerrainStream(self, request, context):
+        """
+        @brief Generates terrain and streams its tiles in chunks; see
+        TerrainGeneratorService.GenerateTerrainStream.
+
+        Each chunk is generated on the executor, so the event loop only waits for it.
+        """
+        start_time = timer()
+        logger.debug("GenerateTerrainStream invocation started.")
+
+        try:
+            total_land_hexagons = request.total_land_hexagons
+            self._validate_request(total_land_hexagons)
+            chunk_size = request.chunk_size or DEFAULT_CHUNK_SIZE
+            if chunk_size < 1:
+                raise ValueError("chunk_size must be greater than 0")
+            seed = self._resolve_seed(request)
+            settings = self._resolve_settings(request)
+
+            cached = self.terrain_cache.get((seed, total_land_hexagons, settings))
+            if cached is not None:
+                source = zip(cached.xs, cached.ys, cached.codes)
+            else:
+                source = await offload(
+                    self.executor,
+                    self._iter_terrain_codes,
+                    total_land_hexagons,
+                    seed,
+                    settings,
+                )
+
+            terrain_types = self.terrain_sampler.terrain_types
+            persisted_tiles = TileArrays(terrain_types)
+
+            def next_chunk():
+                chunk_tiles = TileArrays(terrain_types)
+                for x, y, code in source:
+                    chunk_tiles.append(x, y, code)
+                    if request.persist:
+                        persisted_tiles.append(x, y, code)
+                    if len(chunk_tiles) >= chunk_size:
+                        break
+                if not len(chunk_tiles):
+                    return None
+                return self._create_chunk(chunk_tiles, request.packed)
+
+            while True:
+                chunk = await offload(self.executor, next_chunk)
+                if chunk is None:
+                    break
+                yield chunk
+
+            terrain_id = ""
+            if request.persist and request.persist_async:
+                terrain_id = await offload(
+                    self.executor, self._persist_terrain_later, persisted_tiles
+                )
+            elif request.persist:
+                terrain_id = await self._persist_terrain_async(persisted_tiles)
+
+            if cached is None:
+                TILES_GENERATED.inc(total_land_hexagons)
+            logger.info("Generated terrain with %d tiles", total_land_hexagons)
+            yield terrain_generation_pb2.TerrainChunk(
+                terrain_id=terrain_id, final=True, seed=seed
+            )
+
+            duration = timer() - start_time
+            logger.info(f"GenerateTerrainStream completed in {duration:.2f} seconds.")
+        except ValueError as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+        except queue.Full:
+            logger.error("Persistence queue is full")
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details("Persistence queue is full")
+        except Exception as e:
+            logger.error(f"Error during terrain generation: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details("Failed to generate terrain")
+
+    async def GetTerrainChunk(self, request, context):
+        """
+        @brief Returns one chunk of an unbounded world; see
+        TerrainGeneratorService.GetTerrainChunk.
+        """
+        start_time = timer()
+        logger.debug("GetTerrainChunk invocation started.")
+
+        try:
+            key = self._chunk_key(request)
+            tiles, terrain_id = await offload(self.executor, self._get_world_chunk, key)
+
+            if request.persist and not terrain_id:
+                async with self._async_chunk_persist_locks.hold(key):
+                    # Another request may have persisted the chunk in the meantime
+                    tiles, terrain_id = await offload(
+                        self.executor, self._get_world_chunk, key
+                    )
+                    if not terrain_id:
+                        terrain_id = await self._persist_terrain_async(
+                            tiles, self._chunk_terrain_id(key)
+                        )
+                        self.chunk_cache.put(key, (tiles, terrain_id), tiles.nbytes)
+
+            def build_response():
+                response = terrain_generation_pb2.WorldChunkResponse(
+                    terrain_id=terrain_id,
+                    world_seed=request.world_seed,
+                    chunk_q=request.chunk_q,
+                    chunk_r=request.chunk_r,
+                    chunk_size=self.world_chunk_size,
+                )
+                if request.packed:
+                    tiles.fill_packed(response.packed_tiles)
+                else:
+                    tiles.add_to(response.tiles)
+                return response
+
+            response = await offload(self.executor, build_response)
+
+            duration = timer() - start_time
+            logger.info(f"GetTerrainChunk completed in {duration:.2f} seconds.")
+            return response
+        except ValueError as e:
+            logger.error(f"Error during chunk generation: {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return terrain_generation_pb2.WorldChunkResponse()
+        except Exception as e:
+            logger.error(f"Error during chunk generation: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details("Failed to generate chunk")
+            return terrain_generation_pb2.WorldChunkResponse()
+
+    GetPersistenceStatus = offloaded(TerrainGeneratorService.GetPersistenceStatus)
+
+    async def _persist_terrain_async(self, tiles, terrain_id=""):
+        """
+        @brief Persists the generated terrain tiles through the grpc.aio stub; see
+        TerrainGeneratorService._persist_terrain.
+
+        @param tiles The generated TileArrays.
+        @param terrain_id The ID to store the terrain under, or empty to have one assigned.
+
+        @return The ID of the persisted terrain.
+        """
+        stub = self._get_async_persistence_stub()
+
+        async def store_chunks():
+            # Each chunk is built on the executor as the upload asks for it
+            iterator = self._iter_store_chunks(tiles, terrain_id)
+            done = object()
+            while True:
+                chunk = await offload(self.executor, next, iterator, done)
+                if chunk is done:
+                    return
+                yield chunk
+
+        compression = call_compression(tiles.nbytes)
+        try:
+            with TRACER.span("persist_terrain", {"tiles": len(tiles)}):
+                if len(tiles) > STREAM_PERSIST_THRESHOLD:
+                    with TRACER.span(_STORE_TERRAIN_STREAM, kind=CLIENT):
+                        store_response = await stub.StoreTerrainStream(
+                            store_chunks(),
+                            compression=compression,
+                            metadata=outgoing_metadata(),
+                        )
+                    return store_response.terrain_id
+                store_request = await offload(
+                    self.executor, self._build_store_request, tiles, terrain_id
+                )
+                with TRACER.span(_STORE_TERRAIN_ATOMIC, kind=CLIENT):
+                    store_response = await stub.StoreTerrainAtomic(
+                        store_request,
+                        compression=compression,
+                        metadata=outgoing_metadata(),
+                    )
+                return store_response.terrain_id
+        except Exception as e:
+            logger.error(f"Error during terrain persistence: {e}")
+            raise
+
+    def close(self):
+        """
+        @brief Shuts down the executor and the generation process pool.
+        """
+        super().close()
+        self.executor.shutdown()
+
+
+async def serve_async():
+    """
+    @brief Runs the Terrain Generation Service on a grpc.aio server until terminated.
+    """
+    server = grpc.aio.server(
+        maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS,
+        options=server_options(),
+        interceptors=[AsyncMetricsInterceptor(), AsyncTracingInterceptor(TRACER)],
+    )
+    service = AsyncTerrainGeneratorService()
+    terrain_generation_pb2_grpc.add_TerrainGenerationServiceServicer_to_server(
+        service, server
+    )
+
+    # Enable reflection
+    SERVICE_NAMES = (
+        terrain_generation_pb2.DESCRIPTOR.services_by_name[
+            "TerrainGenerationService"
+        ].full_name,
+        reflection.SERVICE_NAME,
+    )
+    reflection.enable_server_reflection(SERVICE_NAMES, server)
+
+    server.add_secure_port("[::]:50051", server_credentials)
+
+    await server.start()
+    logger.info("Terrain Generation Service started on port 50051 (asyncio)")
+    try:
+        await server.wait_for_termination()
+    finally:
+        service.close()
+
+
 def serve():
+    configure_logging()
     if os.path.exists(LOCK_FILE):
         logger.error("Terrain Generation Service is already running.")
         return
@@ -340,8 +1245,20 @@ def serve():
     with open(LOCK_FILE, "w") as lock_file:
         lock_file.write(str(os.getpid()))
 
+    metrics_server = None
     try:
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        if METRICS_PORT:
+            metrics_server = start_metrics_server(METRICS_PORT, METRICS_ADDRESS)
+            logger.info(f"Metrics served on {METRICS_ADDRESS}:{METRICS_PORT}/metrics")
+        if use_asyncio():
+            asyncio.run(serve_async())
+            return
+
+        server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=10),
+            options=server_options(),
+            interceptors=[MetricsInterceptor(), TracingInterceptor(TRACER)],
+        )
         terrain_generation_pb2_grpc.add_TerrainGenerationServiceServicer_to_server(
             TerrainGeneratorService(), server
         )
@@ -364,6 +1281,8 @@ def serve():
     except Exception as e:
         logger.error(f"Error starting Terrain Generation Service: {e}")
     finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
         if os.path.exists(LOCK_FILE):
             os.remove(LOCK_FILE)
 
@@ -0,0 +1,106 @@
+"""
+@file terrain_sampler.py
+@brief Precompiled terrain-transition sampler.
+
+Terrain types are mapped to small integer codes and the transition weights to a
+matrix. Because a hex has at most six neighbours, the summed weights of every possible
+multiset of neighbour types can be tabulated up front as cumulative distributions, so
+drawing a terrain type is a table lookup and a bisection over six entries.
+"""
+
+import functools
+from bisect import bisect
+from itertools import accumulate, combinations_with_replacement
+
+import numpy as np
+
+# A hex has six neighbours, so each type occurs at most six times in a multiset
+MAX_NEIGHBORS = 6
+_KEY_BASE = MAX_NEIGHBORS + 1
+
+
+class TerrainSampler:
+    """
+    @brief Draws terrain types from the transition weights of placed neighbours.
+
+    Neighbour multisets are identified by an integer key, the sum of each neighbour's
+    key_weight, which callers can compute incrementally.
+    """
+
+    def __init__(self, terrain_weights, terrain_types):
+        """
+        @brief Compiles the sampling tables.
+
+        @param terrain_weights Nested dictionary of neighbour to terrain transition weights.
+        @param terrain_types The terrain types in code order.
+        """
+        self.terrain_types = list(terrain_types)
+        self.codes = {terrain: code for code, terrain in enumerate(self.terrain_types)}
+        self.matrix = np.array(
+            [
+                [terrain_weights[neighbor].get(terrain, 0) for terrain in terrain_types]
+                for neighbor in terrain_types
+            ],
+            dtype=float,
+        )
+        count = len(self.terrain_types)
+        self.key_weight = [_KEY_BASE**code for code in range(count)]
+        self._hi = count - 1
+
+        # Tabulate the cumulative weights of every non-empty neighbour multiset, in the
+        # same form random.choices builds them, so draws match it exactly
+        rows = self.matrix.tolist()
+        self._tables = {}
+        for size in range(1, MAX_NEIGHBORS + 1):
+            for neighbors in combinations_with_replacement(range(count), size):
+                weights = [
+                    sum(rows[neighbor][terrain] for neighbor in neighbors)
+                    for terrain in range(count)
+                ]
+                cum_weights = list(accumulate(weights))
+                key = self.neighbor_key(neighbors)
+                self._tables[key] = (cum_weights, cum_weights[-1])
+
+    def __reduce__(self):
+        # Ship only the weights to worker processes, which compile (once) on arrival
+        return _compiled_sampler, (
+            tuple(map(tuple, self.matrix.tolist())),
+            tuple(self.terrain_types),
+        )
+
+    def neighbor_key(self, neighbor_codes):
+        """
+        @brief Returns the key identifying a multiset of neighbour terrain codes.
+
+        @param neighbor_codes The terrain codes of the placed neighbours.
+
+        @return The multiset key; 0 for no neighbours.
+        """
+        key_weight = self.key_weight
+        return sum(key_weight[code] for code in neighbor_codes)
+
+    def draw(self, key, rng):
+        """
+        @brief Draws a terrain code for a hex with the given neighbours.
+
+        Uses one rng.random() call and selects exactly as random.choices would with the
+        summed neighbour weights.
+
+        @param key The non-zero neighbour multiset key.
+        @param rng The random.Random to draw from.
+
+        @return The drawn terrain code, or None if every weight is zero.
+        """
+        cum_weights, total = self._tables[key]
+        if total <= 0:
+            return None
+        return bisect(cum_weights, rng.random() * total, 0, self._hi)
+
+
+@functools.lru_cache(maxsize=8)
+def _compiled_sampler(rows, terrain_types):
+    weights = {
+        neighbor: dict(zip(terrain_types, row))
+        for neighbor, row in zip(terrain_types, rows)
+    }
+    return TerrainSampler(weights, terrain_types)
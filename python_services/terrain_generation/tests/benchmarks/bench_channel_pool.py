@@ -0,0 +1,132 @@
+"""
+@file bench_channel_pool.py
+@brief Measures the connections and bytes on the wire of persisting generated terrains.
+
+A persistence server is started behind a TCP proxy listening on the persistence port
+the generation service connects to (localhost:50052 unless VIE_PERSISTENCE_TARGET
+says otherwise). Several generation service instances are created, as the tests and
+the servers do, and each generates and persists terrains. The proxy counts the
+connections opened, each a TLS handshake, and the bytes sent each way.
+
+Run from python_services, with nothing else listening on the persistence port:
+
+    python -m terrain_generation.tests.benchmarks.bench_channel_pool [--services N]
+"""
+
+import argparse
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent import futures
+from unittest.mock import MagicMock
+
+import grpc
+
+from common.channel_pool import server_options
+from persistence import persistence_pb2_grpc
+from persistence.persistence_service import PersistenceService, server_credentials
+from terrain_generation.terrain_generation_pb2 import TerrainRequest
+from terrain_generation.terrain_generation_service import TerrainGeneratorService
+
+
+class CountingProxy:
+    """
+    @brief Forwards TCP connections to a server, counting connections and bytes.
+    """
+
+    def __init__(self, listen_port, server_port):
+        self.server_port = server_port
+        self.connections = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        self.listener.bind(("::", listen_port))
+        self.listener.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            server = socket.create_connection(("127.0.0.1", self.server_port))
+            with self.lock:
+                self.connections += 1
+            for source, sink, up in ((client, server, True), (server, client, False)):
+                threading.Thread(
+                    target=self._pipe, args=(source, sink, up), daemon=True
+                ).start()
+
+    def _pipe(self, source, sink, up):
+        try:
+            while data := source.recv(65536):
+                sink.sendall(data)
+                with self.lock:
+                    if up:
+                        self.bytes_up += len(data)
+                    else:
+                        self.bytes_down += len(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, sink):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def run(service_count, calls, tiles):
+    """
+    @brief Runs the benchmark and prints the totals.
+
+    @param service_count The number of generation service instances.
+    @param calls The number of persisted terrains per instance.
+    @param tiles The number of tiles per terrain.
+    """
+    logging.disable(logging.INFO)
+    target = os.environ.get("VIE_PERSISTENCE_TARGET", "localhost:50052")
+    with tempfile.TemporaryDirectory() as directory:
+        server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=10), options=server_options()
+        )
+        persistence_pb2_grpc.add_PersistenceServiceServicer_to_server(
+            PersistenceService(f"sqlite:///{directory}/bench.db"), server
+        )
+        server_port = server.add_secure_port("127.0.0.1:0", server_credentials)
+        server.start()
+        proxy = CountingProxy(int(target.rsplit(":", 1)[1]), server_port)
+
+        start = time.perf_counter()
+        services = [TerrainGeneratorService() for _ in range(service_count)]
+        for index, service in enumerate(services):
+            for call in range(calls):
+                request = TerrainRequest(
+                    total_land_hexagons=tiles, persist=True, seed=index * calls + call
+                )
+                assert service.GenerateTerrain(request, MagicMock()).terrain_id
+        elapsed = time.perf_counter() - start
+        server.stop(None)
+
+    print(
+        f"{'services':>10} {'calls':>10} {'tiles':>10} {'connections':>12} "
+        f"{'bytes up':>12} {'bytes down':>12} {'time':>10}"
+    )
+    print(
+        f"{service_count:>10} {service_count * calls:>10} {tiles:>10} "
+        f"{proxy.connections:>12} {proxy.bytes_up:>12} {proxy.bytes_down:>12} "
+        f"{elapsed:>9.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--services", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=3)
+    parser.add_argument("--tiles", type=int, default=20_000)
+    arguments = parser.parse_args()
+    run(arguments.services, arguments.calls, arguments.tiles)
@@ -0,0 +1,110 @@
+"""
+@file bench_suite.py
+@brief Regression-gated benchmarks of terrain generation and response serialization.
+
+Measures the time of generating terrains of several sizes with
+_generate_terrain_tiles, bypassing the terrain cache, how the per-hex time of the
+flood fill changes from small to large islands, and the time of building, serializing
+and parsing a TerrainResponse with the tiles as messages and packed. The results are
+compared with baseline.json next to this file; the run fails when a gated metric is
+worse than its baseline by more than its threshold.
+
+Run from python_services:
+
+    python -m terrain_generation.tests.benchmarks.bench_suite [--update-baseline]
+"""
+
+import logging
+import sys
+from pathlib import Path
+
+from common.benchmarking import Metric, best_time, run_suite
+from terrain_generation.terrain_engine import generate_island
+from terrain_generation.terrain_generation_pb2 import TerrainResponse
+from terrain_generation.terrain_generation_service import TerrainGeneratorService
+
+BASELINE = Path(__file__).with_name("baseline.json")
+MAP_SIZES = (1_000, 10_000, 100_000)
+SERIALIZED_TILES = 10_000
+# Island sizes whose per-hex flood fill times are compared, and the repeats of each
+ISLAND_SIZES = ((1_000, 20), (1_000_000, 1))
+REPEATS = 5
+# Serialization takes under a millisecond, so each of its samples times several calls
+SERIALIZATION_CALLS = 20
+
+
+def bench_generate_terrain_tiles():
+    """
+    @brief Times _generate_terrain_tiles at each of MAP_SIZES.
+    """
+    service = TerrainGeneratorService(cache_max_entries=0)
+    try:
+        for size in MAP_SIZES:
+            seconds = best_time(
+                lambda: service._generate_terrain_tiles(size, seed=size), REPEATS
+            )
+            yield Metric(f"generate_terrain_tiles[{size}]", seconds, "s")
+    finally:
+        service.close()
+
+
+def bench_generate_island():
+    """
+    @brief Times the flood fill per placed hex at each of ISLAND_SIZES, and the ratio
+    of the largest size's per-hex time to the smallest's, which stays near 1 while the
+    fill runs in linear time.
+    """
+    per_hex = []
+    for size, repeats in ISLAND_SIZES:
+        seconds = best_time(
+            lambda: generate_island(size, lambda x, y, neighbor_types: "plains"),
+            repeats,
+        )
+        per_hex.append(seconds / size)
+        yield Metric(f"generate_island_per_hex[{size}]", per_hex[-1], "s")
+    yield Metric("generate_island_scaling", per_hex[-1] / per_hex[0], "x")
+
+
+def bench_response_serialization():
+    """
+    @brief Times building, serializing and parsing a TerrainResponse of
+    SERIALIZED_TILES tiles, with and without packing.
+    """
+    service = TerrainGeneratorService(cache_max_entries=0)
+    try:
+        tiles = service._generate_terrain_tiles(SERIALIZED_TILES, seed=1)
+        for packed in (False, True):
+            label = "packed" if packed else "tiles"
+            response = service._create_response(tiles, "", packed)
+            payload = response.SerializeToString()
+            seconds = best_time(
+                lambda: service._create_response(tiles, "", packed),
+                REPEATS,
+                SERIALIZATION_CALLS,
+            )
+            yield Metric(f"build_response[{label}]", seconds, "s")
+            seconds = best_time(
+                response.SerializeToString, REPEATS, SERIALIZATION_CALLS
+            )
+            yield Metric(f"serialize_response[{label}]", seconds, "s")
+            seconds = best_time(
+                lambda: TerrainResponse.FromString(payload),
+                REPEATS,
+                SERIALIZATION_CALLS,
+            )
+            yield Metric(f"parse_response[{label}]", seconds, "s")
+            yield Metric(f"response_size[{label}]", len(payload), "bytes")
+    finally:
+        service.close()
+
+
+BENCHMARKS = {
+    "generate_terrain_tiles": bench_generate_terrain_tiles,
+    "generate_island": bench_generate_island,
+    "response_serialization": bench_response_serialization,
+}
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    sys.exit(run_suite(__doc__.split("\n")[2], BENCHMARKS, BASELINE))
@@ -1,12 +1,33 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
 import pytest
 import grpc
-from unittest.mock import patch, MagicMock, Mock
+from concurrent import futures
+from unittest.mock import patch, MagicMock, Mock, AsyncMock
 from pathlib import Path
 from black import format_file_in_place, FileMode, WriteBack
-from terrain_generation.terrain_generation_service import TerrainGeneratorService
-from terrain_generation.terrain_generation_pb2 import TerrainRequest, TerrainResponse, TerrainTile
+from terrain_generation.terrain_generation_service import TILES_GENERATED, TerrainGeneratorService, AsyncTerrainGeneratorService
+from terrain_generation.terrain_generation_pb2 import TerrainRequest, TerrainResponse, TerrainTile, TerrainChunk, GenerationParams, WorldChunkRequest, PersistenceStatusRequest, PERSISTENCE_STATUS_UNKNOWN, PERSISTENCE_STATUS_DURABLE
+from terrain_generation.terrain_generation_pb2_grpc import TerrainGenerationServiceStub, add_TerrainGenerationServiceServicer_to_server
 from persistence.persistence_service import PersistenceService
-from persistence.persistence_pb2 import StoreTerrainRequest, TerrainTile
+from persistence.persistence_pb2_grpc import PersistenceServiceStub, add_PersistenceServiceServicer_to_server
+from persistence.persistence_pb2 import StoreTerrainRequest, TerrainTile, RetrieveTerrainRequest
+from terrain_generation.terrain_engine import (
+    generate_island,
+    island_radius,
+    HEX_NEIGHBOR_OFFSETS,
+)
+from terrain_generation.elevation import ElevationField, perlin_noise_2d
+from terrain_generation.parallel_generation import generate_island_parallel, island_coordinates
+from terrain_generation.chunk_generation import generate_chunk
+from common.tile_arrays import TileArrays
+from common import channel_pool, logging_config, metrics, tracing, write_behind
+from common.tracing_interceptor import TracingInterceptor
+from common.benchmarking import Metric, find_regressions, load_baseline, run_suite, save_baseline
+from common.write_behind import WriteBehindQueue
 
 @pytest.fixture(scope='module')
 def persistence_service():
@@ -156,23 +177,26 @@ def test_generate_terrain_with_transaction():
     Tests the terrain generation with transaction management.
     
     @pre TerrainGeneratorService is initialized
-    @post A TerrainResponse with the expected number of tiles is returned and transaction is committed
+    @post A TerrainResponse with the expected number of tiles is returned and the terrain is stored in one atomic call
     """
     service = TerrainGeneratorService()
     request = TerrainRequest(total_land_hexagons=5, persist=1)
     context = MagicMock()
 
     with patch.object(service, 'persistence_stub', autospec=True) as mock_stub:
-        mock_stub.BeginTransaction.return_value = MagicMock(transaction_id='1234')
-        mock_stub.StoreTerrain.return_value = MagicMock(terrain_id='5678')
-        mock_stub.CommitTransaction.return_value = MagicMock()
+        mock_stub.StoreTerrainAtomic.return_value = MagicMock(terrain_id='5678')
 
         response = service.GenerateTerrain(request, context)
 
-        mock_stub.BeginTransaction.assert_called_once()
-        mock_stub.StoreTerrain.assert_called_once()
-        mock_stub.CommitTransaction.assert_called_once()
+        mock_stub.StoreTerrainAtomic.assert_called_once()
+        mock_stub.BeginTransaction.assert_not_called()
+        mock_stub.CommitTransaction.assert_not_called()
+        stored = TileArrays.from_packed(mock_stub.StoreTerrainAtomic.call_args[0][0].packed_tiles)
+        assert [(tile.x, tile.y, tile.terrain_type) for tile in stored] == [
+            (tile.x, tile.y, tile.terrain_type) for tile in response.tiles
+        ]
         assert isinstance(response, TerrainResponse)
+        assert response.terrain_id == "5678"
         assert len(response.tiles) == 5
 
 def test_store_terrain(persistence_service):
@@ -201,9 +225,9 @@ def test_generate_terrain_with_error_handling():
     request = TerrainRequest(total_land_hexagons=5, persist=1)
     context = MagicMock()
 
-    # Mock the persistence stub to raise an exception during StoreTerrain
+    # Mock the persistence stub to raise an exception while storing
     with patch.object(service, 'persistence_stub', autospec=True) as mock_stub:
-        mock_stub.StoreTerrain.side_effect = Exception("Simulated storage error")
+        mock_stub.StoreTerrainAtomic.side_effect = Exception("Simulated storage error")
 
         response = service.GenerateTerrain(request, context)
 
@@ -211,4 +235,1054 @@ def test_generate_terrain_with_error_handling():
         context.set_code.assert_called_once_with(grpc.StatusCode.INTERNAL)
         context.set_details.assert_called_once_with('Failed to store terrain')  # Ensure this matches the actual error message
         assert isinstance(response, TerrainResponse)
-        assert len(response.tiles) == 0
\ No newline at end of file
+        assert len(response.tiles) == 0
+
+def test_generate_island_is_connected():
+    """
+    @test Generate Island Connectivity
+    Verifies that every hex of a flood-filled island is reachable from the origin through placed hexes.
+
+    @pre The terrain engine is importable
+    @post The island has the requested size, no duplicate coordinates and a single connected component
+    """
+    island = generate_island(2000, lambda x, y, neighbor_types: "plains")
+    assert len(island) == 2000
+
+    reached = {(0, 0)}
+    stack = [(0, 0)]
+    while stack:
+        x, y = stack.pop()
+        for dx, dy in HEX_NEIGHBOR_OFFSETS:
+            coord = (x + dx, y + dy)
+            if coord in island and coord not in reached:
+                reached.add(coord)
+                stack.append(coord)
+    assert reached == set(island)
+
+
+def test_generate_island_passes_placed_neighbors():
+    """
+    @test Generate Island Neighbor Lookup
+    Verifies that the terrain chooser receives the terrain types of every already placed neighbour.
+
+    @pre The terrain engine is importable
+    @post Each chooser call sees exactly the neighbours placed before the hex itself
+    """
+    calls = []
+
+    def choose(x, y, neighbor_types):
+        calls.append(len(neighbor_types))
+        return "plains"
+
+    island = generate_island(50, choose)
+    order = list(island)
+    for index, (x, y) in enumerate(order):
+        earlier = set(order[:index])
+        expected = sum(
+            (x + dx, y + dy) in earlier for dx, dy in HEX_NEIGHBOR_OFFSETS
+        )
+        assert calls[index] == expected
+
+
+def test_generate_island_scales_linearly():
+    """
+    @test Generate Island Scaling
+    Verifies that the flood fill does a fixed number of neighbour lookups per placed hex, so it runs in linear time.
+
+    @pre The terrain engine is importable
+    @post From 1k to 100k hexes, exactly six neighbours are looked up per placed hex
+    """
+    lookups = [0]
+
+    class CountingOffsets(tuple):
+        def __iter__(self):
+            for offset in tuple.__iter__(self):
+                lookups[0] += 1
+                yield offset
+
+    with patch("terrain_generation.terrain_engine.HEX_NEIGHBOR_OFFSETS", CountingOffsets(HEX_NEIGHBOR_OFFSETS)):
+        for count in (1_000, 100_000):
+            lookups[0] = 0
+            island = generate_island(count, lambda x, y, neighbor_types: "plains")
+            assert len(island) == count
+            assert lookups[0] == 6 * count
+
+
+def test_perlin_noise_matches_reference():
+    """
+    @test Perlin Noise Reference
+    Verifies that the vectorised noise field reproduces noise.pnoise2 point for point.
+
+    @pre The noise package is installed
+    @post Every sampled point agrees with noise.pnoise2 to single precision
+    """
+    import numpy as np
+    import noise
+
+    rng = np.random.default_rng(7)
+    xs = rng.uniform(-300, 300, 2000)
+    ys = rng.uniform(-300, 300, 2000)
+    expected = np.array([noise.pnoise2(x, y) for x, y in zip(xs, ys)])
+    assert np.allclose(perlin_noise_2d(xs, ys), expected, atol=1e-4)
+
+
+def test_island_fits_elevation_field():
+    """
+    @test Island Radius
+    Verifies that the island radius bounds every flood-filled tile, so the elevation field covers the island.
+
+    @pre The terrain engine is importable
+    @post Every tile coordinate lies within the radius
+    """
+    for count in (1, 2, 7, 8, 500, 4321):
+        radius = island_radius(count)
+        island = generate_island(count, lambda x, y, neighbor_types: "plains")
+        assert all(abs(x) <= radius and abs(y) <= radius for x, y in island)
+        field = ElevationField(radius, 0.1)
+        assert field.values.shape == (2 * radius + 1, 2 * radius + 1)
+
+
+def test_terrain_follows_elevation():
+    """
+    @test Terrain Follows Elevation
+    Verifies that high ground becomes mountain or hills and low ground becomes lake.
+
+    @pre TerrainGeneratorService is initialized
+    @post Every tile past an elevation threshold has the matching terrain type
+    """
+    from terrain_generation import terrain_engine
+
+    fields = []
+
+    def record_field(*args, **kwargs):
+        fields.append(ElevationField(*args, **kwargs))
+        return fields[-1]
+
+    with patch('terrain_generation.terrain_generation_service.ElevationField', side_effect=record_field):
+        tiles = TerrainGeneratorService()._generate_terrain_tiles(5000)
+    field = fields[0]
+    assert field.radius == island_radius(5000)
+    for tile in tiles:
+        height = field.at(tile.x, tile.y)
+        if height >= terrain_engine.MOUNTAIN_ELEVATION:
+            assert tile.terrain_type == "mountain"
+        elif height >= terrain_engine.HILLS_ELEVATION:
+            assert tile.terrain_type == "hills"
+        elif height <= terrain_engine.LAKE_ELEVATION:
+            assert tile.terrain_type == "lake"
+
+
+def test_generate_terrain_stream_chunks():
+    """
+    @test Generate Terrain Stream Chunks
+    Verifies that streamed generation yields chunks of the requested size followed by a final message.
+
+    @pre TerrainGeneratorService is initialized
+    @post All tiles arrive in chunks no larger than chunk_size, and only the final message has final set
+    """
+    service = TerrainGeneratorService()
+    request = TerrainRequest(total_land_hexagons=250, persist=0, chunk_size=100)
+    context = MagicMock()
+
+    chunks = list(service.GenerateTerrainStream(request, context))
+
+    assert [len(chunk.tiles) for chunk in chunks] == [100, 100, 50, 0]
+    assert all(isinstance(chunk, TerrainChunk) for chunk in chunks)
+    assert [chunk.final for chunk in chunks] == [False, False, False, True]
+    coords = {(tile.x, tile.y) for chunk in chunks for tile in chunk.tiles}
+    assert len(coords) == 250
+    context.set_code.assert_not_called()
+
+
+def test_generate_terrain_stream_persist():
+    """
+    @test Generate Terrain Stream Persist
+    Verifies that a persisted streamed terrain reports its terrain ID on the final message.
+
+    @pre TerrainGeneratorService is initialized
+    @post Every streamed tile is persisted and the final message carries the terrain ID
+    """
+    service = TerrainGeneratorService()
+    request = TerrainRequest(total_land_hexagons=30, persist=1, chunk_size=8)
+    context = MagicMock()
+
+    with patch.object(service, 'persistence_stub', autospec=True) as mock_stub:
+        mock_stub.StoreTerrainAtomic.return_value = MagicMock(terrain_id='5678')
+
+        chunks = list(service.GenerateTerrainStream(request, context))
+
+        mock_stub.StoreTerrainAtomic.assert_called_once()
+        stored = mock_stub.StoreTerrainAtomic.call_args[0][0]
+        assert len(stored.packed_tiles.terrain_codes) == 30
+        assert chunks[-1].final
+        assert chunks[-1].terrain_id == '5678'
+
+
+def test_generate_terrain_stream_invalid_input():
+    """
+    @test Generate Terrain Stream Invalid Input
+    Verifies that an invalid streaming request yields nothing and sets an error status.
+
+    @pre TerrainGeneratorService is initialized
+    @post The gRPC context is set with INVALID_ARGUMENT
+    """
+    service = TerrainGeneratorService()
+    context = MagicMock()
+
+    chunks = list(service.GenerateTerrainStream(TerrainRequest(total_land_hexagons=0), context))
+
+    assert chunks == []
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def test_generate_terrain_seed_is_reproducible():
+    """
+    @test Seeded Generation
+    Verifies that the same seed and parameters always generate the same terrain.
+
+    @pre Two TerrainGeneratorService instances with separate caches
+    @post Equal seeds give identical tiles, different seeds give different tiles, and the seed is echoed back
+    """
+    request = TerrainRequest(total_land_hexagons=400, seed=42)
+    first = TerrainGeneratorService().GenerateTerrain(request, MagicMock())
+    second = TerrainGeneratorService().GenerateTerrain(request, MagicMock())
+    other = TerrainGeneratorService().GenerateTerrain(TerrainRequest(total_land_hexagons=400, seed=43), MagicMock())
+
+    assert first.seed == 42
+    assert list(first.tiles) == list(second.tiles)
+    assert [t.terrain_type for t in first.tiles] != [t.terrain_type for t in other.tiles]
+
+    unseeded = TerrainGeneratorService().GenerateTerrain(TerrainRequest(total_land_hexagons=400), MagicMock())
+    replay = TerrainGeneratorService().GenerateTerrain(TerrainRequest(total_land_hexagons=400, seed=unseeded.seed), MagicMock())
+    assert list(unseeded.tiles) == list(replay.tiles)
+
+
+def test_generate_terrain_params():
+    """
+    @test Generation Parameters
+    Verifies that generation parameters take effect and invalid ones are rejected.
+
+    @pre TerrainGeneratorService is initialized
+    @post A mountain threshold below every elevation gives an all-mountain terrain; a zero noise scale is rejected
+    """
+    service = TerrainGeneratorService()
+    request = TerrainRequest(total_land_hexagons=50, seed=1, params=GenerationParams(mountain_elevation=-2.0))
+    response = service.GenerateTerrain(request, MagicMock())
+    assert {tile.terrain_type for tile in response.tiles} == {"mountain"}
+
+    context = MagicMock()
+    request = TerrainRequest(total_land_hexagons=50, params=GenerationParams(noise_scale=0.0))
+    service.GenerateTerrain(request, context)
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def test_generate_terrain_cache():
+    """
+    @test Generated Terrain Cache
+    Verifies that repeated seeded requests are served from the cache without regenerating.
+
+    @pre TerrainGeneratorService is initialized
+    @post The second request is a cache hit that returns the same tiles, for both unary and streaming calls
+    """
+    service = TerrainGeneratorService()
+    request = TerrainRequest(total_land_hexagons=300, seed=7, chunk_size=100)
+    first = service.GenerateTerrain(request, MagicMock())
+    assert service.terrain_cache.misses == 1
+
+    with patch.object(service, '_iter_terrain_codes') as mock_generate:
+        second = service.GenerateTerrain(request, MagicMock())
+        chunks = list(service.GenerateTerrainStream(request, MagicMock()))
+        mock_generate.assert_not_called()
+
+    assert service.terrain_cache.hits == 2
+    assert list(second.tiles) == list(first.tiles)
+    assert [tile for chunk in chunks for tile in chunk.tiles] == list(first.tiles)
+
+
+def test_generate_terrain_packed():
+    """
+    @test Packed Terrain Encoding
+    Verifies that the packed columnar encoding carries the same tiles as the per-tile messages, in less space.
+
+    @pre TerrainGeneratorService is initialized
+    @post Decoding the packed unary response and the packed stream gives the tiles of the unpacked response
+    """
+    service = TerrainGeneratorService()
+    plain = service.GenerateTerrain(TerrainRequest(total_land_hexagons=500, seed=3), MagicMock())
+    packed = service.GenerateTerrain(TerrainRequest(total_land_hexagons=500, seed=3, packed=True), MagicMock())
+
+    assert len(packed.tiles) == 0
+    assert packed.seed == plain.seed
+    expected = [(tile.x, tile.y, tile.terrain_type) for tile in plain.tiles]
+    decoded = TileArrays.from_packed(packed.packed_tiles)
+    assert [(tile.x, tile.y, tile.terrain_type) for tile in decoded] == expected
+    assert packed.ByteSize() < plain.ByteSize() / 2
+
+    request = TerrainRequest(total_land_hexagons=500, seed=3, chunk_size=200, packed=True)
+    chunks = list(service.GenerateTerrainStream(request, MagicMock()))
+    streamed = [
+        (tile.x, tile.y, tile.terrain_type)
+        for chunk in chunks[:-1]
+        for tile in TileArrays.from_packed(chunk.packed_tiles)
+    ]
+    assert streamed == expected
+
+
+def test_generate_terrain_cache_eviction():
+    """
+    @test Generated Terrain Cache Eviction
+    Verifies that the cache evicts the least recently used terrain when it runs out of room.
+
+    @pre TerrainGeneratorService is initialized with room for two terrains
+    @post The least recently used terrain is evicted and the cache stays within its bounds
+    """
+    service = TerrainGeneratorService(cache_max_entries=2)
+    for seed in (1, 2, 1, 3):
+        service._generate_terrain_tiles(20, seed)
+
+    stats = service.terrain_cache.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+    keys = {key[0] for key in service.terrain_cache._entries}
+    assert keys == {1, 3}
+
+
+def _is_connected(coords):
+    coords = set(coords)
+    start = next(iter(coords))
+    reached = {start}
+    stack = [start]
+    while stack:
+        x, y = stack.pop()
+        for dx, dy in HEX_NEIGHBOR_OFFSETS:
+            coord = (x + dx, y + dy)
+            if coord in coords and coord not in reached:
+                reached.add(coord)
+                stack.append(coord)
+    return reached == coords
+
+
+def test_island_coordinates_are_contiguous():
+    """
+    @test Island Coordinates
+    Verifies that the up-front island layout used for parallel generation is contiguous and of the requested size.
+
+    @pre The parallel generation module is importable
+    @post Each layout has exactly the requested number of distinct, connected hexes
+    """
+    for count in (1, 7, 8, 100, 3001):
+        xs, ys = island_coordinates(count)
+        coords = list(zip(xs.tolist(), ys.tolist()))
+        assert len(set(coords)) == count
+        assert _is_connected(coords)
+
+
+def test_generate_island_parallel_stitches_blocks():
+    """
+    @test Parallel Generation Stitching
+    Verifies that block-wise generation gives a contiguous island that does not depend on the number of workers.
+
+    @pre The parallel generation module is importable
+    @post The result is contiguous, has valid terrain types and is identical for one and four workers
+    """
+    from concurrent import futures
+    from terrain_generation.terrain_engine import GenerationSettings
+
+    sampler = TerrainGeneratorService().terrain_sampler
+    with futures.ThreadPoolExecutor(max_workers=1) as single, futures.ThreadPoolExecutor(max_workers=4) as multiple:
+        first = generate_island_parallel(5000, 11, GenerationSettings(), sampler, single, block_size=8)
+        second = generate_island_parallel(5000, 11, GenerationSettings(), sampler, multiple, block_size=8)
+
+    assert first == second
+    assert len(first) == 5000
+    assert _is_connected((x, y) for x, y, _ in first)
+    assert {code for _, _, code in first} <= set(range(6))
+
+
+def test_generate_terrain_switches_to_parallel_mode():
+    """
+    @test Parallel Generation Mode
+    Verifies that the service generates maps at or above the threshold on its process pool.
+
+    @pre TerrainGeneratorService is initialized with a low parallel threshold and two workers
+    @post Small maps are generated sequentially, large maps on the pool, and both are contiguous
+    """
+    service = TerrainGeneratorService(parallel_threshold=500, generation_workers=2, parallel_block_size=8)
+    try:
+        with patch('terrain_generation.terrain_generation_service.generate_island_parallel', wraps=generate_island_parallel) as parallel:
+            small = service.GenerateTerrain(TerrainRequest(total_land_hexagons=499, seed=3), MagicMock())
+            parallel.assert_not_called()
+            large = service.GenerateTerrain(TerrainRequest(total_land_hexagons=2000, seed=3), MagicMock())
+            parallel.assert_called_once()
+    finally:
+        service.close()
+
+    assert len(small.tiles) == 499
+    assert len(large.tiles) == 2000
+    assert _is_connected((tile.x, tile.y) for tile in large.tiles)
+
+
+def test_terrain_sampler_matches_weighted_choice():
+    """
+    @test Terrain Sampler Equivalence
+    Verifies that the compiled sampler draws exactly what a per-tile random.choices over summed neighbour weights would.
+
+    @pre TerrainGeneratorService is initialized
+    @post For the same random stream, every draw agrees with random.choices
+    """
+    import random
+
+    service = TerrainGeneratorService()
+    weights = service._get_terrain_weights()
+    sampler = service.terrain_sampler
+    types = sampler.terrain_types
+    pick = random.Random(5)
+    reference_rng = random.Random(99)
+    sampler_rng = random.Random(99)
+
+    for _ in range(5000):
+        neighbors = sorted(pick.choices(range(6), k=pick.randint(1, 6)))
+        summed = [sum(weights[types[n]].get(t, 0) for n in neighbors) for t in types]
+        expected = reference_rng.choices(range(6), weights=summed, k=1)[0]
+        key = sampler.neighbor_key(neighbors)
+        assert sampler.draw(key, sampler_rng) == expected
+
+
+def test_terrain_sampler_pickles_compactly():
+    """
+    @test Terrain Sampler Pickling
+    Verifies that the sampler sent to worker processes carries only its weights.
+
+    @pre TerrainGeneratorService is initialized
+    @post The pickled sampler is small and unpickles to an equivalent sampler
+    """
+    import pickle
+    import random
+
+    sampler = TerrainGeneratorService().terrain_sampler
+    payload = pickle.dumps(sampler)
+    assert len(payload) < 2048
+
+    restored = pickle.loads(payload)
+    assert restored.terrain_types == sampler.terrain_types
+    key = sampler.neighbor_key([0, 2, 2, 5])
+    assert [restored.draw(key, random.Random(i)) for i in range(50)] == [sampler.draw(key, random.Random(i)) for i in range(50)]
+
+
+def test_generate_chunk_borders():
+    """
+    @test World Chunk Borders
+    Verifies that world chunks are deterministic and tile the plane consistently with their neighbours.
+
+    @pre The chunk generation module is importable
+    @post Chunks do not depend on generation order, cover each hex exactly once and every hex next to a border has a neighbour-weighted terrain
+    """
+    from terrain_generation.terrain_engine import GenerationSettings
+
+    sampler = TerrainGeneratorService().terrain_sampler
+    settings = GenerationSettings()
+    coords = [(q, r) for q in (-1, 0, 1) for r in (-1, 0, 1)]
+    chunks = {coord: generate_chunk(5, coord[0], coord[1], 8, settings, sampler) for coord in coords}
+    reversed_chunks = {coord: generate_chunk(5, coord[0], coord[1], 8, settings, sampler) for coord in reversed(coords)}
+    assert chunks == reversed_chunks
+
+    tiles = {}
+    for chunk in chunks.values():
+        assert len(chunk) == 64
+        for x, y, code in chunk:
+            assert (x, y) not in tiles
+            tiles[(x, y)] = code
+    assert set(tiles) == {(x, y) for x in range(-8, 16) for y in range(-8, 16)}
+    assert set(tiles.values()) <= set(range(6))
+    assert generate_chunk(6, 0, 0, 8, settings, sampler) != chunks[(0, 0)]
+
+
+def test_get_terrain_chunk():
+    """
+    @test Get Terrain Chunk
+    Verifies that chunks are generated once, memoized, and persisted at most once.
+
+    @pre TerrainGeneratorService is initialized with a mocked persistence stub
+    @post Repeated requests hit the chunk cache, the packed and unpacked encodings agree, the chunk is stored once, persisting it again after it left the cache reuses its terrain ID, and chunks with coordinates beyond 32 bits are rejected
+    """
+    service = TerrainGeneratorService(world_chunk_size=16)
+    service.persistence_stub = MagicMock()
+    service.persistence_stub.StoreTerrainAtomic.return_value.terrain_id = "chunk-id"
+
+    request = WorldChunkRequest(world_seed=9, chunk_q=-2, chunk_r=3)
+    response = service.GetTerrainChunk(request, MagicMock())
+    assert response.chunk_size == 16
+    assert len(response.tiles) == 256
+    assert {(tile.x // 16, tile.y // 16) for tile in response.tiles} == {(-2, 3)}
+    assert response.terrain_id == ""
+
+    packed_request = WorldChunkRequest(world_seed=9, chunk_q=-2, chunk_r=3, packed=True)
+    packed = service.GetTerrainChunk(packed_request, MagicMock())
+    decoded = TileArrays.from_packed(packed.packed_tiles)
+    assert [(tile.x, tile.y, tile.terrain_type) for tile in decoded] == [
+        (tile.x, tile.y, tile.terrain_type) for tile in response.tiles
+    ]
+    assert service.chunk_cache.misses == 1
+    assert service.chunk_cache.hits == 1
+
+    persist_request = WorldChunkRequest(world_seed=9, chunk_q=-2, chunk_r=3, persist=True)
+    assert service.GetTerrainChunk(persist_request, MagicMock()).terrain_id == "chunk-id"
+    assert service.GetTerrainChunk(persist_request, MagicMock()).terrain_id == "chunk-id"
+    service.persistence_stub.StoreTerrainAtomic.assert_called_once()
+    stored_id = service.persistence_stub.StoreTerrainAtomic.call_args[0][0].terrain_id
+    assert stored_id
+
+    service.chunk_cache.clear()
+    service.GetTerrainChunk(persist_request, MagicMock())
+    assert service.persistence_stub.StoreTerrainAtomic.call_args[0][0].terrain_id == stored_id
+    other_request = WorldChunkRequest(world_seed=9, chunk_q=-2, chunk_r=4, persist=True)
+    service.GetTerrainChunk(other_request, MagicMock())
+    assert service.persistence_stub.StoreTerrainAtomic.call_args[0][0].terrain_id != stored_id
+
+    edge_request = WorldChunkRequest(world_seed=9, chunk_q=2**31 // 16 - 2, chunk_r=-(2**31) // 16)
+    assert len(service.GetTerrainChunk(edge_request, MagicMock()).tiles) == 256
+    for chunk_q, chunk_r in ((2**31 // 16 - 1, 0), (0, -(2**31) // 16 - 1), (2**31 - 1, 0)):
+        context = MagicMock()
+        request = WorldChunkRequest(world_seed=9, chunk_q=chunk_q, chunk_r=chunk_r)
+        assert not service.GetTerrainChunk(request, context).tiles
+        context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def test_get_terrain_chunk_persist_locking():
+    """
+    @test Get Terrain Chunk Persist Locking
+    Verifies that concurrent requests persisting the same world chunk store it once, without holding up requests persisting other chunks.
+
+    @pre TerrainGeneratorService with a mocked persistence stub that holds back its first store
+    @post A second chunk is persisted while the first is in flight, both requests for the first chunk get one terrain ID, and no lock is left behind
+    """
+    service = TerrainGeneratorService(world_chunk_size=8)
+    first_started = threading.Event()
+    release = threading.Event()
+    calls = []
+    released = []
+
+    def store_terrain_atomic(request, compression=None, metadata=None):
+        calls.append(request)
+        terrain_id = f"id-{len(calls)}"
+        if len(calls) == 1:
+            first_started.set()
+            # Only released once the other chunk is persisted, so a lock shared by all
+            # chunks times this out
+            released.append(release.wait(5))
+        return MagicMock(terrain_id=terrain_id)
+
+    service.persistence_stub = MagicMock()
+    service.persistence_stub.StoreTerrainAtomic.side_effect = store_terrain_atomic
+    first_chunk = WorldChunkRequest(world_seed=1, chunk_q=0, chunk_r=0, persist=True)
+    other_chunk = WorldChunkRequest(world_seed=1, chunk_q=1, chunk_r=0, persist=True)
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(service.GetTerrainChunk, first_chunk, MagicMock())
+        assert first_started.wait(5)
+        duplicate = pool.submit(service.GetTerrainChunk, first_chunk, MagicMock())
+        assert service.GetTerrainChunk(other_chunk, MagicMock()).terrain_id == "id-2"
+        release.set()
+        assert first.result().terrain_id == duplicate.result().terrain_id == "id-1"
+    assert len(calls) == 2 and released == [True]
+    assert len(service._chunk_persist_locks) == 0
+
+def test_async_generate_terrain():
+    """
+    @test Async Terrain Generation
+    Verifies that the grpc.aio servicer generates the same terrain as the synchronous one and persists through an async stub.
+
+    @pre AsyncTerrainGeneratorService is initialized with a mocked grpc.aio persistence stub
+    @post Unary, streamed and chunk responses match the synchronous service, and persisting awaits the stub
+    """
+    service = AsyncTerrainGeneratorService(executor_workers=2, world_chunk_size=8)
+    stub = MagicMock()
+    stub.StoreTerrainAtomic = AsyncMock(return_value=MagicMock(terrain_id="terrain-id"))
+    service._async_persistence_stub = stub
+    expected = TerrainGeneratorService().GenerateTerrain(TerrainRequest(total_land_hexagons=300, seed=4), MagicMock())
+
+    async def run():
+        unary, chunks = await asyncio.gather(
+            service.GenerateTerrain(TerrainRequest(total_land_hexagons=300, seed=4, persist=True), MagicMock()),
+            _collect(service.GenerateTerrainStream(TerrainRequest(total_land_hexagons=300, seed=4, chunk_size=128), MagicMock())),
+        )
+        world_chunk = await service.GetTerrainChunk(WorldChunkRequest(world_seed=4), MagicMock())
+        return unary, chunks, world_chunk
+
+    async def _collect(stream):
+        return [chunk async for chunk in stream]
+
+    try:
+        unary, chunks, world_chunk = asyncio.run(run())
+    finally:
+        service.close()
+
+    assert list(unary.tiles) == list(expected.tiles)
+    assert unary.terrain_id == "terrain-id"
+    assert len(stub.StoreTerrainAtomic.await_args.args[0].packed_tiles.terrain_codes) == 300
+    stub.StoreTerrainAtomic.assert_awaited_once()
+    assert [len(chunk.tiles) for chunk in chunks] == [128, 128, 44, 0]
+    assert [tile for chunk in chunks for tile in chunk.tiles] == list(expected.tiles)
+    assert len(world_chunk.tiles) == 64
+
+
+def test_async_get_terrain_chunk_persist_locking():
+    """
+    @test Async Get Terrain Chunk Persist Locking
+    Verifies that concurrent grpc.aio requests persisting the same world chunk store it once, while other chunks are persisted alongside.
+
+    @pre AsyncTerrainGeneratorService with a mocked grpc.aio persistence stub that holds back each store
+    @post Two requests for one chunk get one terrain ID from one store, a request for another chunk is stored concurrently under its own chosen ID, and no lock is left behind
+    """
+    service = AsyncTerrainGeneratorService(executor_workers=2, world_chunk_size=8)
+    in_flight = []
+    most_in_flight = []
+
+    async def store_terrain_atomic(request, compression=None, metadata=None):
+        in_flight.append(request)
+        most_in_flight.append(len(in_flight))
+        terrain_id = f"id-{len(most_in_flight)}"
+        await asyncio.sleep(0.05)
+        in_flight.remove(request)
+        return MagicMock(terrain_id=terrain_id)
+
+    stub = MagicMock()
+    stub.StoreTerrainAtomic = AsyncMock(side_effect=store_terrain_atomic)
+    service._async_persistence_stub = stub
+    first_chunk = WorldChunkRequest(world_seed=1, chunk_q=0, chunk_r=0, persist=True)
+    other_chunk = WorldChunkRequest(world_seed=1, chunk_q=1, chunk_r=0, persist=True)
+
+    async def run():
+        return await asyncio.gather(
+            service.GetTerrainChunk(first_chunk, MagicMock()),
+            service.GetTerrainChunk(first_chunk, MagicMock()),
+            service.GetTerrainChunk(other_chunk, MagicMock()),
+        )
+
+    try:
+        first, duplicate, other = asyncio.run(run())
+    finally:
+        service.close()
+
+    assert first.terrain_id == duplicate.terrain_id
+    assert other.terrain_id and other.terrain_id != first.terrain_id
+    assert stub.StoreTerrainAtomic.await_count == 2
+    stored_ids = {call.args[0].terrain_id for call in stub.StoreTerrainAtomic.await_args_list}
+    assert len(stored_ids) == 2 and "" not in stored_ids
+    assert max(most_in_flight) == 2
+    assert len(service._async_chunk_persist_locks) == 0
+
+def test_write_behind_queue():
+    """
+    @test Write-Behind Queue
+    Verifies batching, backpressure, retries and per-item fallback of the background writer.
+
+    @pre A WriteBehindQueue whose writes can be held back and made to fail
+    @post Producers block when the queue is full, queued items are written in batches, transient failures are retried, and only the bad item of a failing batch fails
+    """
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+    failures = {"transient": 1}
+
+    def write_batch(items):
+        started.set()
+        release.wait()
+        if "bad" in items:
+            raise RuntimeError("bad item")
+        if failures["transient"]:
+            failures["transient"] -= 1
+            raise RuntimeError("transient")
+        batches.append(list(items))
+
+    writer = WriteBehindQueue(write_batch, max_pending=3, batch_size=4, max_attempts=3, retry_delay=0)
+    writer.submit("first", "first")
+    assert started.wait(5)  # The writer holds the first item, so three more fill the queue
+    for key in ("a", "bad", "c"):
+        writer.submit(key, key)
+    with pytest.raises(queue.Full):
+        writer.submit("d", "d", timeout=0.01)
+    assert writer.status("d") is None
+    assert writer.status("a") == (write_behind.PENDING, "")
+
+    release.set()
+    writer.flush()
+    assert batches == [["first"], ["a"], ["c"]]
+    assert writer.status("first") == (write_behind.DURABLE, "")
+    assert writer.status("c") == (write_behind.DURABLE, "")
+    assert writer.status("bad") == (write_behind.FAILED, "bad item")
+    writer.close()
+
+
+def test_generate_terrain_persist_async(persistence_service):
+    """
+    @test Generate Terrain Persist Async
+    Verifies that persist_async returns the terrain ID before the terrain is stored and reports when it is durable.
+
+    @pre TerrainGeneratorService whose persistence stub calls a PersistenceService directly and fails once
+    @post The response carries the terrain ID at once, the retried write stores the terrain under that ID, and its status becomes durable
+    """
+    service = TerrainGeneratorService()
+    calls = []
+
+    def store_terrain_batch(request, compression=None):
+        calls.append(request)
+        if len(calls) == 1:
+            raise grpc.RpcError("unavailable")
+        return persistence_service.StoreTerrainBatch(request, MagicMock())
+
+    service.persistence_stub = MagicMock()
+    service.persistence_stub.StoreTerrainBatch.side_effect = store_terrain_batch
+    request = TerrainRequest(total_land_hexagons=40, persist=True, persist_async=True)
+    with patch("terrain_generation.terrain_generation_service.WRITE_BEHIND_RETRY_DELAY", 0):
+        response = service.GenerateTerrain(request, MagicMock())
+        terrain_id = response.terrain_id
+        assert terrain_id
+        service._write_behind.flush()
+
+    status = service.GetPersistenceStatus(PersistenceStatusRequest(terrain_id=terrain_id), MagicMock())
+    assert status.status == PERSISTENCE_STATUS_DURABLE
+    unknown = service.GetPersistenceStatus(PersistenceStatusRequest(terrain_id="unknown"), MagicMock())
+    assert unknown.status == PERSISTENCE_STATUS_UNKNOWN
+    assert len(calls) == 2
+    service.persistence_stub.StoreTerrainAtomic.assert_not_called()
+    stored = persistence_service.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=terrain_id), MagicMock())
+    assert sorted((tile.x, tile.y, tile.terrain_type) for tile in stored.tiles) == sorted(
+        (tile.x, tile.y, tile.terrain_type) for tile in response.tiles
+    )
+    service.close()
+
+
+def test_generate_terrain_persist_stream(persistence_service):
+    """
+    @test Generate Terrain Persist Stream
+    Verifies that a terrain above the streaming threshold is uploaded as a stream of packed chunks.
+
+    @pre TerrainGeneratorService whose persistence stub calls a PersistenceService directly, with small streaming thresholds
+    @post The terrain is uploaded in batches of at most the batch size, the terrain ID is sent once, and every tile is stored
+    """
+    service = TerrainGeneratorService()
+    chunks = []
+
+    def store_terrain_stream(request_iterator, compression=None, metadata=None):
+        def record():
+            for chunk in request_iterator:
+                chunks.append(chunk)
+                yield chunk
+
+        return persistence_service.StoreTerrainStream(record(), MagicMock())
+
+    service.persistence_stub = MagicMock()
+    service.persistence_stub.StoreTerrainStream.side_effect = store_terrain_stream
+    request = TerrainRequest(total_land_hexagons=50, persist=True)
+    with patch(
+        "terrain_generation.terrain_generation_service.STREAM_PERSIST_THRESHOLD", 20
+    ), patch("terrain_generation.terrain_generation_service.PERSIST_STREAM_BATCH_SIZE", 8):
+        response = service.GenerateTerrain(request, MagicMock())
+
+    service.persistence_stub.StoreTerrainAtomic.assert_not_called()
+    assert [len(chunk.packed_tiles.terrain_codes) for chunk in chunks] == [8] * 6 + [2]
+    assert [bool(chunk.terrain_id) for chunk in chunks] == [False] * 7
+    stored = persistence_service.RetrieveTerrain(
+        RetrieveTerrainRequest(terrain_id=response.terrain_id), MagicMock()
+    )
+    assert len(stored.tiles) == 50
+
+
+def test_channel_pool():
+    """
+    @test Channel Pool
+    Verifies that gRPC client channels are shared per target, credentials and event loop, and that compression depends on payload size.
+
+    @pre A ChannelPool and a PersistenceService server accepting pooled channels
+    @post Equal requests return the same channel, a gzip-compressed call is served, generation services add no channels, and unknown algorithms raise ValueError
+    """
+    pool = channel_pool.ChannelPool()
+    channel = pool.channel("localhost:1")
+    assert pool.channel("localhost:1") is channel
+    assert pool.channel("localhost:2") is not channel
+    assert pool.channel("localhost:1", authority="localhost") is not channel
+    assert len(pool) == 3
+
+    async def aio_channel():
+        return pool.aio_channel("localhost:1"), pool.aio_channel("localhost:1")
+
+    first, again = asyncio.run(aio_channel())
+    assert first is again
+    second, _ = asyncio.run(aio_channel())
+    assert second is not first
+    # The channel of the first, closed loop is dropped when the second loop opens its own
+    assert len(pool) == 4
+    pool.close()
+    assert len(pool) == 0
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), options=channel_pool.server_options())
+    add_PersistenceServiceServicer_to_server(PersistenceService(), server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        stub = PersistenceServiceStub(pool.channel(f"127.0.0.1:{port}"))
+        request = StoreTerrainRequest(tiles=[TerrainTile(x=i, y=0, terrain_type="Plains") for i in range(20000)])
+        compression = channel_pool.call_compression(request.ByteSize())
+        assert compression == grpc.Compression.Gzip
+        terrain_id = stub.StoreTerrain(request, compression=compression).terrain_id
+        assert len(stub.RetrieveTerrain(RetrieveTerrainRequest(terrain_id=terrain_id)).tiles) == 20000
+    finally:
+        pool.close()
+        server.stop(None)
+
+    TerrainGeneratorService().close()
+    channels = len(channel_pool._shared_pool)
+    services = [TerrainGeneratorService() for _ in range(3)]
+    assert len(channel_pool._shared_pool) == channels
+    for service in services:
+        service.close()
+
+    assert channel_pool.call_compression(10) == grpc.Compression.NoCompression
+    with patch("common.channel_pool.COMPRESSION", "none"):
+        assert channel_pool.call_compression(10**6) == grpc.Compression.NoCompression
+    with patch("common.channel_pool.COMPRESSION", "brotli"), pytest.raises(ValueError):
+        channel_pool.call_compression(10**6)
+
+
+def test_benchmark_regression_gate(tmp_path):
+    """
+    @test Benchmark Regression Gate
+    Verifies that benchmark results are compared with a JSON baseline and that only gated metrics regressing past their threshold fail the run.
+
+    @pre A baseline written from measured metrics, with one metric's gate turned off and one given its own threshold
+    @post Regressions are reported by direction and threshold, re-baselining keeps the gate settings, and run_suite exits 1 on a regression
+    """
+    path = tmp_path / "baseline.json"
+    baseline_metrics = [
+        Metric("latency", 1.0, "s"),
+        Metric("throughput", 100.0, "tiles/s", higher_is_better=True),
+        Metric("noisy", 1.0, "s"),
+        Metric("size", 1000, "bytes"),
+    ]
+    save_baseline(path, baseline_metrics, load_baseline(path))
+    baseline = load_baseline(path)
+    baseline["metrics"]["noisy"]["gate"] = False
+    baseline["metrics"]["size"]["threshold"] = 0.0
+    path.write_text(json.dumps(baseline))
+    baseline = load_baseline(path)
+
+    assert find_regressions(baseline_metrics, baseline) == []
+    worse = [
+        Metric("latency", 1.2, "s"),
+        Metric("throughput", 70.0, "tiles/s", higher_is_better=True),
+        Metric("noisy", 10.0, "s"),
+        Metric("size", 1001, "bytes"),
+        Metric("new", 5.0, "s"),
+    ]
+    regressions = find_regressions(worse, baseline)
+    assert [message.split(":")[0] for message in regressions] == ["throughput", "size"]
+    assert len(find_regressions(worse, baseline, threshold=0.1)) == 3
+    better = [Metric("latency", 0.5, "s"), Metric("throughput", 200.0, "tiles/s", True)]
+    assert find_regressions(better, baseline) == []
+
+    save_baseline(path, worse, baseline)
+    rebaselined = load_baseline(path)
+    assert rebaselined["metrics"]["noisy"]["gate"] is False
+    assert rebaselined["metrics"]["size"]["threshold"] == 0.0
+    assert rebaselined["metrics"]["new"]["gate"] is True
+
+    benchmarks = {"bench": lambda: [Metric("latency", 3.0, "s")]}
+    assert run_suite("test", benchmarks, path, ["--threshold", "0.5"]) == 1
+    assert run_suite("test", benchmarks, path, ["--update-baseline", "--only", "bench"]) == 0
+    assert load_baseline(path)["metrics"]["throughput"]["value"] == 70.0
+    assert run_suite("test", benchmarks, path, []) == 0
+
+
+def test_metrics_registry():
+    """
+    @test Metrics Registry
+    Verifies the Prometheus text rendering of counters, gauges and histograms, and that generating tiles increments the tiles generated counter.
+
+    @pre A fresh Registry with a labeled counter, a gauge reading a function and a histogram, and a TerrainGeneratorService
+    @post The rendering has the expected samples, misuse raises ValueError, and only generation that misses the caches is counted
+    """
+    registry = metrics.Registry()
+    requests = registry.register(metrics.Counter("requests_total", 'Requests "sent".', ("method",)))
+    assert registry.register(metrics.Counter("requests_total", "Again.", ("method",))) is requests
+    with pytest.raises(ValueError):
+        registry.register(metrics.Gauge("requests_total", "Not a counter."))
+    open_sessions = registry.register(metrics.Gauge("open_sessions", "Open sessions."))
+    latency = registry.register(metrics.Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0)))
+
+    requests.labels('a"b').inc()
+    requests.labels('a"b').inc(2)
+    with pytest.raises(ValueError):
+        requests.inc()
+    with pytest.raises(ValueError):
+        requests.labels("a").inc(-1)
+    open_sessions.set_function(lambda: 7)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+        "# HELP open_sessions Open sessions.",
+        "# TYPE open_sessions gauge",
+        "open_sessions 7",
+        '# HELP requests_total Requests "sent".',
+        "# TYPE requests_total counter",
+        'requests_total{method="a\\"b"} 3',
+        'requests_total{method="a"} 0',
+    ]
+
+    service = TerrainGeneratorService(cache_max_entries=4)
+
+    def generated():
+        return next(TILES_GENERATED.samples())[2]
+
+    start = generated()
+    service._generate_terrain_tiles(50, seed=3)
+    service._generate_terrain_tiles(50, seed=3)
+    assert generated() - start == 50
+    chunks = list(service.GenerateTerrainStream(TerrainRequest(total_land_hexagons=30, seed=4), MagicMock()))
+    assert chunks[-1].final
+    assert generated() - start == 80
+    service.close()
+
+
+def test_distributed_tracing(tmp_path):
+    """
+    @test Distributed Tracing
+    Verifies that a sampled GenerateTerrain request is traced through the generation and persistence services, and that an unsampled one records nothing on either.
+
+    @pre Generation and PersistenceService servers with tracing interceptors exporting to one file, the generator calling persistence over a channel of its own
+    @post All spans share one trace, the persistence server span continues the generator's client span, the internal phases are recorded, and unsampled requests export no spans
+    """
+    exporter = tracing.SpanExporter(path=str(tmp_path / "spans.jsonl"))
+    generation_tracer = tracing.Tracer("terrain_generation", exporter, sample_ratio=1.0)
+    persistence_tracer = tracing.Tracer("persistence", exporter, sample_ratio=1.0)
+
+    persistence_server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), interceptors=[TracingInterceptor(persistence_tracer)])
+    add_PersistenceServiceServicer_to_server(PersistenceService(), persistence_server)
+    persistence_port = persistence_server.add_insecure_port("127.0.0.1:0")
+    persistence_server.start()
+    service = TerrainGeneratorService(cache_max_entries=0)
+    service.persistence_stub = PersistenceServiceStub(grpc.insecure_channel(f"127.0.0.1:{persistence_port}"))
+    generation_server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), interceptors=[TracingInterceptor(generation_tracer)])
+    add_TerrainGenerationServiceServicer_to_server(service, generation_server)
+    generation_port = generation_server.add_insecure_port("127.0.0.1:0")
+    generation_server.start()
+
+    def spans():
+        assert exporter.flush()
+        path = tmp_path / "spans.jsonl"
+        lines = path.read_text().splitlines() if path.exists() else []
+        return [
+            (resource["resource"]["attributes"][0]["value"]["stringValue"], span)
+            for line in lines
+            for resource in json.loads(line)["resourceSpans"]
+            for scope in resource["scopeSpans"]
+            for span in scope["spans"]
+        ]
+
+    try:
+        stub = TerrainGenerationServiceStub(grpc.insecure_channel(f"127.0.0.1:{generation_port}"))
+        with patch("terrain_generation.terrain_generation_service.TRACER", generation_tracer), patch(
+            "persistence.persistence_service.TRACER", persistence_tracer
+        ):
+            response = stub.GenerateTerrain(TerrainRequest(total_land_hexagons=200, seed=5, persist=True))
+            assert response.terrain_id
+
+            recorded = spans()
+            assert len({span["traceId"] for _, span in recorded}) == 1
+            by_name = {span["name"]: (service_name, span) for service_name, span in recorded}
+            root = by_name["terrain.TerrainGenerationService/GenerateTerrain"][1]
+            assert "parentSpanId" not in root
+            assert root["kind"] == tracing.SERVER
+            # The client span of the persistence call and the server span continuing it share the method's name
+            client, server = [
+                (service_name, span)
+                for service_name, span in sorted(recorded, key=lambda item: item[1]["kind"], reverse=True)
+                if span["name"] == "persistence.PersistenceService/StoreTerrainAtomic"
+            ]
+            assert client[0] == "terrain_generation" and client[1]["kind"] == tracing.CLIENT
+            assert server[0] == "persistence" and server[1]["kind"] == tracing.SERVER
+            assert server[1]["parentSpanId"] == client[1]["spanId"]
+            for name in ("generate_terrain_tiles", "flood_fill", "elevation_field", "build_store_request", "build_response"):
+                assert by_name[name][0] == "terrain_generation"
+            for name in ("decode_tiles", "write", "commit"):
+                assert by_name[name][0] == "persistence"
+            flood_fill = by_name["flood_fill"][1]
+            assert flood_fill["parentSpanId"] == by_name["generate_terrain_tiles"][1]["spanId"]
+            assert "terrain_choice.seconds" in [attribute["key"] for attribute in flood_fill["attributes"]]
+
+            generation_tracer.sample_ratio = 0.0
+            assert stub.GenerateTerrain(TerrainRequest(total_land_hexagons=200, seed=6, persist=True)).terrain_id
+            assert len(spans()) == len(recorded)
+    finally:
+        generation_server.stop(None)
+        persistence_server.stop(None)
+        service.close()
+
+    assert tracing.parse_traceparent("00-" + "0" * 32 + "-" + "1" * 16 + "-01") is None
+    assert tracing.parse_traceparent("garbage") is None
+    context = tracing.SpanContext(3, 4, True)
+    assert tracing.parse_traceparent(context.traceparent()) == context
+    assert tracing.outgoing_metadata() == ()
+
+
+def test_logging_config():
+    """
+    @test Logging Config
+    Verifies that loggers queue records unformatted for the writer thread, take their levels from the configuration, sample per-item logs and can write JSON.
+
+    @pre Loggers set up with setup_logger under patched levels, and a QueueingHandler over a queue of one record
+    @post Levels follow LOG_LEVEL and LOG_LEVELS, unknown levels raise ValueError naming their variable, records are queued with their arguments, overflow is dropped and counted, samples are bounded, and JSON lines parse
+    """
+    with patch("common.logging_config.LOG_LEVEL", "WARNING"), patch(
+        "common.logging_config.LOG_LEVELS", "LoggingTestVerbose=DEBUG, Other=ERROR"
+    ):
+        verbose = logging_config.setup_logger("LoggingTestVerbose")
+        quiet = logging_config.setup_logger("LoggingTestQuiet")
+    assert verbose.level == logging.DEBUG and quiet.level == logging.WARNING
+    assert not verbose.propagate
+    assert isinstance(verbose.handlers[0], logging_config.QueueingHandler)
+    assert logging_config.setup_logger("LoggingTestVerbose").handlers == verbose.handlers
+    with patch("common.logging_config.LOG_LEVELS", "LoggingTestVerbose=VERBOSE"), pytest.raises(
+        ValueError, match="VIE_LOG_LEVELS"
+    ):
+        logging_config.log_level("LoggingTestVerbose")
+    with patch("common.logging_config.LOG_LEVEL", "loud"), pytest.raises(ValueError, match="VIE_LOG_LEVEL"):
+        logging_config.log_level("LoggingTestQuiet")
+
+    handler = logging_config.QueueingHandler(queue.Queue(maxsize=1))
+    dropped = next(logging_config.RECORDS_DROPPED.samples())[2]
+    for value in (1, 2):
+        handler.handle(logging.LogRecord("test", logging.INFO, __file__, 1, "value %d", (value,), None))
+    record = handler.queue.get_nowait()
+    assert (record.msg, record.args) == ("value %d", (1,))
+    assert next(logging_config.RECORDS_DROPPED.samples())[2] - dropped == 1
+
+    records = []
+    sampled = logging.getLogger("LoggingTestSample")
+    sampled.setLevel(logging.INFO)
+    sampled.propagate = False
+    sampled.addHandler(Mock(level=logging.DEBUG, handle=records.append))
+    logging_config.log_sample(sampled, logging.INFO, "item %d", 100, lambda index: (index,), limit=10)
+    assert [record.getMessage() for record in records] == [f"item {index}" for index in range(0, 100, 10)] + [
+        "Logged 10 of 100 items"
+    ]
+    records.clear()
+    logging_config.log_sample(sampled, logging.INFO, "item %d", 3, lambda index: (index,), limit=10)
+    assert len(records) == 3
+    arguments = Mock()
+    logging_config.log_sample(sampled, logging.DEBUG, "item %d", 100, arguments)
+    arguments.assert_not_called()
+
+    entry = json.loads(logging_config.create_formatter("json").format(record))
+    assert (entry["logger"], entry["level"], entry["message"]) == ("test", "INFO", "value 1")
+    assert logging_config.create_formatter("text").format(record).endswith(" - test - INFO - value 1")
+    with pytest.raises(ValueError):
+        logging_config.create_formatter("xml")